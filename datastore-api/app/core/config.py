@@ -7,9 +7,23 @@ class Settings(BaseSettings):
     ES_URL: str = Field("", env="ES_URL")
     ES_SEARCH_TIMEOUT: int = Field(30, env="ES_SEARCH_TIMEOUT")
 
+    # faiss: one faiss-instant container per index, local: indices are searched in the API process
+    VECTOR_INDEX_BACKEND: str = Field("faiss", env="VECTOR_INDEX_BACKEND")
+    VECTOR_INDEX_PATH: str = Field("./indices", env="VECTOR_INDEX_PATH")
+    VECTOR_INDEX_NPROBE: int = Field(0, env="VECTOR_INDEX_NPROBE")
+    VECTOR_INDEX_EF_SEARCH: int = Field(0, env="VECTOR_INDEX_EF_SEARCH")
+    VECTOR_INDEX_RELOAD_INTERVAL: float = Field(10, env="VECTOR_INDEX_RELOAD_INTERVAL")
+
     FAISS_PORT: int = Field(5000, env="FAISS_PORT")
+    FAISS_TIMEOUT: float = Field(30, env="FAISS_TIMEOUT")
+    FAISS_MAX_CONNECTIONS: int = Field(100, env="FAISS_MAX_CONNECTIONS")
+    FAISS_MAX_RETRIES: int = Field(2, env="FAISS_MAX_RETRIES")
+    FAISS_CIRCUIT_BREAKER_THRESHOLD: int = Field(5, env="FAISS_CIRCUIT_BREAKER_THRESHOLD")
+    FAISS_CIRCUIT_BREAKER_RESET: float = Field(30, env="FAISS_CIRCUIT_BREAKER_RESET")
     UPLOAD_BATCH_SIZE: int = Field(1000, env="UPLOAD_BATCH_SIZE")
     MODEL_API_URL: str = Field("", env="MODEL_API_URL")
+    MODEL_API_TIMEOUT: float = Field(100, env="MODEL_API_TIMEOUT")
+    MODEL_API_MAX_CONNECTIONS: int = Field(100, env="MODEL_API_MAX_CONNECTIONS")
     MAX_RETURN_ITEMS: int = Field(10000, env="MAX_RETURN_ITEMS")
 
     # Mongo ROOT
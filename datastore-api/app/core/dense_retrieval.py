@@ -1,18 +1,25 @@
+import asyncio
 import logging
-from typing import List
+from typing import List, Union
 from ..models.document import Document
 
-from ..models.query import QueryResult
+from ..models.query import FusionMethod, QueryResult
 from .base_connector import BaseConnector
 from .faiss import FaissClient
+from .fusion import fuse
+from .vector_index import LocalVectorIndex
 from .model_api import ModelAPIClient
 
 logger = logging.getLogger(__name__)
 
 class DenseRetrieval:
-    """Contains the logic for dense retrieval leveraging the Square Model API and FAISS."""
+    """Contains the logic for dense retrieval leveraging the Square Model API and FAISS.
 
-    def __init__(self, conn: BaseConnector, model_api: ModelAPIClient, faiss: FaissClient):
+    The FAISS indices are either served by faiss-instant containers (FaissClient)
+    or loaded into the API process (LocalVectorIndex).
+    """
+
+    def __init__(self, conn: BaseConnector, model_api: ModelAPIClient, faiss: Union[FaissClient, LocalVectorIndex]):
         self.conn = conn
         self.model_api = model_api
         self.faiss = faiss
@@ -32,9 +39,9 @@ class DenseRetrieval:
         if index is None:
             return False
 
-        status = self.faiss.status(datastore_name, index_name) is not None
+        status = await self.faiss.status(datastore_name, index_name) is not None
         if status:
-            status &= self.model_api.is_alive(index, credential_token)
+            status &= await self.model_api.is_alive(index, credential_token)
         return status
 
     async def search(
@@ -68,7 +75,7 @@ class DenseRetrieval:
         query_vector = await self.model_api.encode_query(query, index, credential_token)
         logger.debug(f"Received query embedding:{query_vector}")
         # 2. Search for the query in the FAISS store. This will return ids of matched docs.
-        queried = self.faiss.search(datastore_name, index_name, query_vector, top_k)
+        queried = await self.faiss.search(datastore_name, index_name, query_vector, top_k)
         logger.debug(f"Queried Faiss, returned {len(queried)} docs.")
         # 3. Lookup the retrieved doc ids in the ES index.
         docs: List[Document] = await self.conn.get_document_batch(datastore_name, list(queried.keys()))
@@ -79,6 +86,121 @@ class DenseRetrieval:
 
         return sorted(results, key=lambda x: x.score, reverse=True)
 
+    async def hybrid_search(
+        self,
+        datastore_name: str,
+        index_name: str,
+        query: str,
+        top_k: int = 10,
+        credential_token: str = None,
+        fusion: FusionMethod = FusionMethod.rrf,
+        dense_weight: float = 0.5,
+        feedback_documents: List[str] = None,
+    ) -> List[QueryResult]:
+        """Searches for documents matching the given query string with both BM25 and dense retrieval.
+        Both retrievals run concurrently and their scores are fused.
+
+        Args:
+            datastore_name (str): The datastore in which to search.
+            index_name (str): The index to be used for dense retrieval.
+            query (str): The query string.
+            top_k (int, optional): The number of hits to retrieve with each retrieval and to return. Defaults to 10.
+            fusion (FusionMethod, optional): How the scores are fused. Defaults to reciprocal rank fusion.
+            dense_weight (float, optional): The weight of dense retrieval, BM25 is weighted by 1 - dense_weight.
+                Defaults to 0.5.
+            feedback_documents (list, optional): Relevant feedback documents for BM25.
+
+        Returns:
+            list: A list of QueryResults with the fused scores.
+        """
+        index = await self.conn.get_index(datastore_name, index_name)
+        if index is None:
+            raise ValueError("Datastore or index not found.")
+
+        if credential_token is None:
+            raise ValueError("Credential token is None")
+
+        async def dense_search():
+            query_vector = await self.model_api.encode_query(query, index, credential_token)
+            if query_vector is None:
+                raise ValueError("Index has no query encoder")
+            return await self.faiss.search(datastore_name, index_name, query_vector, top_k)
+
+        # 1. Run BM25 and dense retrieval (query encoding and FAISS search) concurrently.
+        sparse_results, dense_hits = await asyncio.gather(
+            self.conn.search(datastore_name, query, feedback_documents=feedback_documents, n_hits=top_k),
+            dense_search(),
+        )
+        # 2. Fuse the scores of both retrievals.
+        sparse_hits = {result.id: result.score for result in sparse_results}
+        fused = fuse([sparse_hits, dense_hits], [1 - dense_weight, dense_weight], fusion)
+        # 3. BM25 already returned its documents, only the remaining documents are looked up in the ES index.
+        docs_by_id = {result.id: result.document for result in sparse_results}
+        missing_ids = [doc_id for doc_id, _ in fused if doc_id not in docs_by_id]
+        if missing_ids:
+            docs: List[Document] = await self.conn.get_document_batch(datastore_name, missing_ids)
+            docs_by_id.update({str(doc["id"]): doc for doc in docs})
+
+        # documents that are not in the datastore are skipped before the top_k hits are selected
+        return [
+            QueryResult(document=docs_by_id[doc_id], score=score, id=doc_id)
+            for doc_id, score in fused
+            if doc_id in docs_by_id
+        ][:top_k]
+
+    async def search_batch(
+        self,
+        datastore_name: str,
+        index_name: str,
+        queries: List[str],
+        top_k: int = 10,
+        credential_token: str = None
+    ) -> List[List[QueryResult]]:
+        """Searches for documents matching each of the given query strings.
+        All queries are encoded with one Model API request and searched with one FAISS request.
+        The retrieved documents of all queries are looked up together.
+
+        Args:
+            datastore_name (str): The datastore in which to search.
+            index_name (str): The index to be used.
+            queries (list): The query strings.
+            top_k (int, optional): The number of hits to return per query. Defaults to 10.
+
+        Returns:
+            list: A list of QueryResults for each query.
+        """
+        index = await self.conn.get_index(datastore_name, index_name)
+        if index is None:
+            raise ValueError("Datastore or index not found.")
+
+        if credential_token is None:
+            raise ValueError("Credential token is None")
+
+        if not queries:
+            return []
+
+        # 1. Get the query embeddings from the model api
+        query_vectors = await self.model_api.encode_queries(queries, index, credential_token)
+        if query_vectors is None:
+            raise ValueError("Index has no query encoder")
+        # 2. Search for all queries in the FAISS store. This will return ids of matched docs per query.
+        queried = await self.faiss.search_many(datastore_name, index_name, query_vectors, top_k)
+        logger.debug(f"Queried Faiss for {len(queries)} queries.")
+        # 3. Lookup the retrieved doc ids of all queries in the ES index at once.
+        doc_ids = list(dict.fromkeys(doc_id for hits in queried for doc_id in hits))
+        docs: List[Document] = await self.conn.get_document_batch(datastore_name, doc_ids) if doc_ids else []
+        docs_by_id = {str(doc["id"]): doc for doc in docs}
+
+        results = []
+        for hits in queried:
+            query_results = [
+                QueryResult(document=docs_by_id[doc_id], score=score, id=doc_id)
+                for doc_id, score in hits.items()
+                if doc_id in docs_by_id
+            ]
+            results.append(sorted(query_results, key=lambda x: x.score, reverse=True))
+        return results
+
     async def search_by_vector(
         self, 
         datastore_name: str, 
@@ -104,7 +226,7 @@ class DenseRetrieval:
         # 0. Ensure the query vector has the right dimensionality.
         query_vector = query_vector + [0] * (index.embedding_size - len(query_vector))
         # 1. Search for the query in the FAISS store. This will return ids of matched docs.
-        queried = self.faiss.search(datastore_name, index_name, query_vector, top_k)
+        queried = await self.faiss.search(datastore_name, index_name, query_vector, top_k)
         # 2. Lookup the retrieved doc ids in the ES index.
         docs: List[Document] = await self.conn.get_document_batch(datastore_name, list(queried.keys()))
         results = []
@@ -140,7 +262,7 @@ class DenseRetrieval:
         # 1. Get the query embedding from the model api
         query_vector = await self.model_api.encode_query(query, index, credential_token)
         # 2. Search for the query in the FAISS store. This will return ids of matched docs.
-        queried = self.faiss.explain(
+        queried = await self.faiss.explain(
             datastore_name, 
             index_name, 
             query_vector, 
@@ -165,5 +287,5 @@ class DenseRetrieval:
         if index is None:
             raise ValueError("Datastore or index not found.")
 
-        result = self.faiss.reconstruct(datastore_name, index_name, document_id)
+        result = await self.faiss.reconstruct(datastore_name, index_name, document_id)
         return result["vector"]
@@ -246,7 +246,12 @@ class ElasticsearchConnector(BaseConnector):
         """
         docs_index = self._datastore_docs_index_name(datastore_name)
         results = await self.es.mget(index=docs_index, body={"ids": document_ids})
-        return [self.converter.convert_to_document(doc["_source"], doc['_id']) for doc in results["docs"]]
+        # documents that do not exist (anymore) are skipped
+        return [
+            self.converter.convert_to_document(doc["_source"], doc['_id'])
+            for doc in results["docs"]
+            if doc.get("found", True)
+        ]
 
     async def add_document(self, datastore_name: str, document_id: str, document: Document) -> Tuple[bool, bool]:
         """Adds a new document.
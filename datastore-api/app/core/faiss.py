@@ -1,63 +1,163 @@
+import asyncio
 import logging
-from typing import List, Optional
-import requests
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+
 from .config import settings
 from ..models.query import QueryResult
 
 
 logger = logging.getLogger(__name__)
 
+# Responses with these status codes are retried, e.g. while the FAISS container is (re)starting
+RETRY_STATUS_CODES = {502, 503, 504}
+
+
+class CircuitBreaker:
+    """Stops calling a FAISS server after consecutive failures until a cool-down has passed.
+
+    After the cool-down, a single trial request is let through. If it succeeds the circuit is closed again,
+    otherwise it stays open for another cool-down.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def allow_request(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            # half-open: let one request through and block the others until it is done
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failure_threshold > 0 and self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
 
 class FaissClient:
-    """Wraps access to the FAISS server."""
+    """Wraps access to the FAISS server.
+
+    All requests share one keep-alive connection pool. Failed requests are retried and the
+    FAISS server of each index has its own circuit breaker, so that an unavailable index fails fast.
+    """
+
+    def __init__(
+        self,
+        timeout: float = None,
+        max_connections: int = None,
+        max_retries: int = None,
+        failure_threshold: int = None,
+        reset_timeout: float = None,
+    ):
+        self.timeout = aiohttp.ClientTimeout(total=timeout if timeout is not None else settings.FAISS_TIMEOUT)
+        self.max_connections = max_connections if max_connections is not None else settings.FAISS_MAX_CONNECTIONS
+        self.max_retries = max_retries if max_retries is not None else settings.FAISS_MAX_RETRIES
+        self.failure_threshold = (
+            failure_threshold if failure_threshold is not None else settings.FAISS_CIRCUIT_BREAKER_THRESHOLD
+        )
+        self.reset_timeout = reset_timeout if reset_timeout is not None else settings.FAISS_CIRCUIT_BREAKER_RESET
+        self.retry_backoff = 0.1
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop = None
+        self._breakers: Dict[tuple, CircuitBreaker] = {}
 
     @staticmethod
     def build_faiss_url(datastore_name, index_name):
         url = 'http://' + '_'.join(['faiss', datastore_name, index_name]) + f':{settings.FAISS_PORT}'
         return url
 
-    def status(self, datastore_name, index_name) -> Optional[dict]:
-        url = f"{self.build_faiss_url(datastore_name, index_name)}/index_list"
-        response = requests.get(url)
-        if response.status_code != 200:
-            logger.info(response.text)
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Returns the shared session, creating it in the running event loop if necessary."""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._loop = loop
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _get_breaker(self, datastore_name: str, index_name: str) -> CircuitBreaker:
+        key = (datastore_name, index_name)
+        if key not in self._breakers:
+            self._breakers[key] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return self._breakers[key]
+
+    async def _request(self, method: str, datastore_name: str, index_name: str, path: str, **kwargs):
+        """Sends a request to the FAISS server of the index and returns the decoded JSON response.
+
+        Raises:
+            EnvironmentError: If the server is unavailable or does not return status 200.
+        """
+        breaker = self._get_breaker(datastore_name, index_name)
+        if not breaker.allow_request():
+            raise EnvironmentError(f"Faiss server for index {index_name} is unavailable.")
+
+        url = f"{self.build_faiss_url(datastore_name, index_name)}/{path}"
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            try:
+                async with self._get_session().request(method, url, **kwargs) as response:
+                    if response.status == 200:
+                        queried = await response.json()
+                        breaker.record_success()
+                        return queried
+                    text = await response.text()
+                    logger.info(text)
+                    error = EnvironmentError(f"Faiss server returned {response.status}.")
+                    if response.status not in RETRY_STATUS_CODES:
+                        # the server is up, but rejected the request
+                        breaker.record_success()
+                        raise error
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.info(f"Request to faiss at {url} failed: {e!r}")
+                error = EnvironmentError(f"Faiss server is not reachable: {e!r}")
+        breaker.record_failure()
+        raise error
+
+    async def status(self, datastore_name, index_name) -> Optional[dict]:
+        try:
+            return await self._request("GET", datastore_name, index_name, "index_list")
+        except EnvironmentError:
             return None
 
-        queried = response.json()
-        return queried
+    async def search(self, datastore_name, index_name, query_vector, top_k=10) -> List[QueryResult]:
+        return (await self.search_many(datastore_name, index_name, [query_vector], top_k))[0]
+
+    async def search_many(self, datastore_name, index_name, query_vectors, top_k=10) -> List[dict]:
+        """Searches for all query vectors with a single request to the FAISS server.
 
-    def search(self, datastore_name, index_name, query_vector, top_k=10) -> List[QueryResult]:
-        url = f"{self.build_faiss_url(datastore_name, index_name)}/search"
-        data = {"k": top_k, "vectors": [query_vector]}
-        logger.debug(f"querying faiss at {url}") 
-        response = requests.post(url, json=data)
-        if response.status_code != 200:
-            logger.info(response.text)
-            raise EnvironmentError(f"Faiss server returned {response.status_code}.")
-        
-        logger.debug(f"received response from datastore api:\n{response.content}")
-        
-        queried = response.json()[0]
+        Returns:
+            list: For each query vector, a dictionary from document id to score.
+        """
+        data = {"k": top_k, "vectors": query_vectors}
+        logger.debug(f"querying faiss for index {index_name} with {len(query_vectors)} vectors")
+        queried = await self._request("POST", datastore_name, index_name, "search", json=data)
+        logger.debug(f"received response from faiss:\n{queried}")
         return queried
 
-    def explain(self, datastore_name, index_name, query_vector, document_id) -> QueryResult:
-        url = f"{self.build_faiss_url(datastore_name, index_name)}/explain"
+    async def explain(self, datastore_name, index_name, query_vector, document_id) -> QueryResult:
         data = {"vector": query_vector, "id": document_id}
-        response = requests.post(url, json=data)
-        if response.status_code != 200:
-            logger.info(response.text)
-            raise EnvironmentError(f"Faiss server returned {response.status_code}.")
-
-        queried = response.json()
-        return queried
+        return await self._request("POST", datastore_name, index_name, "explain", json=data)
 
-    def reconstruct(self, datastore_name, index_name, document_id) -> List[float]:
-        url = f"{self.build_faiss_url(datastore_name, index_name)}/reconstruct"
+    async def reconstruct(self, datastore_name, index_name, document_id) -> List[float]:
         params = {"id": document_id}
-        response = requests.get(url, params=params)
-        if response.status_code != 200:
-            logger.info(response.text)
-            raise EnvironmentError(f"Faiss server returned {response.status_code}.")
-
-        queried = response.json()
-        return queried
+        return await self._request("GET", datastore_name, index_name, "reconstruct", params=params)
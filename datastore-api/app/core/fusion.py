@@ -0,0 +1,60 @@
+from typing import Dict, List, Tuple
+
+from ..models.query import FusionMethod
+
+# Rank constant of reciprocal rank fusion, dampens the influence of the top ranks (Cormack et al., 2009)
+RRF_K = 60
+
+
+def reciprocal_rank_fusion(rankings: List[Dict[str, float]], weights: List[float], k: int = RRF_K) -> Dict[str, float]:
+    """Fuses the rankings by the weighted sum of 1 / (k + rank) of each document.
+    Only the order of the documents in each ranking is used, not their scores.
+
+    Args:
+        rankings (list): For each retrieval, a dictionary from document id to score.
+        weights (list): The weight of each retrieval.
+        k (int, optional): The rank constant. Defaults to RRF_K.
+    """
+    fused = {}
+    for ranking, weight in zip(rankings, weights):
+        ranked = sorted(ranking.items(), key=lambda x: x[1], reverse=True)
+        for rank, (doc_id, _) in enumerate(ranked, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight / (k + rank)
+    return fused
+
+
+def linear_fusion(rankings: List[Dict[str, float]], weights: List[float]) -> Dict[str, float]:
+    """Fuses the rankings by the weighted sum of the min-max normalized scores of each document.
+    Documents that were not retrieved by a retrieval get 0 from it.
+
+    Args:
+        rankings (list): For each retrieval, a dictionary from document id to score.
+        weights (list): The weight of each retrieval.
+    """
+    fused = {}
+    for ranking, weight in zip(rankings, weights):
+        if not ranking:
+            continue
+        low, high = min(ranking.values()), max(ranking.values())
+        for doc_id, score in ranking.items():
+            normalized = (score - low) / (high - low) if high > low else 1.0
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight * normalized
+    return fused
+
+
+def fuse(
+    rankings: List[Dict[str, float]], weights: List[float], method: FusionMethod, top_k: int = None
+) -> List[Tuple[str, float]]:
+    """Fuses the rankings of several retrievals, higher scores are assumed to be better in each ranking.
+
+    Returns:
+        list: The (document id, fused score) pairs, best first. Only the first top_k pairs if top_k is given.
+    """
+    if method == FusionMethod.rrf:
+        fused = reciprocal_rank_fusion(rankings, weights)
+    elif method == FusionMethod.linear:
+        fused = linear_fusion(rankings, weights)
+    else:
+        raise ValueError(f"Unknown fusion method {method}.")
+    ranked = sorted(fused.items(), key=lambda x: x[1], reverse=True)
+    return ranked if top_k is None else ranked[:top_k]
@@ -1,18 +1,17 @@
-import ast
 import asyncio
 import base64
-import json
 import logging
 import time
 import os
 from io import BytesIO
+from typing import List
 
 import aiohttp
 import numpy as np
-import requests
 from aiohttp.client import ClientSession
 from square_auth.client_credentials import ClientCredentials
 
+from .config import settings
 from ..models.index import Index
 logger = logging.getLogger(__name__)
 
@@ -25,11 +24,13 @@ class ModelAPIClient:
         self.base_url = base_url
         self.square_api_url = base_url
         self.verify_ssl = os.getenv("VERIFY_SSL", "1") == "1"
-        self.max_attempts = 50
-        self.poll_interval = 2
-        
+        self.max_wait = settings.MODEL_API_TIMEOUT
+        self.max_poll_interval = 1
+        self.max_connections = settings.MODEL_API_MAX_CONNECTIONS
+        self._session = None
+        self._loop = None
 
-    def is_alive(self, index: Index, credential_token: str) -> bool:
+    async def is_alive(self, index: Index, credential_token: str) -> bool:
         if not self.base_url:
             raise EnvironmentError("Model API not available.")
 
@@ -41,14 +42,14 @@ class ModelAPIClient:
 
         request_url = f"{self.base_url}/{index.query_encoder_model}/health/heartbeat"
         try:
-            response = requests.get(
-                request_url, 
+            async with self._get_session().get(
+                request_url,
                 headers={"Authorization": f"Bearer {credential_token}"}
-            )
-            if response.status_code != 200:
-                return False
-            else:
-                return response.json().get("is_alive", False)
+            ) as response:
+                if response.status != 200:
+                    return False
+                else:
+                    return (await response.json()).get("is_alive", False)
         except Exception:
             return False
 
@@ -59,13 +60,24 @@ class ModelAPIClient:
         return arr
 
     async def encode_query(self, query: str, index: Index, credential_token: str):
+        embeddings = await self.encode_queries([query], index, credential_token)
+        if embeddings is None:
+            return None
+        return embeddings[0]
+
+    async def encode_queries(self, queries: List[str], index: Index, credential_token: str):
+        """Encodes all queries with one prediction request to the query encoder of the index.
+
+        Returns:
+            list: The embedding of each query or None if the index has no query encoder.
+        """
         if index.query_encoder_model is None:
             return None
         if not self.base_url:
             raise EnvironmentError("Model API not available.")
 
         data = {
-            "input": [query],
+            "input": queries,
             "adapter_name": index.query_encoder_adapter,
             "task_kwargs": {
                 "embedding_mode": index.embedding_mode
@@ -77,63 +89,82 @@ class ModelAPIClient:
             prediction_method="embedding", 
             input_data=data
         )
-        logger.info(f"Model API response={response}")
+        logger.debug(f"Model API response={response}")
 
         embeddings = self._decode_embeddings(
             response["model_outputs"]["embeddings"]
-        ).flatten()
-        # The vector returned here may be shorter than the stored document vector.
+        ).reshape(len(queries), -1)
+        # The vectors returned here may be shorter than the stored document vectors.
         # In that case, we fill the remaining values with zeros.
-        if index.embedding_size - len(embeddings) > 0:
+        padding = [0] * (index.embedding_size - embeddings.shape[1])
+        if padding:
             logger.warning(
                 "Embedded query vector is shorter than the configured size."
             )
-        return embeddings.tolist() + [0] * (index.embedding_size - len(embeddings))
+        return [embedding.tolist() + padding for embedding in embeddings]
+
+    def _get_session(self) -> ClientSession:
+        """Returns the shared session, creating it in the running event loop if necessary."""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, ssl=None if self.verify_ssl else False)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._loop = loop
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
 
     async def _wait_for_task(
         self,
         task_id: str,
         session: ClientSession,
-        max_attempts=None,
-        poll_interval=None,
+        max_wait=None,
+        max_poll_interval=None,
     ):
         """
         Handling waiting for a task to finish. While the task has
         not finished request the result from the task_result
-        endpoint and check whether it is finished
+        endpoint. The interval between the requests starts at a
+        few milliseconds and is doubled after each request, so that
+        fast predictions are returned almost immediately.
         Args:
              task_id (str): the id of the task
-             max_attempts (int, optional): the maximum number of
-                attempts to get the result. If this is None the
-                self.max_attempts is used. The default is None.
-             poll_interval (int, optional): the interval between the
-                attempts to poll the results. If this is None
-                self.poll_intervall is used. Defaults to None.
+             max_wait (float, optional): the maximum time in seconds
+                to wait for the result. If this is None self.max_wait
+                is used. The default is None.
+             max_poll_interval (float, optional): the maximum interval
+                between the attempts to poll the results. If this is
+                None self.max_poll_interval is used. Defaults to None.
         """
-        if max_attempts is None:
-            max_attempts = self.max_attempts
-        if poll_interval is None:
-            poll_interval = self.poll_interval
-        attempts = 0
-        result = None
-        while attempts < max_attempts:
-            attempts += 1
+        if max_wait is None:
+            max_wait = self.max_wait
+        if max_poll_interval is None:
+            max_poll_interval = self.max_poll_interval
+        deadline = time.monotonic() + max_wait
+        interval = 0.01
+        while True:
             async with session.get(
                 url=f"{self.square_api_url}/main/task_result/{task_id}",
                 headers={"Authorization": f"Bearer {client_credentials()}"},
-                verify_ssl=self.verify_ssl,
             ) as response:
-                resp = await response.text()
-
                 if response.status == 200:
-                    result = ast.literal_eval(json.dumps(resp))
-                    break
-                time.sleep(poll_interval)
-        return json.loads(result)["result"]
+                    return (await response.json())["result"]
+                if response.status != 202:
+                    raise EnvironmentError(f"Model API returned {response.status} for task {task_id}.")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Model API did not finish task {task_id} within {max_wait} seconds.")
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(2 * interval, max_poll_interval)
 
     async def predict(self, model_identifier, prediction_method, input_data):
         """
         Request model prediction.
+        The Model API is asked to return the result with the response (wait=true).
+        If the prediction takes longer than the Model API waits, the result is polled.
         Args:
             model_identifier (str): the identifier of the model that
                 should be used for the prediction
@@ -157,23 +188,19 @@ class ModelAPIClient:
                 f"{supported_prediction_methods}"
             )
 
-        my_conn = aiohttp.TCPConnector()
-        async with aiohttp.ClientSession(connector=my_conn) as session:
-            async with session.post(
-                url=f"{self.square_api_url}/main/{model_identifier}/{prediction_method}",
-                json=input_data,
-                headers={"Authorization": f"Bearer {client_credentials()}"},
-                verify_ssl=self.verify_ssl,
-            ) as response:
-
-                result = await response.text()
-                # print(response.status)
-                if response.status == 200:
-                    return await asyncio.ensure_future(
-                        self._wait_for_task(
-                            ast.literal_eval(result)["task_id"],
-                            session=session,
-                        )
-                    )
-                else:
-                    return response
+        session = self._get_session()
+        async with session.post(
+            url=f"{self.square_api_url}/main/{model_identifier}/{prediction_method}",
+            params={"wait": "true", "timeout": str(self.max_wait)},
+            json=input_data,
+            headers={"Authorization": f"Bearer {client_credentials()}"},
+        ) as response:
+            if response.status not in (200, 202):
+                logger.info(await response.text())
+                raise EnvironmentError(f"Model API returned {response.status}.")
+            result = await response.json()
+
+        if "result" in result:
+            return result["result"]
+        # the prediction did not finish while the Model API waited
+        return await self._wait_for_task(result["task_id"], session=session)
@@ -1,5 +1,5 @@
 from .bing import BingSearch
-from ..routers.dependencies import get_storage_connector, get_mongo_client
+from ..routers.dependencies import get_storage_connector, get_mongo_client, get_search_client
 from .es.connector import ElasticsearchConnector
 from .mongo import MongoClient
 from ..models.datastore import DatastoreRequest, DatastoreField
@@ -73,3 +73,10 @@ async def startup_event_handler():
     except Exception as e:
         logger.error(
             f"Failed to create datastore {datastore_name}: {e}")
+
+
+async def shutdown_event_handler():
+    # close the connection pools of the FAISS and Model API clients
+    search_client = get_search_client()
+    await search_client.faiss.close()
+    await search_client.model_api.close()
@@ -0,0 +1,224 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .config import settings
+from .faiss import FaissClient
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+logger = logging.getLogger(__name__)
+
+# Files of an index, as built by faiss-instant (see local_deploy/deploy_ds.py)
+INDEX_FILE = "dense.index"
+IDS_FILE = "dense.txt"
+
+
+class LoadedIndex:
+    """A FAISS index together with the document ids of its vectors."""
+
+    def __init__(self, path: str, nprobe: int, ef_search: int):
+        self.path = path
+        self.version = self.file_version(path)
+        self.index = self._read_index(os.path.join(path, INDEX_FILE))
+        with open(os.path.join(path, IDS_FILE)) as f:
+            self.ids = [line.strip() for line in f]
+        if len(self.ids) != self.index.ntotal:
+            raise ValueError(
+                f"Index {path} contains {self.index.ntotal} vectors, but {len(self.ids)} ids."
+            )
+        self.positions = {doc_id: position for position, doc_id in enumerate(self.ids)}
+        self.inner_product = self.index.metric_type == faiss.METRIC_INNER_PRODUCT
+        self._set_search_parameters(nprobe, ef_search)
+        self._has_direct_map = False
+        self._direct_map_lock = threading.Lock()
+
+    @staticmethod
+    def file_version(path: str) -> Tuple:
+        """(mtime, size) of the index files, used to detect updated indices."""
+        stats = [os.stat(os.path.join(path, name)) for name in (INDEX_FILE, IDS_FILE)]
+        return tuple((stat.st_mtime, stat.st_size) for stat in stats)
+
+    @staticmethod
+    def _read_index(index_file: str):
+        # memory-map the index, so that it is not copied into memory and shared between workers
+        try:
+            return faiss.read_index(index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            logger.info(f"Index {index_file} does not support memory-mapping, reading it into memory.")
+            return faiss.read_index(index_file)
+
+    def _set_search_parameters(self, nprobe: int, ef_search: int):
+        parameters = faiss.ParameterSpace()
+        for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+            if value <= 0:
+                continue
+            try:
+                parameters.set_index_parameter(self.index, name, value)
+            except RuntimeError:
+                # the index has no such parameter, e.g. nprobe for exact or HNSW indices
+                pass
+
+    def search(self, query_vectors: List[List[float]], top_k: int) -> List[Dict[str, float]]:
+        queries = np.asarray(query_vectors, dtype=np.float32).reshape(len(query_vectors), self.index.d)
+        scores, positions = self.index.search(queries, top_k)
+        return [
+            {self.ids[position]: float(score) for score, position in zip(query_scores, query_positions) if position >= 0}
+            for query_scores, query_positions in zip(scores, positions)
+        ]
+
+    def reconstruct(self, document_id: str) -> List[float]:
+        position = self.positions.get(str(document_id))
+        if position is None:
+            raise ValueError(f"Document {document_id} not found in index.")
+        with self._direct_map_lock:
+            if not self._has_direct_map:
+                # IVF indices can only reconstruct vectors with a map from position to inverted list
+                ivf_index = faiss.try_extract_index_ivf(self.index)
+                if ivf_index is not None:
+                    ivf_index.make_direct_map()
+                self._has_direct_map = True
+        return self.index.reconstruct(position).tolist()
+
+    def explain(self, query_vector: List[float], document_id: str) -> float:
+        """The score of the document for the query, as it would be returned by search."""
+        query = np.asarray(query_vector, dtype=np.float32)
+        vector = np.asarray(self.reconstruct(document_id), dtype=np.float32)
+        if self.inner_product:
+            return float(np.dot(query, vector))
+        return float(np.sum((query - vector) ** 2))
+
+
+class LocalVectorIndex:
+    """Serves the dense indices from within the Datastore API process instead of from FAISS containers.
+
+    The index of (datastore, index) is read from <VECTOR_INDEX_PATH>/<datastore>/<index>/dense.index and dense.txt,
+    i.e. the resources of a faiss-instant container. Indices are loaded on first use. When the files are replaced,
+    the new index is loaded in the background and swapped in once it is ready, so searches are never interrupted.
+    It implements the methods of FaissClient that are used by DenseRetrieval.
+    """
+
+    def __init__(
+        self,
+        path: str = None,
+        nprobe: int = None,
+        ef_search: int = None,
+        reload_interval: float = None,
+    ):
+        if faiss is None:
+            raise ImportError("The local vector index requires faiss, install faiss-cpu or faiss-gpu.")
+        self.path = path if path is not None else settings.VECTOR_INDEX_PATH
+        self.nprobe = nprobe if nprobe is not None else settings.VECTOR_INDEX_NPROBE
+        self.ef_search = ef_search if ef_search is not None else settings.VECTOR_INDEX_EF_SEARCH
+        self.reload_interval = reload_interval if reload_interval is not None else settings.VECTOR_INDEX_RELOAD_INTERVAL
+        self._indices: Dict[Tuple[str, str], LoadedIndex] = {}
+        self._loading: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._checked_at: Dict[Tuple[str, str], float] = {}
+
+    def index_path(self, datastore_name: str, index_name: str) -> str:
+        return os.path.join(self.path, datastore_name, index_name)
+
+    def _load(self, key: Tuple[str, str]) -> asyncio.Task:
+        """Loads the index in a thread. Concurrent requests for the same index share the task."""
+        if key not in self._loading:
+            async def load():
+                try:
+                    loaded = await asyncio.to_thread(LoadedIndex, self.index_path(*key), self.nprobe, self.ef_search)
+                    self._indices[key] = loaded
+                    self._checked_at[key] = time.monotonic()
+                    logger.info(f"Loaded index {key} with {loaded.index.ntotal} vectors")
+                    return loaded
+                finally:
+                    del self._loading[key]
+
+            self._loading[key] = asyncio.ensure_future(load())
+        return self._loading[key]
+
+    async def get_index(self, datastore_name: str, index_name: str) -> LoadedIndex:
+        """Returns the loaded index and reloads it in the background if its files have changed.
+
+        Raises:
+            EnvironmentError: If the index files do not exist.
+        """
+        key = (datastore_name, index_name)
+        loaded = self._indices.get(key)
+        if loaded is None:
+            try:
+                return await asyncio.shield(self._load(key))
+            except (OSError, RuntimeError, ValueError) as e:
+                raise EnvironmentError(f"Index {index_name} of datastore {datastore_name} is not available: {e}")
+
+        now = time.monotonic()
+        if key not in self._loading and now - self._checked_at.get(key, 0) >= self.reload_interval:
+            self._checked_at[key] = now
+            try:
+                changed = LoadedIndex.file_version(loaded.path) != loaded.version
+            except OSError:
+                changed = False
+            if changed:
+                logger.info(f"Files of index {key} changed, reloading it")
+                self._load(key).add_done_callback(self._log_failed_reload)
+        # the current index is used until the new one is loaded
+        return loaded
+
+    @staticmethod
+    def _log_failed_reload(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Reloading index failed, keeping the current one: {task.exception()}")
+
+    async def reload(self, datastore_name: str, index_name: str):
+        """Loads the current files of the index and swaps them in once loaded."""
+        await self._load((datastore_name, index_name))
+
+    async def close(self):
+        for task in list(self._loading.values()):
+            task.cancel()
+        self._indices.clear()
+
+    async def status(self, datastore_name, index_name) -> Optional[dict]:
+        try:
+            loaded = await self.get_index(datastore_name, index_name)
+        except EnvironmentError:
+            return None
+        return {
+            "device": "cpu",
+            "index list": [index_name],
+            "index loaded": index_name,
+            "size": loaded.index.ntotal,
+        }
+
+    async def search(self, datastore_name, index_name, query_vector, top_k=10) -> Dict[str, float]:
+        return (await self.search_many(datastore_name, index_name, [query_vector], top_k))[0]
+
+    async def search_many(self, datastore_name, index_name, query_vectors, top_k=10) -> List[Dict[str, float]]:
+        loaded = await self.get_index(datastore_name, index_name)
+        # searching releases the GIL, so other requests are served in the meantime
+        return await asyncio.to_thread(loaded.search, query_vectors, top_k)
+
+    async def explain(self, datastore_name, index_name, query_vector, document_id) -> dict:
+        loaded = await self.get_index(datastore_name, index_name)
+        score = await asyncio.to_thread(loaded.explain, query_vector, document_id)
+        return {"id": document_id, "score": score}
+
+    async def reconstruct(self, datastore_name, index_name, document_id) -> dict:
+        loaded = await self.get_index(datastore_name, index_name)
+        vector = await asyncio.to_thread(loaded.reconstruct, document_id)
+        return {"id": document_id, "vector": vector}
+
+
+def create_vector_index():
+    """Creates the vector index backend of DenseRetrieval configured with VECTOR_INDEX_BACKEND."""
+    if settings.VECTOR_INDEX_BACKEND == "local":
+        return LocalVectorIndex()
+    if settings.VECTOR_INDEX_BACKEND == "faiss":
+        return FaissClient()
+    raise ValueError(f"Unknown vector index backend {settings.VECTOR_INDEX_BACKEND}, use 'faiss' or 'local'.")
@@ -2,7 +2,7 @@ from fastapi import FastAPI, Depends
 from fastapi.middleware.cors import CORSMiddleware
 
 from .core.bing import BingMiddleware
-from .core.startup import startup_event_handler
+from .core.startup import startup_event_handler, shutdown_event_handler
 from .core.config import settings
 # from .core.auth import verify_api_key  # deprecated
 from .routers import api
@@ -34,3 +34,8 @@ app = get_app()
 @app.on_event("startup")
 async def startup_event():
     await startup_event_handler()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await shutdown_event_handler()
@@ -9,6 +9,12 @@ class QueryResult(BaseModel):
     score: float
     id: str
 
+
+class FusionMethod(str, Enum):
+    """How the scores of sparse and dense retrieval are combined in hybrid search."""
+    rrf = "rrf"  # reciprocal rank fusion
+    linear = "linear"  # weighted sum of min-max normalized scores
+
 regions = {
 "da-DK": "da-DK",
 "de-AT": "de-AT",
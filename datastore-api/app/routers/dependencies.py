@@ -5,7 +5,7 @@ from ..core.config import settings
 from ..core.dense_retrieval import DenseRetrieval
 from ..core.es.connector import ElasticsearchConnector
 from ..core.kgs.connector import KnowledgeGraphConnector
-from ..core.faiss import FaissClient
+from ..core.vector_index import create_vector_index
 from ..core.model_api import ModelAPIClient
 from ..core.mongo import MongoClient
 from ..core.bing import BingSearch
@@ -29,7 +29,7 @@ def get_search_client() -> DenseRetrieval:
     model_api = ModelAPIClient(
         settings.MODEL_API_URL
     )
-    faiss = FaissClient()
+    faiss = create_vector_index()
     return DenseRetrieval(get_storage_connector(), model_api, faiss)
 
 @lru_cache()
@@ -5,7 +5,7 @@ from fastapi import APIRouter, Depends, HTTPException
 from fastapi.param_functions import Body, Path, Query
 
 from ..models.httperror import HTTPError
-from ..models.query import QueryResult, Region
+from ..models.query import FusionMethod, QueryResult, Region
 from .dependencies import get_search_client, get_storage_connector, client_credentials, get_bing_search_client
 
 router = APIRouter(tags=["Query"])
@@ -16,7 +16,8 @@ logger = logging.getLogger(__name__)
     "/search",
     summary="Search the documentstore with given query and return top-k documents",
     description="Searches the given datastore with the search strategy specified by the given index \
-            and if necessery encodes the query with the specified encoder",
+            and if necessery encodes the query with the specified encoder. With hybrid, BM25 and dense retrieval \
+            are combined.",
     response_description="The top-K documents",
     response_model=List[QueryResult],
     responses={
@@ -33,6 +34,10 @@ async def search(
     feedback_documents: List[str] = Query(
         None, description="Relevant feedback documents from previous query."),
     region: Region = Query(None, description="Region of the query when using the bing_search datastore."),
+    hybrid: bool = Query(False, description="Combine BM25 and the dense retrieval of the given index."),
+    fusion: FusionMethod = Query(FusionMethod.rrf, description="How the scores are combined in hybrid search."),
+    dense_weight: float = Query(
+        0.5, ge=0, le=1, description="Weight of dense retrieval in hybrid search, BM25 has weight 1 - dense_weight."),
     conn=Depends(get_storage_connector),
     dense_retrieval=Depends(get_search_client),
     credential_token=Depends(client_credentials),
@@ -50,6 +55,24 @@ async def search(
             raise HTTPException(status_code=404, detail=str(e))
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
+    elif hybrid:
+        if not index_name:
+            raise HTTPException(status_code=422, detail="Hybrid search requires an index_name.")
+        try:
+            return await dense_retrieval.hybrid_search(
+                datastore_name,
+                index_name,
+                query,
+                top_k,
+                credential_token,
+                fusion=fusion,
+                dense_weight=dense_weight,
+                feedback_documents=feedback_documents,
+            )
+        except ValueError as ex:
+            raise HTTPException(status_code=404, detail=str(ex))
+        except Exception as other_ex:
+            raise HTTPException(status_code=500, detail=str(other_ex))
     # do dense retrieval
     elif index_name:
         try:
@@ -69,6 +92,45 @@ async def search(
         return await conn.search(datastore_name, query, n_hits=top_k, feedback_documents=feedback_documents)
 
 
+@router.post(
+    "/search_batch",
+    summary="Search the documentstore with many queries and return top-k documents per query",
+    description="Searches the given datastore for each query with the dense retrieval of the given index. \
+            All queries are encoded and searched together, which is much faster than one request per query.",
+    response_description="The top-K documents of each query",
+    response_model=List[List[QueryResult]],
+    responses={
+        200: {"model": List[List[QueryResult]], "description": "The top-K documents of each query"},
+        404: {"model": HTTPError, "description": "The datastore or index does not exist"},
+        500: {"model": HTTPError, "description": "Model API error"},
+    },
+)
+async def search_batch(
+    datastore_name: str = Path(..., description="Name of the datastore."),
+    index_name: str = Body(..., description="Index name."),
+    queries: List[str] = Body(..., description="The query strings."),
+    top_k: int = Body(40, description="Number of documents to retrieve per query."),
+    dense_retrieval=Depends(get_search_client),
+    credential_token=Depends(client_credentials),
+):
+    logger.debug(
+        f"Searching datastore {datastore_name} on index {index_name} "
+        f"with {len(queries)} queries and top_k {top_k}."
+    )
+    try:
+        return await dense_retrieval.search_batch(
+            datastore_name,
+            index_name,
+            queries,
+            top_k,
+            credential_token
+        )
+    except ValueError as ex:
+        raise HTTPException(status_code=404, detail=str(ex))
+    except Exception as other_ex:
+        raise HTTPException(status_code=500, detail=str(other_ex))
+
+
 @router.post(
     "/search_by_vector",
     summary="Search a datastore with the given query vector and return top-k documents",
@@ -1,5 +1,6 @@
 import os
 from typing import Tuple, Iterable, List
+from aiohttp import web
 from fastapi.testclient import TestClient
 
 import pytest
@@ -343,3 +344,29 @@ def client(es_container, mock_search_client, mongo_client, token) -> TestClient:
     app.dependency_overrides[get_mongo_client] = lambda: mongo_client
     client = TestClient(app)
     return client
+
+
+@pytest.fixture(scope="function")
+def run_with_server():
+    """Runs an async test against a local web server, e.g. a fake FAISS container or Model API.
+
+    The returned function serves the aiohttp routes on a free local port,
+    awaits test with the base url of the server and returns its result.
+    """
+    def run(routes: List[web.RouteDef], test):
+        async def run_test():
+            app = web.Application()
+            app.add_routes(routes)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            try:
+                return await test(f"http://127.0.0.1:{port}")
+            finally:
+                await runner.cleanup()
+
+        return asyncio.run(run_test())
+
+    return run
@@ -0,0 +1,105 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+from aiohttp import web
+from app.core.faiss import FaissClient
+
+
+class FakeFaissServer:
+    """Handles the FAISS web service endpoints and records the received requests."""
+
+    def __init__(self, fail_times: int = 0, fail_status: int = 503):
+        self.fail_times = fail_times
+        self.fail_status = fail_status
+        self.requests = []
+        self.remotes = set()
+
+    async def search(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        self.requests.append(data)
+        self.remotes.add(request.transport.get_extra_info("peername"))
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            return web.Response(status=self.fail_status, text="unavailable")
+        return web.json_response([{str(i): float(sum(v))} for i, v in enumerate(data["vectors"])])
+
+    def routes(self):
+        return [web.post("/search", self.search)]
+
+
+def search_with_server(run_with_server, server: FakeFaissServer, client: FaissClient, test):
+    async def run(url):
+        try:
+            with patch.object(FaissClient, "build_faiss_url", return_value=url):
+                return await test()
+        finally:
+            await client.close()
+
+    return run_with_server(server.routes(), run)
+
+
+def test_search_many_sends_one_request(run_with_server):
+    server = FakeFaissServer()
+    client = FaissClient(max_retries=0)
+
+    async def test():
+        return await client.search_many("datastore", "index", [[1, 2], [3, 4], [5, 6]], top_k=5)
+
+    queried = search_with_server(run_with_server, server, client, test)
+    assert queried == [{"0": 3.0}, {"1": 7.0}, {"2": 11.0}]
+    assert server.requests == [{"k": 5, "vectors": [[1, 2], [3, 4], [5, 6]]}]
+
+
+def test_concurrent_searches_reuse_connections(run_with_server):
+    server = FakeFaissServer()
+    client = FaissClient(max_connections=2)
+
+    async def test():
+        return await asyncio.gather(*[client.search("datastore", "index", [i]) for i in range(20)])
+
+    queried = search_with_server(run_with_server, server, client, test)
+    assert queried == [{"0": float(i)} for i in range(20)]
+    assert len(server.remotes) <= 2
+
+
+def test_unavailable_server_is_retried(run_with_server):
+    server = FakeFaissServer(fail_times=2)
+    client = FaissClient(max_retries=2)
+    client.retry_backoff = 0
+
+    async def test():
+        return await client.search("datastore", "index", [1])
+
+    assert search_with_server(run_with_server, server, client, test) == {"0": 1.0}
+    assert len(server.requests) == 3
+
+
+def test_circuit_breaker_fails_fast(run_with_server):
+    server = FakeFaissServer(fail_times=100, fail_status=502)
+    client = FaissClient(max_retries=0, failure_threshold=2, reset_timeout=60)
+
+    async def test():
+        for _ in range(2):
+            with pytest.raises(EnvironmentError, match="502"):
+                await client.search("datastore", "index", [1])
+        with pytest.raises(EnvironmentError, match="unavailable"):
+            await client.search("datastore", "index", [1])
+        # other indices are not affected
+        with pytest.raises(EnvironmentError, match="502"):
+            await client.search("datastore", "other_index", [1])
+
+    search_with_server(run_with_server, server, client, test)
+    assert len(server.requests) == 3
+
+
+def test_client_errors_are_not_retried(run_with_server):
+    server = FakeFaissServer(fail_times=1, fail_status=400)
+    client = FaissClient(max_retries=2)
+
+    async def test():
+        with pytest.raises(EnvironmentError, match="400"):
+            await client.search("datastore", "index", [1])
+
+    search_with_server(run_with_server, server, client, test)
+    assert len(server.requests) == 1
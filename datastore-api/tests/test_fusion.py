@@ -0,0 +1,28 @@
+import pytest
+from app.core.fusion import RRF_K, fuse
+from app.models.query import FusionMethod
+
+SPARSE = {"a": 12.0, "b": 9.0, "c": 3.0}
+DENSE = {"c": 0.9, "d": 0.8, "a": 0.1}
+
+
+def test_reciprocal_rank_fusion():
+    fused = dict(fuse([SPARSE, DENSE], [1, 1], FusionMethod.rrf, top_k=10))
+    assert fused["a"] == pytest.approx(1 / (RRF_K + 1) + 1 / (RRF_K + 3))
+    assert fused["c"] == pytest.approx(1 / (RRF_K + 3) + 1 / (RRF_K + 1))
+    assert fused["d"] == pytest.approx(1 / (RRF_K + 2))
+    # documents found by both retrievals are ranked first
+    assert set(list(fused)[:2]) == {"a", "c"}
+
+
+def test_linear_fusion_normalizes_scores():
+    fused = fuse([SPARSE, DENSE], [0.25, 0.75], FusionMethod.linear, top_k=2)
+    assert [doc_id for doc_id, _ in fused] == ["c", "d"]
+    assert fused[0][1] == pytest.approx(0.75)
+    assert fused[1][1] == pytest.approx(0.75 * 0.875)
+
+
+def test_fusion_with_empty_ranking():
+    fused = fuse([SPARSE, {}], [0.5, 0.5], FusionMethod.linear, top_k=10)
+    assert [doc_id for doc_id, _ in fused] == ["a", "b", "c"]
+    assert fused[0][1] == pytest.approx(0.5)
@@ -1,7 +1,9 @@
-from app.core.config import settings
+from unittest.mock import patch
+
 from app.models.index import IndexRequest
-from requests_mock import Mocker
 from app.core.faiss import FaissClient
+from app.core.model_api import ModelAPIClient
+from tests.utils import async_mock_callable
 
 
 class TestIndices:
@@ -21,26 +23,19 @@ class TestIndices:
         response = client.get(f"/datastores/{datastore_name}/indices/not_found")
         assert response.status_code == 404
 
-    def test_get_index_status(
-        self, requests_mock: Mocker, client, datastore_name, dpr_index
-    ):
-        requests_mock.real_http = True
-        requests_mock.get(
-            f"{settings.MODEL_API_URL}/{dpr_index.query_encoder_model}/health/heartbeat",
-            json={"is_alive": True},
-        )
-        requests_mock.get(
-            f"{FaissClient.build_faiss_url(datastore_name, dpr_index.name)}/index_list",
-            json={
-                "device": "cpu",
-                "index list": ["samples"],
-                "index loaded": "samples",
-            },
-        )
+    def test_get_index_status(self, client, datastore_name, dpr_index):
+        faiss_return = {
+            "device": "cpu",
+            "index list": ["samples"],
+            "index loaded": "samples",
+        }
 
-        response = client.get(
-            f"/datastores/{datastore_name}/indices/{dpr_index.name}/status"
-        )
+        with patch.object(FaissClient, "status", new_callable=async_mock_callable(faiss_return)), patch.object(
+            ModelAPIClient, "is_alive", new_callable=async_mock_callable(True)
+        ):
+            response = client.get(
+                f"/datastores/{datastore_name}/indices/{dpr_index.name}/status"
+            )
         assert response.status_code == 200
         assert response.json() == {"is_available": True}
 
@@ -80,26 +75,20 @@ class TestIndices:
 
     def test_get_document_embedding(
         self,
-        requests_mock: Mocker,
         client,
         datastore_name,
         dpr_index,
         test_document,
         test_document_embedding,
     ):
-        requests_mock.real_http = True
-        requests_mock.get(
-            f"{FaissClient.build_faiss_url(datastore_name, dpr_index.name)}/reconstruct",
-            json={
-                "vector": test_document_embedding
-            },  # use an impossible score to test that this return value is used
-        )
+        faiss_return = {"vector": test_document_embedding}
 
-        response = client.get(
-            "/datastores/{0}/indices/{1}/embeddings/{2}".format(
-                datastore_name, dpr_index.name, test_document["id"]
+        with patch.object(FaissClient, "reconstruct", new_callable=async_mock_callable(faiss_return)):
+            response = client.get(
+                "/datastores/{0}/indices/{1}/embeddings/{2}".format(
+                    datastore_name, dpr_index.name, test_document["id"]
+                )
             )
-        )
         assert response.status_code == 200
         assert response.json()["id"] == test_document["id"]
         assert response.json()["embedding"] == test_document_embedding
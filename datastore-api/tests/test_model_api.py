@@ -0,0 +1,119 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+from aiohttp import web
+from app.core.model_api import ModelAPIClient
+from app.models.index import Index
+
+
+class FakeModelAPI:
+    """Handles the prediction, task result and heartbeat endpoints of the Model API."""
+
+    def __init__(self, finish_after: int = 0):
+        # number of task result requests before the task is finished, 0 finishes the prediction inline
+        self.finish_after = finish_after
+        self.predictions = []
+        self.polls = 0
+
+    async def predict(self, request: web.Request) -> web.Response:
+        self.predictions.append((request.match_info["model"], dict(request.query), await request.json()))
+        if self.finish_after == 0:
+            return web.json_response({"task_id": "1", "status": "Finished", "result": {"model_outputs": {}}})
+        return web.json_response({"task_id": "1", "status": "Processing"}, status=202)
+
+    async def task_result(self, request: web.Request) -> web.Response:
+        self.polls += 1
+        if self.polls < self.finish_after:
+            return web.json_response({"task_id": "1", "status": "Processing"}, status=202)
+        return web.json_response({"task_id": "1", "status": "Finished", "result": {"model_outputs": {"polled": 1}}})
+
+    async def heartbeat(self, request: web.Request) -> web.Response:
+        return web.json_response({"is_alive": request.headers.get("Authorization") == "Bearer token"})
+
+    def routes(self):
+        return [
+            web.post("/main/{model}/embedding", self.predict),
+            web.get("/main/task_result/{task_id}", self.task_result),
+            web.get("/{model}/health/heartbeat", self.heartbeat),
+        ]
+
+
+def predict_with_server(run_with_server, server: FakeModelAPI, test):
+    async def run(url):
+        client = ModelAPIClient(url)
+        try:
+            with patch("app.core.model_api.client_credentials", return_value="token"):
+                return await test(client)
+        finally:
+            await client.close()
+
+    return run_with_server(server.routes(), run)
+
+
+def test_result_is_returned_with_the_response(run_with_server):
+    server = FakeModelAPI()
+
+    async def test(client):
+        return await client.predict("bert", "embedding", {"input": ["query"]})
+
+    assert predict_with_server(run_with_server, server, test) == {"model_outputs": {}}
+    assert server.predictions[0][0] == "bert"
+    assert server.predictions[0][1]["wait"] == "true"
+    assert server.polls == 0
+
+
+def test_unfinished_prediction_is_polled_without_blocking(run_with_server):
+    server = FakeModelAPI(finish_after=3)
+
+    async def test(client):
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.001)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        result = await client.predict("bert", "embedding", {"input": ["query"]})
+        ticker.cancel()
+        return result, ticks
+
+    result, ticks = predict_with_server(run_with_server, server, test)
+    assert result == {"model_outputs": {"polled": 1}}
+    assert server.polls == 3
+    # other coroutines kept running while the client waited for the result
+    assert ticks > 0
+
+
+def test_polling_times_out(run_with_server):
+    server = FakeModelAPI(finish_after=1000)
+
+    async def test(client):
+        client.max_wait = 0.05
+        with pytest.raises(TimeoutError):
+            await client.predict("bert", "embedding", {"input": ["query"]})
+
+    predict_with_server(run_with_server, server, test)
+
+
+def test_unknown_prediction_method():
+    async def test():
+        with pytest.raises(ValueError):
+            await ModelAPIClient("http://localhost").predict("bert", "unknown", {})
+
+    asyncio.run(test())
+
+
+def test_heartbeat(run_with_server):
+    server = FakeModelAPI()
+    index = Index(name="dpr", datastore_name="wiki", query_encoder_model="bert")
+
+    async def test(client):
+        alive = await client.is_alive(index, "token")
+        not_alive = await client.is_alive(index, "other_token")
+        unknown = await client.is_alive(Index(name="bm25", datastore_name="wiki"), "token")
+        return alive, not_alive, unknown
+
+    assert predict_with_server(run_with_server, server, test) == (True, False, False)
@@ -0,0 +1,102 @@
+import asyncio
+import os
+
+import numpy as np
+import pytest
+
+faiss = pytest.importorskip("faiss")
+
+from app.core.vector_index import LocalVectorIndex  # noqa: E402
+
+DIMENSION = 8
+NUM_DOCS = 200
+
+
+def build_index(path, factory: str, vectors: np.ndarray, ids, metric=faiss.METRIC_INNER_PRODUCT):
+    os.makedirs(path, exist_ok=True)
+    index = faiss.index_factory(DIMENSION, factory, metric)
+    index.train(vectors)
+    index.add(vectors)
+    faiss.write_index(index, os.path.join(path, "dense.index"))
+    with open(os.path.join(path, "dense.txt"), "w") as f:
+        f.write("\n".join(ids) + "\n")
+
+
+@pytest.fixture
+def vectors():
+    vectors = np.random.RandomState(0).randn(NUM_DOCS, DIMENSION).astype(np.float32)
+    # normalized, so that each document is its own nearest neighbor
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def ids():
+    return [f"doc{i}" for i in range(NUM_DOCS)]
+
+
+@pytest.mark.parametrize("factory", ["Flat", "IVF4,Flat", "HNSW16"])
+def test_search_reconstruct_and_explain(tmp_path, vectors, ids, factory):
+    build_index(tmp_path / "wiki" / "dpr", factory, vectors, ids)
+    index = LocalVectorIndex(path=str(tmp_path), nprobe=4, ef_search=64)
+
+    async def run():
+        queried = await index.search_many("wiki", "dpr", vectors[:3].tolist(), top_k=5)
+        reconstructed = await index.reconstruct("wiki", "dpr", "doc7")
+        explained = await index.explain("wiki", "dpr", vectors[0].tolist(), list(queried[0])[1])
+        status = await index.status("wiki", "dpr")
+        return queried, reconstructed, explained, status
+
+    queried, reconstructed, explained, status = asyncio.run(run())
+    expected = np.argsort(-vectors[:3] @ vectors.T, axis=1)[:, :5]
+    for hits, expected_positions in zip(queried, expected):
+        assert list(hits.keys()) == [ids[position] for position in expected_positions]
+    np.testing.assert_allclose(reconstructed["vector"], vectors[7], rtol=1e-5)
+    assert explained["score"] == pytest.approx(list(queried[0].values())[1], rel=1e-5)
+    assert status["size"] == NUM_DOCS
+
+
+def test_l2_scores_match_search(tmp_path, vectors, ids):
+    build_index(tmp_path / "wiki" / "l2", "Flat", vectors, ids, metric=faiss.METRIC_L2)
+    index = LocalVectorIndex(path=str(tmp_path))
+
+    async def run():
+        hits = await index.search("wiki", "l2", vectors[1].tolist(), top_k=2)
+        return hits, await index.explain("wiki", "l2", vectors[1].tolist(), list(hits)[1])
+
+    hits, explained = asyncio.run(run())
+    assert list(hits)[0] == "doc1"
+    assert explained["score"] == pytest.approx(list(hits.values())[1], rel=1e-5)
+
+
+def test_unknown_document_and_index(tmp_path, vectors, ids):
+    build_index(tmp_path / "wiki" / "dpr", "Flat", vectors, ids)
+    index = LocalVectorIndex(path=str(tmp_path))
+
+    async def run():
+        assert await index.status("wiki", "unknown") is None
+        with pytest.raises(EnvironmentError):
+            await index.search("wiki", "unknown", vectors[0].tolist())
+        with pytest.raises(ValueError):
+            await index.reconstruct("wiki", "dpr", "unknown_doc")
+
+    asyncio.run(run())
+
+
+def test_updated_index_is_swapped_in(tmp_path, vectors, ids):
+    path = tmp_path / "wiki" / "dpr"
+    build_index(path, "Flat", vectors, ids)
+    index = LocalVectorIndex(path=str(tmp_path), reload_interval=0)
+
+    async def run():
+        before = await index.search("wiki", "dpr", vectors[0].tolist(), top_k=1)
+        build_index(path, "Flat", vectors[:10], [f"new{i}" for i in range(10)])
+        os.utime(path / "dense.index", (0, 0))
+        # the current index answers while the new one is loaded
+        during = await index.search("wiki", "dpr", vectors[0].tolist(), top_k=1)
+        await asyncio.gather(*index._loading.values())
+        after = await index.search("wiki", "dpr", vectors[0].tolist(), top_k=1)
+        return before, during, after
+
+    before, during, after = asyncio.run(run())
+    assert list(before) == list(during) == ["doc0"]
+    assert list(after) == ["new0"]
@@ -0,0 +1,17 @@
+from fastapi import APIRouter
+from starlette.responses import PlainTextResponse
+
+from tasks.config.model_config import load_process_statistics
+from tasks.metrics import render_prometheus
+
+router = APIRouter()
+
+
+@router.get("/metrics", name="metrics")
+def get_metrics() -> PlainTextResponse:
+    """
+    Latency, batch size and padding histograms of all workers in the Prometheus text format
+    """
+    return PlainTextResponse(
+        render_prometheus(load_process_statistics("metrics")), media_type="text/plain; version=0.0.4"
+    )
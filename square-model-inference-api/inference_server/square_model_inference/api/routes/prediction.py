@@ -1,13 +1,20 @@
 from celery.result import AsyncResult
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
+import asyncio
+import msgpack
 import os
+import time
+from typing import Union
 
 from square_model_inference.models.request import PredictionRequest, Task
-from square_model_inference.models.prediction import AsyncTaskResult
+from square_model_inference.models.prediction import AsyncTaskResult, PredictionResponse, TaskResult, TaskStatus
 from square_model_inference.models.statistics import ModelStatistics, UpdateModel
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response
 
-from tasks.config.model_config import ModelConfig
+from tasks.config.model_config import ModelConfig, load_process_statistics
+from tasks.inference.adapter_cache import AdapterCache
+from tasks.inference.embedding_cache import EmbeddingCache
+from tasks.models.prediction import binary_to_base64
 from tasks.tasks import prediction_task
 
 import logging
@@ -16,6 +23,22 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 QUEUE = os.getenv("QUEUE", os.getenv("MODEL_NAME", None))
+MSGPACK_MEDIA_TYPES = ["application/x-msgpack", "application/msgpack"]
+# Default and maximum time in seconds that requests with `wait=true` wait for the result before falling back to polling
+WAIT_TIMEOUT = float(os.getenv("WAIT_TIMEOUT", 30))
+MAX_POLL_INTERVAL = 0.1
+PREDICTION_RESPONSES = {
+    200: {
+        "description": "The queued task, or with `wait=true` the finished task. "
+                       "The result is returned as msgpack for clients that accept it.",
+        "content": {MSGPACK_MEDIA_TYPES[0]: {}},
+    },
+    202: {"model": TaskStatus, "description": "The task did not finish within the timeout of `wait=true`"},
+}
+TASK_RESULT_RESPONSES = {
+    200: {"description": "The finished task", "content": {MSGPACK_MEDIA_TYPES[0]: {}}},
+    202: {"model": TaskStatus, "description": "The task is still queued or running"},
+}
 
 
 def check_valid_request(request):
@@ -24,15 +47,69 @@ def check_valid_request(request):
     return True, None
 
 
-@router.post("/{identifier}/sequence-classification", response_model=AsyncTaskResult,
-             name="sequence classification")
-@router.post("/{hf_username}/{identifier}/sequence-classification", response_model=AsyncTaskResult,
-             name="sequence classification")
+def accepts_msgpack(request: Request) -> bool:
+    accept = request.headers.get("accept", "")
+    return any(media_type in accept for media_type in MSGPACK_MEDIA_TYPES)
+
+
+async def wait_for_task(task: AsyncResult, timeout: float) -> bool:
+    """
+    Wait until the task is finished without blocking the event loop.
+    The result backend is polled with an increasing interval, starting at a few milliseconds
+    so that short predictions are returned almost immediately. The requests to the result backend
+    are blocking and therefore run in a thread.
+    :return: whether the task finished before the timeout
+    """
+    deadline = time.monotonic() + timeout
+    interval = 0.005
+    while not await asyncio.to_thread(task.ready):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(2 * interval, MAX_POLL_INTERVAL)
+    return True
+
+
+async def task_response(task: AsyncResult, message: str, request: Request, wait: bool, timeout: float):
+    """
+    Response for a queued prediction. With `wait` the result is returned inline once the task finished.
+    If the task does not finish within the timeout, the task id is returned with status code 202
+    and the result can be requested from /task_result/{task_id}.
+    """
+    if not wait:
+        return AsyncTaskResult(message=message, task_id=task.id)
+    if not await wait_for_task(task, min(timeout, WAIT_TIMEOUT)):
+        return JSONResponse(status_code=202, content={'task_id': str(task.id), 'status': 'Processing'})
+    return await finished_task_response(task, request)
+
+
+async def finished_task_response(task: AsyncResult, request: Request):
+    """
+    Returns the result of the finished task. Clients that send `Accept: application/x-msgpack` receive the result
+    as msgpack with binary model outputs, all others receive JSON with base64-encoded or plaintext model outputs.
+    """
+    result = await asyncio.to_thread(task.get)
+    content = {'task_id': str(task.id), 'status': 'Finished', 'result': result}
+    if accepts_msgpack(request):
+        return Response(content=msgpack.packb(content, use_bin_type=True), media_type=MSGPACK_MEDIA_TYPES[0])
+    if isinstance(result, dict) and result.get("model_output_is_encoded") and "model_outputs" in result:
+        result["model_outputs"] = binary_to_base64(result["model_outputs"])
+    return JSONResponse(content=content)
+
+
+@router.post("/{identifier}/sequence-classification", response_model=PredictionResponse,
+             responses=PREDICTION_RESPONSES, name="sequence classification")
+@router.post("/{hf_username}/{identifier}/sequence-classification", response_model=PredictionResponse,
+             responses=PREDICTION_RESPONSES, name="sequence classification")
 async def sequence_classification(
         identifier: str,
         prediction_request: PredictionRequest,
-        hf_username: str = None
-) -> AsyncTaskResult:
+        request: Request,
+        hf_username: str = None,
+        wait: bool = False,
+        timeout: float = WAIT_TIMEOUT,
+) -> Union[AsyncTaskResult, Response]:
     if hf_username:
         identifier = f"{hf_username}/{identifier}"
     valid, msg = check_valid_request(prediction_request)
@@ -47,18 +124,21 @@ async def sequence_classification(
         queue=identifier.replace("/", "-")
     )
 
-    return AsyncTaskResult(message="Queued sequence classification", task_id=res.id)
+    return await task_response(res, "Queued sequence classification", request, wait, timeout)
 
 
-@router.post("/{identifier}/token-classification", response_model=AsyncTaskResult,
-             name="token classification")
-@router.post("/{hf_username}/{identifier}/token-classification", response_model=AsyncTaskResult,
-             name="token classification")
+@router.post("/{identifier}/token-classification", response_model=PredictionResponse,
+             responses=PREDICTION_RESPONSES, name="token classification")
+@router.post("/{hf_username}/{identifier}/token-classification", response_model=PredictionResponse,
+             responses=PREDICTION_RESPONSES, name="token classification")
 async def token_classification(
         identifier: str,
         prediction_request: PredictionRequest,
-        hf_username: str = None
-) -> AsyncTaskResult:
+        request: Request,
+        hf_username: str = None,
+        wait: bool = False,
+        timeout: float = WAIT_TIMEOUT,
+) -> Union[AsyncTaskResult, Response]:
     if hf_username:
         identifier = f"{hf_username}/{identifier}"
     valid, msg = check_valid_request(prediction_request)
@@ -73,16 +153,21 @@ async def token_classification(
         ),
         queue=identifier.replace("/", "-")
     )
-    return AsyncTaskResult(message="Queued token classification", task_id=res.id)
+    return await task_response(res, "Queued token classification", request, wait, timeout)
 
 
-@router.post("/{identifier}/embedding", response_model=AsyncTaskResult, name="embedding")
-@router.post("/{hf_username}/{identifier}/embedding", response_model=AsyncTaskResult, name="embedding")
+@router.post("/{identifier}/embedding", response_model=PredictionResponse,
+             responses=PREDICTION_RESPONSES, name="embedding")
+@router.post("/{hf_username}/{identifier}/embedding", response_model=PredictionResponse,
+             responses=PREDICTION_RESPONSES, name="embedding")
 async def embedding(
         identifier: str,
         prediction_request: PredictionRequest,
-        hf_username: str = None
-) -> AsyncTaskResult:
+        request: Request,
+        hf_username: str = None,
+        wait: bool = False,
+        timeout: float = WAIT_TIMEOUT,
+) -> Union[AsyncTaskResult, Response]:
     if hf_username:
         identifier = f"{hf_username}/{identifier}"
     valid, msg = check_valid_request(prediction_request)
@@ -97,16 +182,21 @@ async def embedding(
         ),
         queue=identifier.replace("/", "-")
     )
-    return AsyncTaskResult(message="Queued embedding", task_id=res.id)
+    return await task_response(res, "Queued embedding", request, wait, timeout)
 
 
-@router.post("/{identifier}/question-answering", response_model=AsyncTaskResult, name="question answering")
-@router.post("/{hf_username}/{identifier}/question-answering", response_model=AsyncTaskResult, name="question answering")
+@router.post("/{identifier}/question-answering", response_model=PredictionResponse,
+             responses=PREDICTION_RESPONSES, name="question answering")
+@router.post("/{hf_username}/{identifier}/question-answering", response_model=PredictionResponse,
+             responses=PREDICTION_RESPONSES, name="question answering")
 async def question_answering(
         identifier: str,
         prediction_request: PredictionRequest,
-        hf_username: str = None
-) -> AsyncTaskResult:
+        request: Request,
+        hf_username: str = None,
+        wait: bool = False,
+        timeout: float = WAIT_TIMEOUT,
+) -> Union[AsyncTaskResult, Response]:
     if hf_username:
         identifier = f"{hf_username}/{identifier}"
     valid, msg = check_valid_request(prediction_request)
@@ -121,16 +211,21 @@ async def question_answering(
         ),
         queue=identifier.replace("/", "-")
     )
-    return AsyncTaskResult(message="Queued question answering", task_id=res.id)
+    return await task_response(res, "Queued question answering", request, wait, timeout)
 
 
-@router.post("/{identifier}/generation", response_model=AsyncTaskResult, name="generation")
-@router.post("/{hf_username}/{identifier}/generation", response_model=AsyncTaskResult, name="generation")
+@router.post("/{identifier}/generation", response_model=PredictionResponse,
+             responses=PREDICTION_RESPONSES, name="generation")
+@router.post("/{hf_username}/{identifier}/generation", response_model=PredictionResponse,
+             responses=PREDICTION_RESPONSES, name="generation")
 async def generation(
         identifier: str,
         prediction_request: PredictionRequest,
-        hf_username: str = None
-) -> AsyncTaskResult:
+        request: Request,
+        hf_username: str = None,
+        wait: bool = False,
+        timeout: float = WAIT_TIMEOUT,
+) -> Union[AsyncTaskResult, Response]:
     if hf_username:
         identifier = f"{hf_username}/{identifier}"
     valid, msg = check_valid_request(prediction_request)
@@ -145,16 +240,15 @@ async def generation(
         ),
         queue=identifier.replace("/", "-")
     )
-    return AsyncTaskResult(message="Queued token classification", task_id=res.id)
+    return await task_response(res, "Queued generation", request, wait, timeout)
 
 
-@router.get("/task_result/{task_id}")
-async def get_task_results(task_id: str):
+@router.get("/task_result/{task_id}", response_model=TaskResult, responses=TASK_RESULT_RESPONSES)
+async def get_task_results(task_id: str, request: Request):
     task = AsyncResult(task_id)
-    if not task.ready():
+    if not await asyncio.to_thread(task.ready):
         return JSONResponse(status_code=202, content={'task_id': str(task_id), 'status': 'Processing'})
-    result = task.get()
-    return {'task_id': str(task_id), 'status': 'Finished', 'result': result}
+    return await finished_task_response(task, request)
 
 
 @router.get("/{identifier}/stats", response_model=ModelStatistics, name="statistics")
@@ -206,4 +300,11 @@ def get_statistics(identifier):
     model_config = ModelConfig.load_from_file(identifier)
     model_config.update()
     logger.info(model_config)
-    return model_config.to_statistics()
+    statistics = model_config.to_statistics()
+    # each worker process stores its own statistics
+    statistics.adapter_cache = AdapterCache.merge_statistics(load_process_statistics("adapter_cache", identifier))
+    statistics.embedding_cache = EmbeddingCache.merge_statistics(load_process_statistics("embedding_cache", identifier))
+    # all processes check the same model, so the results of any process are returned
+    precision_check_results = load_process_statistics("precision_check", identifier)
+    statistics.precision_check_results = precision_check_results[0] if precision_check_results else None
+    return statistics
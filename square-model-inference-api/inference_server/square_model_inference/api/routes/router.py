@@ -1,7 +1,8 @@
 from fastapi import APIRouter
 
-from square_model_inference.api.routes import heartbeat, prediction
+from square_model_inference.api.routes import heartbeat, metrics, prediction
 
 api_router = APIRouter()
 api_router.include_router(heartbeat.router, tags=["health"], prefix="/health")
 api_router.include_router(prediction.router, tags=["prediction"])
+api_router.include_router(metrics.router, tags=["metrics"])
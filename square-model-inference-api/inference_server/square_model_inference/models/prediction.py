@@ -1,5 +1,20 @@
+from typing import Any, Union
+
 from pydantic import BaseModel
 
 class AsyncTaskResult(BaseModel):
     message: str
     task_id: str
+
+
+class TaskStatus(BaseModel):
+    task_id: str
+    status: str  # Processing while the task is queued or running
+
+
+class TaskResult(TaskStatus):
+    result: Any  # the prediction output of the finished task
+
+
+# queued task, or with `wait=true` the finished task
+PredictionResponse = Union[AsyncTaskResult, TaskResult]
@@ -11,10 +11,31 @@ class ModelStatistics(BaseModel):
     model_class: str  # for transformers which model class this is e.g. base
     disable_gpu: bool
     return_plaintext_arrays: bool
+    binary_arrays: Optional[bool] = False  # whether the worker stores arrays as raw buffers instead of base64
     preloaded_adapters: bool
+    max_adapters: Optional[int] = 0  # max. number of adapters kept in memory, 0 for no limit
+    max_adapter_memory: Optional[int] = 0  # max. memory in MB of all loaded adapters, 0 for no limit
+    adapter_cache: Optional[dict] = None  # hit/ miss and load time statistics of the adapters of all workers
+    embedding_cache: Optional[dict] = None  # hit/ miss statistics of the embedding caches of all workers
     transformers_cache: Optional[str] = ".cache"
     model_path: Optional[str] = ""
     decoder_path: Optional[str] = ""
+    decoder_with_past_path: Optional[str] = ""
+    onnx_intra_op_threads: Optional[int] = 0  # onnx runtime threads within an operator, 0 for the default
+    onnx_inter_op_threads: Optional[int] = 0  # onnx runtime threads across operators, 0 for the default
+    onnx_graph_optimization: Optional[str] = "all"  # onnx runtime graph optimization level
+    onnx_execution_mode: Optional[str] = "sequential"  # sequential or parallel execution of operators
+    onnx_memory_arena: Optional[bool] = True  # whether onnx runtime uses a memory arena on CPU
+    enable_batching: Optional[bool] = False  # whether concurrent requests are merged into one forward pass
+    batch_wait_time: Optional[float] = 0.01  # max. seconds to wait for requests to merge
+    mix_adapters: Optional[bool] = False  # whether requests for different adapters are merged as well
+    precision: Optional[str] = "fp32"  # numeric precision of the model on CPU: fp32, int8 or bf16
+    precision_check: Optional[bool] = True  # whether reduced precision is compared against fp32 at load time
+    precision_tolerance: Optional[float] = 0.05  # max. relative error before falling back to fp32
+    precision_check_results: Optional[dict] = None  # relative error and latencies of the precision check
+    embedding_cache_size: Optional[int] = 0  # max. memory in MB of cached embeddings, 0 disables the local cache
+    embedding_cache_ttl: Optional[int] = 0  # seconds until cached embeddings expire, 0 for no expiry
+    embedding_cache_redis: Optional[bool] = False  # whether the embedding caches of all workers share a redis
 
 
 class UpdateModel(BaseModel):
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import List, Dict, Tuple
 import random
 import torch
@@ -13,6 +14,22 @@ stop_words = stopwords.words('english')
 valid_words = set(words.words())
 
 
+@lru_cache(maxsize=8)
+def get_replacement_vocab(tokenizer) -> Tuple[Dict[str, int], np.ndarray]:
+    """
+    Returns the vocabulary of the tokenizer sorted by id and the ids of the tokens that cannot be used as
+    replacement (special tokens, stop words and sub-words). Computed once per tokenizer.
+    """
+    vocab = tokenizer.get_vocab()
+    vocab = {k: v for k, v in sorted(vocab.items(), key=lambda item: item[1])}
+    invalid_replacement_indices = []
+    for k, v in vocab.items():
+        k = k.replace("Ġ", "")
+        if k.isalnum() == False or k in stop_words or (k not in valid_words and k.isnumeric() == False):
+            invalid_replacement_indices.append(v)
+    return vocab, np.array(invalid_replacement_indices, dtype=np.int64)
+
+
 class Hotflip(Attacker):
     """
     Flips the tokens in the input text and returns the flipped text
@@ -188,13 +205,7 @@ class Hotflip(Attacker):
         processed_context = self.process_tokens(context_tokens, context_word_map)
 
         # get the invalid tokens
-        vocab = self.tokenizer.get_vocab()
-        vocab = {k: v for k, v in sorted(vocab.items(), key=lambda item: item[1])}
-        invalid_replacement_indices = []
-        for k, v in vocab.items():
-            k = k.replace("Ġ", "")
-            if k.isalnum() == False or k in stop_words or (k not in valid_words and k.isnumeric() == False):
-                invalid_replacement_indices.append(v)
+        vocab, invalid_replacement_indices = get_replacement_vocab(self.tokenizer)
 
         # get the replcement tokens for the chosen tokens
         if self.grads == None:
@@ -243,6 +254,7 @@ class Hotflip(Attacker):
         """
         already_generated = []
         tokens = [word[1] for word in tokens]
+        invalid_replacement_indices = set(invalid_replacement_indices.tolist())
         replacement_tokens = []
         # new added section start
         words = list(vocab.keys())
@@ -272,38 +284,28 @@ class Hotflip(Attacker):
             Returns:
                 replacement_tokens : replacement tokens of the topk tokens
         """
+        tokens = {i: token for i, token, _ in context_tokens}
+        token_ids_in_vocab = self.tokenizer.convert_tokens_to_ids([tokens[imp_tok] for imp_tok in imp_tokens])
+        # add the integer to get the exact token in the gradient matrix
+        grad_idx = [imp_tok + context_start for imp_tok in imp_tokens]
+        with torch.no_grad():
+            # the gradients of all important tokens with dimension (k, 768)
+            token_grads = self.grads[0][0][grad_idx].to(self.embeddings.weight.device)
+            # first order approximation of the change of the loss when replacing each important token
+            # with any word of the vocabulary (k, vocab size) in one matrix multiplication
+            grad_to_emb_matrix = token_grads @ self.embeddings.weight.T
+            grad_to_word_emb = (token_grads * self.embeddings.weight[token_ids_in_vocab]).sum(dim=-1, keepdim=True)
+            # subtract
+            sub = ((-1) * (grad_to_emb_matrix - grad_to_word_emb)).cpu().numpy()
+        # replace invalid indexes with -inf
+        sub[:, invalid_replacement_indices] = -np.inf
 
-        already_generated = []
         replacement_tokens = []
-
-        for idx in range(len(imp_tokens)):
-            i, token, v = context_tokens[idx]
-            imp_tok = imp_tokens[idx]
-            # add the integer to get the exact token in the gradient matrix
-            grad_idx = imp_tokens[idx] + context_start
-            # get the gradient
-            token_grad = self.grads[0][0][grad_idx]
-            token_id_in_vocab = self.tokenizer.convert_tokens_to_ids(token)
-            grad_to_emb_matrix = torch.einsum("in,kj->ik", (token_grad.unsqueeze(0), self.embeddings.weight))
-            # multiply the gradient of the token of domension (1, 768) and the word emebdding of the token of dimension (1 , 768)
-            grad_to_word_emb = torch.einsum("in,kj->ik", (
-            token_grad.unsqueeze(0), self.embeddings.weight[token_id_in_vocab, :].unsqueeze(0)))
-            # subtract
-            sub = (-1) * (grad_to_emb_matrix - grad_to_word_emb)
-            sub = sub.detach().numpy()
-            # replace invalid indexes with -inf
-            sub[:, invalid_replacement_indices] = -np.inf
-            best_index = sub.argmax(1)
-            best_index = best_index.data[0]
-
-            # when the best index is already in generated indexes we need to get the second best and so on
-            while best_index in already_generated:
-                # replace index with -inf to get the nex best
-                sub[:, best_index] = -np.inf
-                best_index = sub.argmax(1)
-                best_index = best_index.data[0]
+        for row in sub:
+            # the same replacement is not used twice
+            best_index = int(row.argmax())
             # include the new generated token index in the already generated list
-            already_generated.append(best_index)
+            sub[:, best_index] = -np.inf
             # append it in the replacement tokens
             replacement_token = self.tokenizer.convert_ids_to_tokens(best_index)
             replacement_tokens.append(replacement_token.replace("Ġ", ""))
@@ -1,5 +1,4 @@
 from typing import List, Dict, Tuple
-from copy import deepcopy
 import numpy as np
 import logging
 
@@ -48,30 +47,17 @@ class InputReduction(Attacker):
 
         smallest_indices = np.argsort(question_scores)[: self.top_k].tolist()
 
-        beam = self.top_k
-        reduced_instances_and_smallest: List[Tuple] = []
-        while len(question_tokens) != 1:
-            instance = deepcopy(question_tokens)
-
-            # find smallest
-            smallest = np.argmin(question_scores)
-            question_scores = np.delete(question_scores, smallest)
-            question_tokens = np.delete(question_tokens, smallest)
-
-            # remove smallest
-            inputs_before_smallest = instance[0:smallest]
-            inputs_after_smallest = instance[smallest + 1 :]
-            reduced_instance = np.append(inputs_before_smallest, inputs_after_smallest)
-
-            reduced_instances_and_smallest.append(
-                (" ".join(list(reduced_instance)), smallest)
-            )
-            # decrement top k counter
-            beam -= 1
-            if beam == 0:
-                break
-
-        reduced_questions = [entry[0] for entry in reduced_instances_and_smallest]
+        # Removing the word with the smallest score one after another is the same as removing the
+        # words in the order of their scores, so all reduced instances are built at once.
+        # A stable sort keeps the first of equal scores first, like np.argmin
+        removal_order = np.argsort(question_scores, kind="stable")
+        removal_step = np.empty(len(question_tokens), dtype=int)
+        removal_step[removal_order] = np.arange(len(question_tokens))
+        num_reductions = min(self.top_k, len(question_tokens) - 1)
+        reduced_questions = [
+            " ".join(question_tokens[removal_step > step].tolist())
+            for step in range(num_reductions)
+        ]
 
         prepared_inputs = self.prepare_data(
             question_text=[question_text] + reduced_questions,
@@ -1,5 +1,4 @@
 from typing import List, Dict, Tuple
-from copy import deepcopy
 import numpy as np
 import logging
 
@@ -41,23 +40,17 @@ class TopkTokens(Attacker):
         ) = self._get_tokens_and_attributions()
         topk_indices = np.argsort(context_scores)[::-1][: self.top_k].tolist()
 
-        reduced_instances_and_smallest: List = []
-        while len(context_tokens) != 1:
-            instance = deepcopy(context_tokens)
-
-            # remove smallest
-            smallest = np.argmin(context_scores)
-            context_scores = np.delete(context_scores, smallest)
-            context_tokens = np.delete(context_tokens, smallest)
-
-            # remove smallest
-            inputs_before_smallest = instance[0:smallest]
-            inputs_after_smallest = instance[smallest + 1 :]
-            reduced_instance = np.append(inputs_before_smallest, inputs_after_smallest)
-
-            reduced_instances_and_smallest.append(" ".join(list(reduced_instance)))
-
-        reduced_contexts = list(reversed(reduced_instances_and_smallest))[: self.top_k]
+        # Keep the j + 1 tokens with the highest scores in their original order. This is the same as
+        # removing the token with the smallest score one after another (a stable sort keeps the
+        # first of equal scores first, like np.argmin)
+        removal_order = np.argsort(context_scores, kind="stable")
+        removal_step = np.empty(len(context_tokens), dtype=int)
+        removal_step[removal_order] = np.arange(len(context_tokens))
+        num_contexts = min(self.top_k, len(context_tokens) - 1)
+        reduced_contexts = [
+            " ".join(context_tokens[removal_step >= len(context_tokens) - keep].tolist())
+            for keep in range(1, num_contexts + 1)
+        ]
         prepared_inputs = [
             [q, c]
             for q, c in zip(
@@ -0,0 +1,294 @@
+import json
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+from tasks.inference.model import Model
+from tasks.metrics import metrics
+from tasks.models.prediction import _decode_numpy, _encode_numpy
+from tasks.models.request import PredictionRequest, Task
+
+logger = logging.getLogger(__name__)
+
+# Outputs of each task (model outputs and other task outputs) that contain one value per token of each input
+SEQUENCE_OUTPUTS = {
+    Task.token_classification: ["logits", "word_ids", "labels"],
+    Task.question_answering: ["start_logits", "end_logits"],
+}
+
+
+def sequence_outputs(request: PredictionRequest, task: Task) -> List[str]:
+    """
+    Names of the outputs of the task that contain one value per token of each input
+    """
+    if task == Task.embedding and request.task_kwargs.get("embedding_mode", "mean") == "token":
+        return ["embeddings", "word_ids"]
+    return SEQUENCE_OUTPUTS.get(task, [])
+
+
+class _PendingRequest:
+    """
+    A request waiting in a batch group together with its result once the batch was processed
+    """
+
+    def __init__(self, request: PredictionRequest):
+        self.request = request
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.submitted_at = time.perf_counter()
+        # seconds spent in each stage of the merged prediction
+        self.timing = {}
+
+
+class _BatchGroup:
+    """
+    Requests for the same task with the same parameters that are merged into one prediction
+    """
+
+    def __init__(self):
+        self.pending: List[_PendingRequest] = []
+        self.num_inputs = 0
+        self.adapter_names = set()
+        self.closed = False
+        self.started_at = None
+
+    def add(self, pending: _PendingRequest):
+        self.pending.append(pending)
+        self.num_inputs += len(pending.request.input)
+        self.adapter_names.add(pending.request.adapter_name)
+
+    def size(self, request: PredictionRequest = None) -> int:
+        """
+        Number of inputs processed by the model for the group (optionally after adding the request).
+        Mixed adapter batches run every input through every adapter of the group.
+        """
+        num_inputs = self.num_inputs
+        adapter_names = self.adapter_names
+        if request is not None:
+            num_inputs += len(request.input)
+            adapter_names = adapter_names | {request.adapter_name}
+        return num_inputs * max(len(adapter_names), 1)
+
+
+class RequestBatcher:
+    """
+    Merges prediction requests that are processed concurrently by the worker (e.g. with `--pool threads`)
+    into a single call of Model.predict and splits the outputs back into the results of each request.
+
+    The first request of a group waits up to max_wait_time seconds for further requests with the same
+    task and parameters, or until max_batch_size inputs are collected. Afterwards, it runs the merged
+    prediction and hands the results to the other requests of the group.
+    All calls to the model are serialized, so the model never runs concurrently in multiple threads.
+
+    With mix_adapters, requests for different adapters are merged as well if the model supports it
+    (see Model.mixed_adapter_key) and predicted in a single forward pass with Model.predict_mixed.
+    """
+
+    def __init__(self, model: Model, max_batch_size: int, max_wait_time: float, mix_adapters: bool = False):
+        """
+        Args:
+             model: the model used for the predictions
+             max_batch_size: maximum number of inputs that are merged into one prediction
+             max_wait_time: maximum time in seconds to wait for further requests before predicting
+             mix_adapters: merge requests for different adapters into one prediction
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        self.mix_adapters = mix_adapters
+        self._groups: Dict[str, _BatchGroup] = {}
+        self._condition = threading.Condition()
+        self._model_lock = threading.Lock()
+
+    def submit(self, request: PredictionRequest, task: Task) -> dict:
+        """
+        Predict the request, possibly merged with other concurrently submitted requests
+
+        Args:
+             request: the prediction request
+             task: the task that the model should perform with the request
+        Returns:
+             the prediction result for the request as dictionary
+        """
+        if not self.model.can_batch(request, task):
+            with self._model_lock, metrics.predict_timer():
+                metrics.observe("inference_batch_requests", 1)
+                return self.model.predict(request, task).dict()
+
+        key = self._batch_key(request, task)
+        pending = _PendingRequest(request)
+        with self._condition:
+            group = self._groups.get(key)
+            if group is not None and group.size(request) > self.max_batch_size:
+                # the open group is full, so it is flushed and this request starts a new group
+                self._close(key, group)
+                group = None
+            is_leader = group is None
+            if is_leader:
+                group = _BatchGroup()
+                self._groups[key] = group
+            group.add(pending)
+            if group.size() >= self.max_batch_size:
+                self._close(key, group)
+
+        if is_leader:
+            self._wait_for_requests(key, group)
+            self._run(group, task)
+        pending.done.wait()
+        metrics.observe_stage("batch_wait", group.started_at - pending.submitted_at)
+        # the leader collected the stages of the merged prediction itself
+        if not is_leader:
+            metrics.add_timing(pending.timing)
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _close(self, key: str, group: _BatchGroup):
+        """
+        Stop adding requests to the group and wake up its leader. Must be called while holding the condition.
+        """
+        if self._groups.get(key) is group:
+            del self._groups[key]
+        group.closed = True
+        self._condition.notify_all()
+
+    def _wait_for_requests(self, key: str, group: _BatchGroup):
+        deadline = time.monotonic() + self.max_wait_time
+        with self._condition:
+            while not group.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            self._close(key, group)
+
+    def _run(self, group: _BatchGroup, task: Task):
+        """
+        Predict all requests of the group with one call to the model and distribute the results
+        """
+        requests = [pending.request for pending in group.pending]
+        group.started_at = time.perf_counter()
+        timing = {}
+        try:
+            adapter_names = list(dict.fromkeys(request.adapter_name for request in requests))
+            if len(adapter_names) > 1 and not self.model.can_mix_adapters(adapter_names):
+                # predict the requests of each adapter together instead
+                results = [None] * len(requests)
+                for adapter_name in adapter_names:
+                    positions = [i for i, request in enumerate(requests) if request.adapter_name == adapter_name]
+                    with metrics.collect() as adapter_timing:
+                        adapter_results = self._predict([requests[i] for i in positions], task)
+                    for i, result in zip(positions, adapter_results):
+                        results[i] = result
+                        group.pending[i].timing = adapter_timing
+            else:
+                with metrics.collect() as timing:
+                    results = self._predict(requests, task)
+            for pending, result in zip(group.pending, results):
+                pending.result = result
+        except Exception as e:
+            for pending in group.pending:
+                pending.error = e
+        finally:
+            for pending in group.pending:
+                pending.timing = pending.timing or timing
+                pending.done.set()
+
+    def _predict(self, requests: List[PredictionRequest], task: Task) -> List[dict]:
+        """
+        Predict the requests with one call to the model and split the output into the results of the requests
+        """
+        metrics.observe("inference_batch_requests", len(requests))
+        if len(requests) == 1:
+            with self._model_lock, metrics.predict_timer():
+                return [self.model.predict(requests[0], task).dict()]
+        merged_input = [x for request in requests for x in request.input]
+        merged_request = PredictionRequest(**{**requests[0].dict(), "input": merged_input})
+        adapter_names = [request.adapter_name for request in requests for _ in request.input]
+        logger.info(f"Merged {len(requests)} requests with {len(merged_input)} inputs for task {task}")
+        with self._model_lock:
+            if len(set(adapter_names)) > 1:
+                with metrics.labels(adapter="mixed"), metrics.predict_timer():
+                    output = self.model.predict_mixed(merged_request, adapter_names, task).dict()
+            else:
+                with metrics.predict_timer():
+                    output = self.model.predict(merged_request, task).dict()
+            sequence_keys = sequence_outputs(merged_request, task)
+            lengths = None
+            if sequence_keys:
+                with metrics.timer("tokenization"):
+                    lengths = self._sequence_lengths(merged_request)
+        with metrics.timer("encoding"):
+            return split_prediction(output, [len(request.input) for request in requests], lengths, sequence_keys)
+
+    def _sequence_lengths(self, request: PredictionRequest) -> Optional[List[int]]:
+        """
+        Number of tokens of each input. Used to remove the additional padding of the merged batch from
+        token-level outputs, so that each request gets the same output as if it was predicted on its own.
+        """
+        tokenizer = getattr(self.model, "tokenizer", None)
+        if tokenizer is None:
+            return None
+        preprocessing_kwargs = {k: v for k, v in request.preprocessing_kwargs.items() if k != "padding"}
+        preprocessing_kwargs["truncation"] = preprocessing_kwargs.get("truncation", True)
+        features = tokenizer(request.input, padding=False, **preprocessing_kwargs)
+        return [len(input_ids) for input_ids in features["input_ids"]]
+
+    def _batch_key(self, request: PredictionRequest, task: Task) -> str:
+        """
+        Requests can only be merged if everything except for the input
+        (and the adapter if mixed adapter batches are enabled) is identical
+        """
+        params = request.dict(exclude={"input"})
+        params["task"] = task
+        if self.mix_adapters:
+            mixed_adapter_key = self.model.mixed_adapter_key(request, task)
+            if mixed_adapter_key is not None:
+                params["adapter_name"] = mixed_adapter_key
+        return json.dumps(params, sort_keys=True, default=str)
+
+
+def split_prediction(
+        output: dict, sizes: List[int], lengths: Optional[List[int]] = None, sequence_keys: List[str] = ()
+) -> List[dict]:
+    """
+    Split the prediction result of merged requests into the results of the single requests
+
+    Args:
+         output: the prediction result (PredictionOutput.dict()) of the merged request
+         sizes: the number of inputs of each of the merged requests
+         lengths: the number of tokens of each input of the merged request
+         sequence_keys: the outputs with one value per token of each input (see sequence_outputs). If lengths
+            are given, their token dimension is truncated to the longest input of each request
+    Returns:
+         the prediction results for each request
+    """
+    num_inputs = sum(sizes)
+    model_outputs = _decode_numpy(output["model_outputs"], output["model_output_is_encoded"])
+    results = []
+    start = 0
+    for size in sizes:
+        end = start + size
+        max_length = max(lengths[start:end]) if lengths else None
+
+        result = {}
+        for k, value in output.items():
+            if k == "model_outputs":
+                continue
+            if isinstance(value, list) and len(value) == num_inputs:
+                value = value[start:end]
+                if k in sequence_keys and max_length is not None:
+                    value = [v[:max_length] for v in value]
+            result[k] = value
+        request_outputs = {}
+        for k, arr in model_outputs.items():
+            arr = arr[start:end]
+            if k in sequence_keys and max_length is not None:
+                arr = arr[:, :max_length]
+            request_outputs[k] = arr
+        result["model_outputs"] = _encode_numpy(request_outputs, return_plaintext=not output["model_output_is_encoded"])
+        results.append(result)
+        start = end
+    return results
@@ -0,0 +1,192 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AdapterCache:
+    """
+    Keeps track of the adapters that are loaded into the model and evicts the least recently used ones
+    once the cache exceeds its budget. Adapters are only loaded when they are requested for the first time
+    (or again after they were evicted).
+
+    The budget is a maximum number of adapters and/or a maximum memory of the adapter weights in bytes.
+    A budget of 0 means no limit. The adapter that was requested last is never evicted, even if it alone
+    exceeds the budget.
+    """
+
+    def __init__(
+        self,
+        load_adapter: Callable[[str], int],
+        unload_adapter: Callable[[str], None],
+        max_adapters: int = 0,
+        max_memory: int = 0,
+    ):
+        """
+        Args:
+             load_adapter: loads the adapter with the given name into the model and returns its size in bytes
+             unload_adapter: removes the adapter with the given name from the model
+             max_adapters: maximum number of loaded adapters, 0 for no limit
+             max_memory: maximum number of bytes used by all loaded adapters, 0 for no limit
+        """
+        self.load_adapter = load_adapter
+        self.unload_adapter = unload_adapter
+        self.max_adapters = max_adapters
+        self.max_memory = max_memory
+        # name -> size in bytes, ordered from least to most recently used
+        self._loaded: OrderedDict = OrderedDict()
+        self._stats: Dict[str, Dict] = {}
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+    def __contains__(self, adapter_name: str) -> bool:
+        return adapter_name in self._loaded
+
+    def __len__(self) -> int:
+        return len(self._loaded)
+
+    @property
+    def memory(self) -> int:
+        return sum(self._loaded.values())
+
+    def is_full(self) -> bool:
+        """
+        Whether adding another adapter would exceed the budget
+        """
+        return (0 < self.max_adapters <= len(self._loaded)) or (0 < self.max_memory <= self.memory)
+
+    def fits(self, adapter_names: List[str]) -> bool:
+        """
+        Whether all the given adapters can be loaded at the same time without exceeding the budget.
+        The size of adapters that were never loaded is unknown and not taken into account.
+        """
+        if 0 < self.max_adapters < len(adapter_names):
+            return False
+        size = sum(self._stats[name]["size"] for name in adapter_names if name in self._stats)
+        return not 0 < self.max_memory < size
+
+    def get(self, adapter_name: str) -> bool:
+        """
+        Make sure the adapter is loaded and mark it as most recently used.
+
+        Returns:
+            True if the adapter was already loaded, False if it had to be loaded
+        """
+        with self._lock:
+            stats = self._adapter_stats(adapter_name)
+            stats["last_used"] = time.time()
+            if adapter_name in self._loaded:
+                self._loaded.move_to_end(adapter_name)
+                stats["hits"] += 1
+                return True
+
+            stats["misses"] += 1
+            start = time.perf_counter()
+            size = self.load_adapter(adapter_name)
+            load_time = time.perf_counter() - start
+            logger.info(f"Loaded adapter {adapter_name} ({size / 2 ** 20:.1f} MB) in {load_time:.2f}s")
+            self.add(adapter_name, size, load_time)
+            return False
+
+    def add(self, adapter_name: str, size: int, load_time: float = 0.0):
+        """
+        Register an adapter that was loaded into the model, e.g. while pre-loading adapters at startup.
+        Least recently used adapters are evicted if the budget is exceeded afterwards.
+        """
+        with self._lock:
+            stats = self._adapter_stats(adapter_name)
+            stats["loads"] += 1
+            stats["load_time"] += load_time
+            stats["size"] = size
+            self._loaded[adapter_name] = size
+            self._loaded.move_to_end(adapter_name)
+            self._evict()
+
+    def _evict(self):
+        while len(self._loaded) > 1 and (
+            (0 < self.max_adapters < len(self._loaded)) or (0 < self.max_memory < self.memory)
+        ):
+            adapter_name, _ = self._loaded.popitem(last=False)
+            logger.info(f"Evicting least recently used adapter {adapter_name}")
+            self.unload_adapter(adapter_name)
+            self._stats[adapter_name]["evictions"] += 1
+            self.evictions += 1
+
+    def _adapter_stats(self, adapter_name: str) -> Dict:
+        if adapter_name not in self._stats:
+            self._stats[adapter_name] = {
+                "hits": 0,
+                "misses": 0,
+                "loads": 0,
+                "evictions": 0,
+                "load_time": 0.0,
+                "size": 0,
+                "last_used": None,
+            }
+        return self._stats[adapter_name]
+
+    def statistics(self) -> Dict:
+        """
+        Hit/ miss and load time statistics of the cache and of every adapter that was requested or loaded
+        """
+        with self._lock:
+            adapters = {name: dict(stats, loaded=name in self._loaded) for name, stats in self._stats.items()}
+            hits = sum(stats["hits"] for stats in adapters.values())
+            misses = sum(stats["misses"] for stats in adapters.values())
+            return {
+                "loaded": len(self._loaded),
+                "memory": self.memory,
+                "max_adapters": self.max_adapters,
+                "max_memory": self.max_memory,
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else None,
+                "evictions": self.evictions,
+                "load_time": sum(stats["load_time"] for stats in adapters.values()),
+                "adapters": adapters,
+            }
+
+
+    @staticmethod
+    def merge_statistics(statistics: List[Dict]) -> Optional[Dict]:
+        """
+        Merge the statistics of the caches of several worker processes. Counts, memory and load times are summed up,
+        the budget is the budget of each process.
+
+        Returns:
+            the merged statistics or None if no process stored statistics
+        """
+        if not statistics:
+            return None
+        adapters = {}
+        for process in statistics:
+            for name, stats in process["adapters"].items():
+                if name not in adapters:
+                    adapters[name] = dict(stats)
+                    continue
+                merged = adapters[name]
+                for key in ["hits", "misses", "loads", "evictions", "load_time"]:
+                    merged[key] += stats[key]
+                merged["size"] = max(merged["size"], stats["size"])
+                merged["last_used"] = max(
+                    (t for t in [merged["last_used"], stats["last_used"]] if t is not None), default=None
+                )
+                merged["loaded"] = merged["loaded"] or stats["loaded"]
+        hits = sum(process["hits"] for process in statistics)
+        misses = sum(process["misses"] for process in statistics)
+        return {
+            "processes": len(statistics),
+            "loaded": sum(process["loaded"] for process in statistics),
+            "memory": sum(process["memory"] for process in statistics),
+            "max_adapters": statistics[0]["max_adapters"],
+            "max_memory": statistics[0]["max_memory"],
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else None,
+            "evictions": sum(process["evictions"] for process in statistics),
+            "load_time": sum(process["load_time"] for process in statistics),
+            "adapters": adapters,
+        }
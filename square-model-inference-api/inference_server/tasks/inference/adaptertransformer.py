@@ -1,15 +1,26 @@
+import json
 import logging
+import time
+from typing import Dict, List, Optional
+
+import torch
 
 from tasks.config.model_config import model_config
 from tasks.models.prediction import PredictionOutput
 from tasks.models.request import PredictionRequest, Task
 from transformers.adapters import AutoAdapterModel, list_adapters
+from transformers.adapters.composition import Parallel
 from transformers.adapters.heads import CausalLMHead
 
+from .adapter_cache import AdapterCache
+from .embedding_cache import create_embedding_cache
 from .transformer import Transformer
 
 logger = logging.getLogger(__name__)
 
+# Tasks for which requests for different adapters can be predicted in a single forward pass
+MIXED_ADAPTER_TASKS = [Task.sequence_classification, Task.token_classification, Task.question_answering]
+
 
 class AdapterTransformer(Transformer):
     """
@@ -19,7 +30,8 @@ class AdapterTransformer(Transformer):
     def __init__(self,  **kwargs):
         """
         Initialize the Adapter with its underlying Transformer 
-        and pre-load all available adapters from adapterhub.ml
+        and pre-load available adapters from adapterhub.ml until the adapter cache is full.
+        All other adapters are loaded when they are requested.
 
         Args:
              model_name: the Huggingface model name
@@ -30,17 +42,26 @@ class AdapterTransformer(Transformer):
         """
         self.task = None
         self.gradients = None
+        self.embedding_cache = create_embedding_cache()
+        # the adapter for each input of the current request if it mixes adapters
+        self.mixed_adapters: Optional[List[str]] = None
         self._load_model(
             AutoAdapterModel, model_config.model_name, model_config.disable_gpu
         )
+        self.adapters = AdapterCache(
+            self._load_single_adapter,
+            self._unload_adapter,
+            max_adapters=model_config.max_adapters,
+            max_memory=model_config.max_adapter_memory * 2 ** 20,
+        )
         if model_config.preloaded_adapters:
             self._load_adapter(model_config.model_name, model_config.transformers_cache)
         self.model_name = model_config.model_name
 
     def _load_adapter(self, model_name, transformers_cache):
         """
-        Pre-load all available adapters for MODEL_NAME from adapterhub.ml.
-        We parse the hub index to extract all names and then load each model.
+        Pre-load the available adapters for MODEL_NAME from adapterhub.ml.
+        We parse the hub index to extract all names and then load each model until the adapter cache is full.
 
         Args:
              model_name: the Huggingface model name
@@ -52,6 +73,8 @@ class AdapterTransformer(Transformer):
         logger.info("Loading all available adapters")
         adapter_infos = []
         for source in ["ah", "hf"]:
+            if self.adapters.is_full():
+                break
             adapter_infos = [
                 info
                 for info in list_adapters(source=source)
@@ -69,7 +92,11 @@ class AdapterTransformer(Transformer):
                     if adapter_info.adapter_id.startswith("AdapterHub")
                 )
             for adapter in adapters:
+                if self.adapters.is_full():
+                    logger.info("Adapter cache is full, remaining adapters are loaded on demand")
+                    break
                 logger.debug(f"Loading adapter {adapter}")
+                start = time.perf_counter()
                 try:
                     self.model.load_adapter(
                         adapter,
@@ -93,15 +120,45 @@ class AdapterTransformer(Transformer):
                         )
                     else:
                         raise e
+                else:
+                    self.adapters.add(adapter, self._adapter_size(adapter), time.perf_counter() - start)
         # Move all freshly loaded adapter weights to the same device as the model
         self.model.to(self.model.device)
 
-    # def _load_single_adapter(self, adapter_name: str):
-    #     if adapter_name not in self.model.config.adapters.adapters:
-    #         logger.info(f"Loading new adapter {adapter_name}")
-    #         self.model.load_adapter(adapter_name, with_head=True, load_as=adapter_name)
-    #     else:
-    #         logger.debug(f"Adapter {adapter_name} is already loaded. Not loading again")
+    def _load_single_adapter(self, adapter_name: str) -> int:
+        """
+        Load the adapter with its head and return the size of its weights in bytes
+        """
+        logger.info(f"Loading new adapter {adapter_name}")
+        self.model.load_adapter(
+            adapter_name,
+            load_as=adapter_name,
+            with_head=True,
+            cache_dir=model_config.transformers_cache,
+            source=None,
+        )
+        self.model.to(self.model.device)
+        # freeze the weights of the new adapter and head like those of the model (see Transformer._load_model)
+        self.model.requires_grad_(False)
+        return self._adapter_size(adapter_name)
+
+    def _unload_adapter(self, adapter_name: str):
+        if adapter_name in self.model.config.adapters.adapters:
+            self.model.delete_adapter(adapter_name)
+        if adapter_name in self.model.heads:
+            self.model.delete_head(adapter_name)
+
+    def _adapter_size(self, adapter_name: str) -> int:
+        """
+        Size in bytes of the weights of the adapter and its head
+        """
+        # adapter and head weights are stored in module dicts with the adapter name as key
+        key = f".{adapter_name}."
+        return sum(
+            param.numel() * param.element_size()
+            for name, param in self.model.named_parameters()
+            if key in f".{name}."
+        )
 
     def _token_classification(self, request: PredictionRequest) -> PredictionOutput:
         # We only have to change the label2id mapping from config.label2id 
@@ -136,8 +193,10 @@ class AdapterTransformer(Transformer):
         return prediction
 
     def _prepare_adapter(self, adapter_name):
-        if adapter_name is not None:
-            self.model.load_adapter(adapter_name, load_as=adapter_name, source=None)
+        loaded = False
+        if adapter_name:
+            # only loads the adapter if it is not in the cache (anymore)
+            loaded = not self.adapters.get(adapter_name)
 
         if not adapter_name or adapter_name not in self.model.config.adapters.adapters:
             raise ValueError(
@@ -145,6 +204,8 @@ class AdapterTransformer(Transformer):
                 f"Please provider a fully specified adapter name from adapterhub.ml"
             )
         self.model.set_active_adapters(adapter_name)
+        # statistics are written immediately if an adapter was loaded
+        self._save_statistics("adapter_cache", self.adapters.statistics, force=loaded)
 
     def _generation(self, request: PredictionRequest) -> PredictionOutput:
         # ensure that the loaded had is a lm head
@@ -160,6 +221,96 @@ class AdapterTransformer(Transformer):
                 self.model.add_seq2seq_lm_head("lm_head", True)
         return super()._generation(request)
 
+    def can_batch(self, request: PredictionRequest, task: Task) -> bool:
+        # Only adapters that are already loaded can be checked for their head type.
+        # Multiple choice heads treat all inputs of a request as the choices of one question.
+        head = self.model.config.prediction_heads.get(request.adapter_name)
+        if head is None or head.get("head_type") == "multiple_choice":
+            return False
+        return super().can_batch(request, task)
+
+    def _use_length_buckets(self, request: PredictionRequest, features) -> bool:
+        # Sorting would mix up the choices of multiple choice heads
+        head = self.model.config.prediction_heads.get(request.adapter_name, {})
+        if head.get("head_type") == "multiple_choice":
+            return False
+        return super()._use_length_buckets(request, features)
+
+    def mixed_adapter_key(self, request: PredictionRequest, task: Task) -> Optional[str]:
+        # Adapters can be mixed if their heads produce the same outputs, i.e. they have the same type and labels
+        head = self.model.config.prediction_heads.get(request.adapter_name)
+        if task not in MIXED_ADAPTER_TASKS or head is None or head.get("head_type") == "multiple_choice":
+            return None
+        return json.dumps(
+            {
+                "head_type": head.get("head_type"),
+                "num_labels": head.get("num_labels"),
+                "label2id": head.get("label2id"),
+            },
+            sort_keys=True,
+        )
+
+    def can_mix_adapters(self, adapter_names: List[str]) -> bool:
+        # all adapters of the forward pass have to fit into the adapter cache at once
+        return self.adapters.fits(adapter_names)
+
+    def predict_mixed(self, request: PredictionRequest, adapter_names: List[str], task: Task) -> PredictionOutput:
+        """
+        Predict the request with a different adapter for each input. All adapters are active in parallel
+        (adapter-transformers' Parallel composition) and the output of each input is taken from the head
+        of its adapter, so the outputs are the same as if each adapter was used on its own.
+        """
+        if len(request.input) > model_config.max_input_size:
+            raise ValueError(
+                f"Input is too large. Max input size is {model_config.max_input_size}"
+            )
+        for adapter_name in dict.fromkeys(adapter_names):
+            self._prepare_adapter(adapter_name)
+        # the label mapping of all adapters is the same, so the request keeps the first adapter's name
+        request.adapter_name = adapter_names[0]
+        self.mixed_adapters = adapter_names
+        try:
+            self.task = task
+            if self.task == Task.sequence_classification:
+                return self._sequence_classification(request)
+            elif self.task == Task.token_classification:
+                return self._token_classification(request)
+            elif self.task == Task.question_answering:
+                return self._question_answering(request)
+            raise ValueError(f"Mixed adapter batches are not supported for {task}")
+        finally:
+            self.mixed_adapters = None
+
+    def _forward(self, features: Dict[str, torch.Tensor], model_kwargs: dict, indices) -> dict:
+        if self.mixed_adapters is None:
+            return super()._forward(features, model_kwargs, indices)
+        adapter_names = [self.mixed_adapters[i] for i in torch.arange(len(self.mixed_adapters))[indices].tolist()]
+        active_adapters = list(dict.fromkeys(adapter_names))
+        if len(active_adapters) == 1:
+            self.model.set_active_adapters(active_adapters[0])
+            return super()._forward(features, model_kwargs, indices)
+
+        # Parallel runs the whole batch through every adapter and its head
+        self.model.set_active_adapters(Parallel(*active_adapters))
+        head_outputs = super()._forward(features, model_kwargs, indices).head_outputs
+        adapter_idx = torch.tensor([active_adapters.index(name) for name in adapter_names])
+        return type(head_outputs[0])(**{
+            key: self._select_adapter_rows([output[key] for output in head_outputs], adapter_idx)
+            for key in head_outputs[0].keys()
+        })
+
+    def _select_adapter_rows(self, values: List, adapter_idx: torch.Tensor):
+        """
+        Take each row of the batch from the output of its adapter
+        """
+        if isinstance(values[0], tuple):
+            return tuple(
+                self._select_adapter_rows([value[i] for value in values], adapter_idx)
+                for i in range(len(values[0]))
+            )
+        stacked = torch.stack(values)
+        return stacked[adapter_idx.to(stacked.device), torch.arange(len(adapter_idx), device=stacked.device)]
+
     def predict(self, request: PredictionRequest, task: Task) -> PredictionOutput:
         if request.is_preprocessed:
             raise ValueError(
@@ -0,0 +1,251 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from io import BytesIO
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from tasks.config.model_config import model_config
+from tasks.models.request import PredictionRequest
+
+logger = logging.getLogger(__name__)
+
+# Prefix of the keys of the embeddings in redis
+REDIS_PREFIX = "embedding-cache:"
+
+
+class EmbeddingCache:
+    """
+    Caches the embeddings of single inputs, so that only inputs that were not embedded before reach the model.
+
+    Embeddings are stored under a hash of the normalized input text and a namespace that contains everything else
+    that influences the embedding (deployment, model, adapter, precision, embedding mode, preprocessing).
+    Inputs are embedded in their normalized form, so that inputs that only differ in their unicode composition
+    or whitespace share one embedding.
+    The local cache is bounded by the memory of the embeddings and evicts the least recently used embeddings.
+    Optionally, embeddings are also stored in redis, so that all workers of a model share their embeddings.
+    """
+
+    def __init__(self, max_memory: int, ttl: float = 0, redis_url: Optional[str] = None):
+        """
+        Args:
+             max_memory: maximum number of bytes of the embeddings in the local cache, 0 disables the local cache
+             ttl: time in seconds after which embeddings expire, 0 for no expiry
+             redis_url: url of the redis instance for the shared cache
+        """
+        self.max_memory = max_memory
+        self.ttl = ttl
+        # key -> (embedding, expiry time), ordered from least to most recently used
+        self._entries: OrderedDict = OrderedDict()
+        self.memory = 0
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self.redis = None
+        if redis_url:
+            import redis
+            self.redis = redis.Redis.from_url(redis_url)
+
+    @staticmethod
+    def normalize(text):
+        """
+        Composes the unicode characters and collapses whitespace of the input (a text or a pair of texts)
+        """
+        if isinstance(text, str):
+            return " ".join(unicodedata.normalize("NFC", text).split())
+        return [EmbeddingCache.normalize(t) for t in text]
+
+    @staticmethod
+    def key(namespace: str, text) -> str:
+        """
+        The cache key of the normalized input (a text or a pair of texts) in the namespace
+        """
+        serialized = json.dumps([namespace, text], ensure_ascii=False)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def embed(
+            self,
+            request: PredictionRequest,
+            namespace: str,
+            compute: Callable[[PredictionRequest], np.ndarray],
+    ) -> np.ndarray:
+        """
+        Returns the embeddings for all inputs of the request.
+        The embeddings of inputs that are not cached are computed with a single call to compute
+        on a copy of the request with only these inputs.
+
+        Args:
+             request: the embedding request
+             namespace: identifies the model and all parameters that influence the embeddings
+             compute: returns the embeddings for the inputs of a request as array with one row per input
+        """
+        texts = [self.normalize(text) for text in request.input]
+        keys = [self.key(namespace, text) for text in texts]
+        embeddings = self.get(keys)
+        # inputs that occur multiple times in the request are only computed once, at their first position
+        positions = {}
+        for i, (key, embedding) in enumerate(zip(keys, embeddings)):
+            if embedding is None:
+                positions.setdefault(key, i)
+        missing = list(positions)
+        if missing:
+            missing_request = request.copy(
+                deep=True, update={"input": [texts[positions[key]] for key in missing]}
+            )
+            # copy the rows, so that the cache does not keep the whole array of the batch alive
+            computed = {key: np.array(row) for key, row in zip(missing, compute(missing_request))}
+            self.put(computed)
+            embeddings = [computed[key] if embedding is None else embedding for key, embedding in zip(keys, embeddings)]
+        return np.stack(embeddings)
+
+    def get(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        Look up the embeddings in the local cache and then in redis
+
+        Returns:
+            the embedding for each key or None if it is not cached
+        """
+        now = time.monotonic()
+        embeddings = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] is not None and entry[1] <= now:
+                    self._remove(key)
+                    entry = None
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                embeddings.append(entry[0] if entry is not None else None)
+
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing and self.redis is not None:
+            shared = self._redis_get([keys[i] for i in missing])
+            found = {}
+            for i, embedding in zip(missing, shared):
+                if embedding is not None:
+                    embeddings[i] = embedding
+                    found[keys[i]] = embedding
+            with self._lock:
+                self.redis_hits += len(found)
+            self._put_local(found)
+        with self._lock:
+            self.misses += sum(embedding is None for embedding in embeddings)
+        return embeddings
+
+    def put(self, embeddings: Dict[str, np.ndarray]):
+        """
+        Store the embeddings in the local cache and in redis
+        """
+        self._put_local(embeddings)
+        if self.redis is not None and embeddings:
+            self._redis_put(embeddings)
+
+    def _put_local(self, embeddings: Dict[str, np.ndarray]):
+        if not self.max_memory:
+            return
+        expiry = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            for key, embedding in embeddings.items():
+                if embedding.nbytes > self.max_memory:
+                    continue
+                if key in self._entries:
+                    self._remove(key)
+                self._entries[key] = (embedding, expiry)
+                self.memory += embedding.nbytes
+            while self.memory > self.max_memory:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: str):
+        embedding, _ = self._entries.pop(key)
+        self.memory -= embedding.nbytes
+
+    def _redis_get(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        import redis
+        try:
+            values = self.redis.mget([REDIS_PREFIX + key for key in keys])
+        except redis.RedisError as e:
+            logger.warning(f"Could not read embeddings from redis: {e}")
+            return [None] * len(keys)
+        return [np.load(BytesIO(value)) if value is not None else None for value in values]
+
+    def _redis_put(self, embeddings: Dict[str, np.ndarray]):
+        import redis
+        try:
+            with self.redis.pipeline(transaction=False) as pipe:
+                for key, embedding in embeddings.items():
+                    with BytesIO() as b:
+                        np.save(b, embedding)
+                        pipe.set(REDIS_PREFIX + key, b.getvalue(), ex=int(self.ttl) or None)
+                pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Could not store embeddings in redis: {e}")
+
+    def statistics(self) -> Dict:
+        """
+        Hit/ miss statistics and size of the cache
+        """
+        hits = self.hits + self.redis_hits
+        lookups = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "memory": self.memory,
+            "max_memory": self.max_memory,
+            "ttl": self.ttl,
+            "redis": self.redis is not None,
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else None,
+            "evictions": self.evictions,
+        }
+
+    @staticmethod
+    def merge_statistics(statistics: List[Dict]) -> Optional[Dict]:
+        """
+        Merge the statistics of the caches of several worker processes. Counts and memory are summed up,
+        the size limit and ttl are the ones of each process.
+
+        Returns:
+            the merged statistics or None if no process stored statistics
+        """
+        if not statistics:
+            return None
+        merged = {
+            "processes": len(statistics),
+            **{key: statistics[0][key] for key in ["max_memory", "ttl", "redis"]},
+            **{
+                key: sum(process[key] for process in statistics)
+                for key in ["entries", "memory", "hits", "redis_hits", "misses", "evictions"]
+            },
+        }
+        lookups = merged["hits"] + merged["redis_hits"] + merged["misses"]
+        merged["hit_rate"] = (merged["hits"] + merged["redis_hits"]) / lookups if lookups else None
+        return merged
+
+
+def create_embedding_cache() -> Optional[EmbeddingCache]:
+    """
+    Create the embedding cache according to the model config
+
+    Returns:
+        the cache or None if it is disabled
+    """
+    if not model_config.embedding_cache_size and not model_config.embedding_cache_redis_url:
+        return None
+    logger.info(
+        f"Caching embeddings with {model_config.embedding_cache_size} MB, "
+        f"ttl {model_config.embedding_cache_ttl}s and redis {bool(model_config.embedding_cache_redis_url)}"
+    )
+    return EmbeddingCache(
+        max_memory=model_config.embedding_cache_size * 2 ** 20,
+        ttl=model_config.embedding_cache_ttl,
+        redis_url=model_config.embedding_cache_redis_url,
+    )
@@ -1,19 +1,19 @@
 import os
+import atexit
 import json
 import logging
-import itertools
 import operator
 from tqdm import tqdm
+from billiard.pool import Pool
 from typing import Union, Tuple, List
 
 import numpy as np
 import torch
 
-import networkx as nx
 import spacy
-from spacy.matcher import Matcher
 
 from tasks.inference.model import Model
+from tasks.metrics import metrics
 from tasks.models.request import Task, PredictionRequest
 from tasks.config.model_config import model_config
 from tasks.models.prediction import (
@@ -28,6 +28,7 @@ from .utils.preprocess import (
     grounding,
     graph,
 )
+from .utils.preprocess.cpnet_index import ConceptNetIndex
 
 
 from transformers import (
@@ -52,13 +53,19 @@ logger = logging.getLogger(__name__)
 
 CPNET_VOCAB = "/concept.txt"
 CPNET_PATH = "/conceptnet.en.pruned.graph"
+# CSR index of CPNET_PATH, created from the graph on the first start if it does not exist
+CPNET_INDEX_PATH = "/conceptnet.en.pruned.csr"
 PATTERN_PATH = "/matcher_patterns.json"
 ENTITIES_PATH = "/tzw.ent.npy"
 
 LM_MODEL = "roberta-base"
 MAX_NODE_NUM = 200
 
-NUM_PROCESSES = os.getenv("NUM_PROCESSES", 16)
+NUM_PROCESSES = int(os.getenv("NUM_PROCESSES", 16))
+# maximum number of tokens of a batch for the LM relevance scores of the graph nodes
+LM_SCORE_MAX_TOKENS = int(os.getenv("LM_SCORE_MAX_TOKENS", 8192))
+# maximum number of cached (context, concept) relevance scores, 0 disables the cache
+LM_SCORE_CACHE_SIZE = int(os.getenv("LM_SCORE_CACHE_SIZE", 100000))
 
 nlp = None
 matcher = None
@@ -85,6 +92,15 @@ merged_relations = [
 id2relation = merged_relations
 
 
+def _init_pool_worker(cpnet_vocab, _nlp, _matcher, _cpnet_index):
+    """
+    Initializer of the worker processes. The workers are forked after the resources are loaded,
+    so they are shared with the workers once instead of being pickled for every request.
+    """
+    grounding.init_worker(cpnet_vocab, _nlp, _matcher)
+    graph.init_worker(cpnet_vocab, _cpnet_index)
+
+
 class GraphTransformers(Model):
     def __init__(self, **kwargs) -> None:
 
@@ -106,24 +122,44 @@ class GraphTransformers(Model):
         self.nlp, self.matcher = self._load_matcher()
         # load DS
         self._load_resources(self.data_path + CPNET_VOCAB)
-        self._load_cpnet(self.data_path + CPNET_PATH)
+        self._load_cpnet(self.data_path + CPNET_PATH, self.data_path + CPNET_INDEX_PATH)
         # load lm model on init
         self._load_lm()
         self._load_qagnn()
+        # pools for grounding and graph construction are reused across requests
+        self._create_pools()
         logger.info(f"LOADED modules!")
 
+    def _create_pools(self):
+        """
+        Starts the worker processes for grounding and graph construction
+        """
+        initargs = (id2concept, self.nlp, self.matcher, cpnet_index)
+        # the resources derived from the vocab are created once here and inherited by the forked workers
+        _init_pool_worker(*initargs)
+        self.pool = Pool(NUM_PROCESSES, initializer=_init_pool_worker, initargs=initargs)
+        atexit.register(self.close)
+        logger.info(f"started {NUM_PROCESSES} worker processes...")
+
+    def close(self):
+        """
+        Shuts down the worker processes
+        """
+        if getattr(self, "pool", None) is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
     def _load_matcher(self):
         """
-        Loads the spacy matcher with the selected
-        matching patterns
+        Loads the spacy pipeline and compiles the
+        matching patterns into a phrase matcher
         """
         nlp = spacy.load("en_core_web_sm", disable=["ner", "parser", "textcat"])
         nlp.add_pipe("sentencizer")
         with open(self.data_path + PATTERN_PATH, "r", encoding="utf8") as fin:
             all_patterns = json.load(fin)
-        matcher = Matcher(nlp.vocab)
-        for concept, pattern in all_patterns.items():
-            matcher.add(concept, [pattern])
+        matcher = grounding.build_matcher(nlp, all_patterns)
         logger.info("loaded matcher...")
         return nlp, matcher
 
@@ -136,20 +172,24 @@ class GraphTransformers(Model):
             id2concept = [w.strip() for w in fin]
         concept2id = {w: i for i, w in enumerate(id2concept)}
 
-    def _load_cpnet(self, cpnet_graph_path):
+    def _load_cpnet(self, cpnet_graph_path, cpnet_index_path):
         """
-        Loads the conceptnet
+        Loads the memory-mapped conceptnet index.
+        If it does not exist yet, it is created from the pickled networkx graph.
         """
-        global cpnet, cpnet_simple
-        cpnet = nx.read_gpickle(cpnet_graph_path)  # Multigraph class
-        cpnet_simple = nx.Graph()  # Graph class
-        for u, v, data in cpnet.edges(data=True):
-            w = data["weight"] if "weight" in data else 1.0
-            if cpnet_simple.has_edge(u, v):
-                cpnet_simple[u][v]["weight"] += w
-            else:
-                cpnet_simple.add_edge(u, v, weight=w)
-        # print(cpnet_simple.nodes)
+        global cpnet_index
+        if ConceptNetIndex.exists(cpnet_index_path):
+            cpnet_index = ConceptNetIndex.load(cpnet_index_path)
+        else:
+            import networkx as nx
+
+            logger.info(f"creating conceptnet index {cpnet_index_path}...")
+            cpnet_index = ConceptNetIndex.from_networkx(nx.read_gpickle(cpnet_graph_path), len(id2concept))
+            try:
+                cpnet_index.save(cpnet_index_path)
+                cpnet_index = ConceptNetIndex.load(cpnet_index_path)
+            except OSError as e:
+                logger.warning(f"Could not store conceptnet index: {e}")
         logger.info("loaded conceptnet...")
 
     def _load_lm(self):
@@ -162,6 +202,12 @@ class GraphTransformers(Model):
         )
         self.lm_model.to(self.device)
         self.lm_model.eval()
+        self.lm_scorer = graph.LMScorer(
+            self.lm_model,
+            self.tokenizer,
+            max_tokens=LM_SCORE_MAX_TOKENS,
+            cache_size=LM_SCORE_CACHE_SIZE,
+        )
         logger.info("loaded pre-trained LM...")
 
     def _load_qagnn(self):
@@ -215,26 +261,30 @@ class GraphTransformers(Model):
         Returns:
              the features for the model
         """
-        global id2concept, concept2id, cpnet, cpnet_simple
+        global id2concept, concept2id, cpnet_index
         statements = statement.convert_to_entailment(input=input)
-        grounded = grounding.ground(
-            statements,
-            cpnet_vocab=id2concept,
-            _nlp=self.nlp,
-            _matcher=self.matcher,
-            num_processes=NUM_PROCESSES,
-        )
-        graph_adj = graph.generate_adj_data_from_grounded_concepts__use_LM(
-            statements,
-            grounded,
-            concept2id=concept2id,
-            _cpnet_vocab=id2concept,
-            _cpnet=cpnet,
-            _cpnet_simple=cpnet_simple,
-            model=self.lm_model,
-            tokenizer=self.tokenizer,
-            num_processes=NUM_PROCESSES,
-        )
+        with metrics.timer("grounding"):
+            grounded = grounding.ground(
+                statements,
+                cpnet_vocab=id2concept,
+                _nlp=self.nlp,
+                _matcher=self.matcher,
+                num_processes=NUM_PROCESSES,
+                pool=self.pool,
+            )
+        with metrics.timer("graph_construction"):
+            graph_adj = graph.generate_adj_data_from_grounded_concepts__use_LM(
+                statements,
+                grounded,
+                concept2id=concept2id,
+                _cpnet_vocab=id2concept,
+                _cpnet_index=cpnet_index,
+                model=self.lm_model,
+                tokenizer=self.tokenizer,
+                num_processes=NUM_PROCESSES,
+                pool=self.pool,
+                scorer=self.lm_scorer,
+            )
         return statements, grounded, graph_adj
 
     def _truncate_seq_pair(self, tokens_a, tokens_b, max_length):
@@ -577,28 +627,30 @@ class GraphTransformers(Model):
         statements, grounded, graphs = self._prepare_input(request.input)
         model_type = self.lm_model.config.model_type
 
-        features = self._convert_examples_to_features(
-            examples=statements,
-            max_seq_length=request.model_kwargs.get("max_seq_length", 128),
-            tokenizer=self.tokenizer,
-            cls_token_at_end=bool(
-                model_type in ["xlnet"]
-            ),  # xlnet has a cls token at the end
-            cls_token=self.tokenizer.cls_token,
-            sep_token=self.tokenizer.sep_token,
-            sep_token_extra=bool(model_type in ["roberta", "albert"]),
-            cls_token_segment_id=2 if model_type in ["xlnet"] else 0,
-            pad_on_left=bool(model_type in ["xlnet"]),  # pad on the left for xlnet
-            pad_token_segment_id=4 if model_type in ["xlnet"] else 0,
-            sequence_b_segment_id=0 if model_type in ["roberta", "albert"] else 1,
-        )
-        *data_tensors, all_label = self.convert_features_to_tensors(features)
+        with metrics.timer("tokenization"):
+            features = self._convert_examples_to_features(
+                examples=statements,
+                max_seq_length=request.model_kwargs.get("max_seq_length", 128),
+                tokenizer=self.tokenizer,
+                cls_token_at_end=bool(
+                    model_type in ["xlnet"]
+                ),  # xlnet has a cls token at the end
+                cls_token=self.tokenizer.cls_token,
+                sep_token=self.tokenizer.sep_token,
+                sep_token_extra=bool(model_type in ["roberta", "albert"]),
+                cls_token_segment_id=2 if model_type in ["xlnet"] else 0,
+                pad_on_left=bool(model_type in ["xlnet"]),  # pad on the left for xlnet
+                pad_token_segment_id=4 if model_type in ["xlnet"] else 0,
+                sequence_b_segment_id=0 if model_type in ["roberta", "albert"] else 1,
+            )
+            *data_tensors, all_label = self.convert_features_to_tensors(features)
 
-        *test_decoder_data, test_adj_data = self.load_sparse_adj_data_with_contextnode(
-            graphs,
-            max_node_num=request.model_kwargs.get("max_node_num", MAX_NODE_NUM),
-            num_choice=num_choices,
-        )
+        with metrics.timer("graph_construction"):
+            *test_decoder_data, test_adj_data = self.load_sparse_adj_data_with_contextnode(
+                graphs,
+                max_node_num=request.model_kwargs.get("max_node_num", MAX_NODE_NUM),
+                num_choice=num_choices,
+            )
 
         input_data = [*data_tensors, *test_decoder_data, *test_adj_data]
         output_lm_subgraph = request.model_kwargs.get("output_lm_subgraph", False)
@@ -606,7 +658,8 @@ class GraphTransformers(Model):
         output_attn_subgraph = request.model_kwargs.get("output_attn_subgraph", False)
         topk_attn = request.model_kwargs.get("topk_attn", 5)
 
-        with torch.no_grad():
+        metrics.observe_batch(num_choices)
+        with torch.no_grad(), metrics.timer("forward"):
             if not output_attn_subgraph:
                 logits, attn = self.model(*input_data)
                 # return logits, self.to_numpy(attn)
@@ -657,24 +710,25 @@ class GraphTransformers(Model):
         return predictions, task_outputs
 
     def _get_edge_info(self, node_ids: list) -> dict:
-        pair_list = [list(i) for i in list(itertools.product(node_ids, node_ids))]
-        edges = [
-            [pair, cpnet[pair[0]][pair[1]][0]]
-            for pair in pair_list
-            if cpnet_simple.has_edge(pair[0], pair[1])
-        ]
+        # the question and option concepts can overlap
+        node_ids = list(dict.fromkeys(node_ids))
+        source_pos, target_pos, relations, weights = cpnet_index.edges_between(node_ids)
+        # only the first edge of each linked pair
+        first = np.ones(len(source_pos), dtype=bool)
+        first[1:] = (source_pos[1:] != source_pos[:-1]) | (target_pos[1:] != target_pos[:-1])
 
-        linked_pairs = [r[0] for r in edges]
         edge_attributes = {}
-        for i, (node_pair, edge) in enumerate(zip(linked_pairs, edges)):
+        for i, (s, t, rel, weight) in enumerate(
+            zip(source_pos[first], target_pos[first], relations[first], weights[first])
+        ):
             tmp_dict = dict()
-            tmp_dict["source"] = node_pair[0]
-            tmp_dict["target"] = node_pair[1]
-            tmp_dict["weight"] = edge[1]["weight"]
-            if edge[1]["rel"] >= len(id2relation):
-                tmp_dict["label"] = id2relation[edge[1]["rel"] - len(id2relation)]
+            tmp_dict["source"] = node_ids[s]
+            tmp_dict["target"] = node_ids[t]
+            tmp_dict["weight"] = float(weight)
+            if rel >= len(id2relation):
+                tmp_dict["label"] = id2relation[rel - len(id2relation)]
             else:
-                tmp_dict["label"] = id2relation[edge[1]["rel"]]
+                tmp_dict["label"] = id2relation[rel]
             edge_attributes[i] = tmp_dict
         return edge_attributes
 
@@ -1,7 +1,38 @@
-from typing import Dict
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
 
+from tasks.config.model_config import IDENTIFIER, save_process_statistics
 from tasks.models.prediction import PredictionOutput
-from tasks.models.request import Task
+from tasks.models.request import PredictionRequest, Task
+
+logger = logging.getLogger(__name__)
+
+# Minimal time in seconds between two writes of the same worker statistics
+STATISTICS_INTERVAL = 1.0
+
+# Writes the statistics of the worker process off the request path, created on first use in each process
+_statistics_writer = None
+_statistics_writer_pid = None
+
+
+def _write_statistics(name: str, statistics: Dict):
+    try:
+        save_process_statistics(IDENTIFIER, name, statistics)
+    except (OSError, AttributeError) as e:
+        logger.warning(f"Could not store {name} statistics: {e}")
+
+
+def flush_statistics():
+    """
+    Wait until the pending statistics of the current process are written
+    """
+    global _statistics_writer
+    if _statistics_writer is not None and _statistics_writer_pid == os.getpid():
+        _statistics_writer.shutdown(wait=True)
+        _statistics_writer = None
 
 
 class Model:
@@ -23,3 +54,84 @@ class Model:
              PredictionOutput: the result of the prediction
         """
         raise NotImplementedError
+
+    def can_batch(self, request: PredictionRequest, task: Task) -> bool:
+        """
+        Whether the request can be merged with other requests for the same task and with the same parameters
+        into a single call of predict. The outputs of the merged call are split again along the input dimension,
+        so this only holds if the output for an input does not depend on the other inputs of the request.
+
+        Args:
+             request: the prediction request
+             task: the task that the model should perform with the request
+        Returns:
+             bool: True if the request can be batched with other requests
+        """
+        return False
+
+    def mixed_adapter_key(self, request: PredictionRequest, task: Task) -> Optional[str]:
+        """
+        Requests that can be batched and have the same mixed adapter key can be merged into a single call of
+        predict_mixed even if they use different adapters, e.g. because the heads of the adapters produce
+        outputs of the same shape and with the same labels.
+
+        Args:
+             request: the prediction request
+             task: the task that the model should perform with the request
+        Returns:
+             the key or None if the request can only be merged with requests for the same adapter
+        """
+        return None
+
+    def can_mix_adapters(self, adapter_names: List[str]) -> bool:
+        """
+        Whether predict_mixed can run all the given adapters in a single forward pass
+
+        Args:
+             adapter_names: the distinct adapters of the merged requests
+        """
+        return False
+
+    def predict_mixed(self, request: PredictionRequest, adapter_names: List[str], task: Task) -> PredictionOutput:
+        """
+        Like predict, but each input of the request is processed with its own adapter
+
+        Args:
+             request: the merged prediction request
+             adapter_names: the adapter for each input of the request
+             task: The task that the model should perform with the request
+        Returns:
+             PredictionOutput: the result of the prediction
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Release resources that outlive single requests, e.g. worker pools.
+        Called when the worker shuts down.
+        """
+        pass
+
+    def _save_statistics(self, name: str, statistics: Callable[[], Dict], force: bool = False):
+        """
+        Store statistics of the model for the /stats route. Each worker process stores its own statistics,
+        the API merges them. The statistics are taken immediately, but written in the background.
+        Unless force is set, they are written at most every STATISTICS_INTERVAL seconds.
+
+        Args:
+             name: the name of the statistics in the model statistics, e.g. adapter_cache
+             statistics: returns the current statistics
+             force: write the statistics even if they were written recently
+        """
+        if not hasattr(self, "_statistics_saved"):
+            self._statistics_saved = {}
+        now = time.monotonic()
+        if not force and now - self._statistics_saved.get(name, float("-inf")) < STATISTICS_INTERVAL:
+            return
+        self._statistics_saved[name] = now
+        global _statistics_writer, _statistics_writer_pid
+        if _statistics_writer is None or _statistics_writer_pid != os.getpid():
+            # the writer thread of the parent does not exist in forked processes
+            _statistics_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="statistics")
+            _statistics_writer_pid = os.getpid()
+        _statistics_writer.submit(_write_statistics, name, statistics())
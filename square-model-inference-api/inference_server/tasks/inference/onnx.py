@@ -1,10 +1,12 @@
+import logging
 from collections import defaultdict
-from typing import Union, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import onnxruntime
 import torch
 from tasks.config.model_config import model_config
+from tasks.metrics import metrics
 from tasks.models.prediction import PredictionOutput, PredictionOutputForEmbedding, \
     PredictionOutputForSequenceClassification, PredictionOutputForGeneration, PredictionOutputForTokenClassification
 from tasks.models.request import PredictionRequest
@@ -14,6 +16,88 @@ from torch.nn import functional as F
 from transformers import AutoTokenizer
 from .transformer import Transformer
 
+logger = logging.getLogger(__name__)
+
+# Inputs of the decoder that are not past keys and values
+DECODER_INPUT_NAMES = ["input_ids", "attention_mask", "position_ids", "encoder_hidden_states", "encoder_attention_mask"]
+GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+EXECUTION_MODES = {
+    "sequential": onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def session_options() -> onnxruntime.SessionOptions:
+    """
+    Creates the options for the onnx runtime sessions from the model config
+    """
+    options = onnxruntime.SessionOptions()
+    if model_config.onnx_graph_optimization not in GRAPH_OPTIMIZATION_LEVELS:
+        raise RuntimeError(f"Unknown ONNX_GRAPH_OPTIMIZATION. Must be one of {list(GRAPH_OPTIMIZATION_LEVELS)}")
+    if model_config.onnx_execution_mode not in EXECUTION_MODES:
+        raise RuntimeError(f"Unknown ONNX_EXECUTION_MODE. Must be one of {list(EXECUTION_MODES)}")
+    options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[model_config.onnx_graph_optimization]
+    options.execution_mode = EXECUTION_MODES[model_config.onnx_execution_mode]
+    # 0 lets onnx runtime choose the number of threads
+    options.intra_op_num_threads = model_config.onnx_intra_op_threads
+    options.inter_op_num_threads = model_config.onnx_inter_op_threads
+    options.enable_cpu_mem_arena = model_config.onnx_memory_arena
+    return options
+
+
+def session_providers() -> List[str]:
+    """
+    Execution providers of the sessions. CUDA is used if it is available and the GPU is not disabled
+    """
+    if not model_config.disable_gpu and "CUDAExecutionProvider" in onnxruntime.get_available_providers():
+        return ["CUDAExecutionProvider", "CPUExecutionProvider"]
+    return ["CPUExecutionProvider"]
+
+
+class OnnxSession:
+    """
+    An onnx runtime session whose input and output metadata is read once when the session is created.
+
+    The prefork pool of the worker loads one session per process. Onnx runtime sessions are thread-safe, so the
+    threads of a `--pool threads` worker share the session. With ENABLE_BATCHING, the calls to the model are
+    serialized by the RequestBatcher and concurrent requests are merged into one run instead.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+             path: path to the onnx file
+        """
+        providers = session_providers()
+        self.path = path
+        self.session = onnxruntime.InferenceSession(path, sess_options=session_options(), providers=providers)
+        self.inputs = self.session.get_inputs()
+        self.outputs = self.session.get_outputs()
+        self.input_names = [node.name for node in self.inputs]
+        self.output_names = [node.name for node in self.outputs]
+        logger.info(f"Created onnx runtime session for {path} with providers {providers}")
+
+    def get_inputs(self):
+        return self.inputs
+
+    def get_outputs(self):
+        return self.outputs
+
+    def run(self, output_names: Optional[List[str]], input_feed: Dict[str, np.ndarray]) -> List[np.ndarray]:
+        """
+        Args:
+             output_names: the names of the outputs to return, all outputs if empty
+             input_feed: the inputs by name
+        Returns:
+             the outputs as numpy arrays
+        """
+        return self.session.run(output_names or self.output_names, input_feed)
+
 
 def to_numpy(x):
     if type(x) is not np.ndarray:
@@ -29,18 +113,34 @@ class Onnx(Transformer):
              model_path: path where the model is stored
              model_name: the ONNX model name
              decoder_path: path to the decoder ONNX model
+             decoder_with_past_path: path to the decoder ONNX model with past-key-value inputs
              kwargs: Not used
         """
         # This assumes that a corresponding onnx file exists
         self.tokenizer = AutoTokenizer.from_pretrained(model_config.model_name)
         if self.tokenizer.pad_token is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
-        self.session = onnxruntime.InferenceSession(model_config.model_path)
+        self.session = self._create_session(model_config.model_path)
         # check whether a decoder model is available
         self.is_encoder_decoder = model_config.decoder_path is not None and model_config.decoder_path != ""
         if self.is_encoder_decoder:
             # if available load the decoder model in a onnx session
-            self.decoder_session = onnxruntime.InferenceSession(model_config.decoder_path)
+            self.decoder_session = self._create_session(model_config.decoder_path)
+        # the decoder with past-key-value inputs is used for all but the first generation step
+        self.decoder_with_past_session = None
+        self.past_input_names = []
+        if model_config.decoder_with_past_path:
+            self.decoder_with_past_session = self._create_session(model_config.decoder_with_past_path)
+            self.past_input_names = [name for name in self.decoder_with_past_session.input_names
+                                     if name not in DECODER_INPUT_NAMES]
+        sessions = [self.session, getattr(self, "decoder_session", None), self.decoder_with_past_session]
+        self.input_names = {session: session.input_names for session in sessions if session is not None}
+        self.output_names = {session: session.output_names for session in sessions if session is not None}
+        self.sequence_dims = self._onnx_sequence_dims()
+
+    @staticmethod
+    def _create_session(path: str) -> OnnxSession:
+        return OnnxSession(path)
 
     def _predict(self, request: PredictionRequest, output_features=False, features=None) \
             -> Union[dict, Tuple[dict, dict]]:
@@ -59,43 +159,81 @@ class Onnx(Transformer):
         request.preprocessing_kwargs["padding"] = request.preprocessing_kwargs.get("padding", True)
         request.preprocessing_kwargs["truncation"] = request.preprocessing_kwargs.get("truncation", True)
         if features is None:
-            features = self.tokenizer(request.input,
-                                      return_tensors="pt",
-                                      **request.preprocessing_kwargs)
+            with metrics.timer("tokenization"):
+                features = self.tokenizer(request.input,
+                                          return_tensors="pt",
+                                          **request.preprocessing_kwargs)
+            sequence_dims = self.sequence_dims
+        else:
+            # features are passed during generation, where the encoder outputs are reused and must not be trimmed
+            sequence_dims = None
+        # Sort the inputs by length, so that each batch is only padded to the longest input in the batch
+        bucketing = sequence_dims is not None and not self.is_encoder_decoder \
+            and self._use_length_buckets(request, features)
+        if bucketing:
+            lengths = features["attention_mask"].sum(dim=1)
+            order = torch.argsort(lengths, descending=True)
+        padded_length = features["input_ids"].shape[1]
+        input_names = self.input_names[self.session]
+
         for start_idx in range(0, features["input_ids"].shape[0], model_config.batch_size):
-            input_names = [self.session.get_inputs()[i].name for i in range(len(self.session.get_inputs()))]
-            ort_inputs = dict(
-                (k, to_numpy(input_data[start_idx:start_idx + model_config.batch_size])) for k, input_data in
-                features.items()
-                if k in input_names)
-
-            res = self.session.run([], ort_inputs)
-            if self.is_encoder_decoder:
-                if self.decoder_session:
-                    # Prepare decoder input
-                    # This works with encoder decoder models exported similarirly to the FastT5 onnx model
-                    ort_inputs = {
-                        "input_ids": features["decoder_input_ids"] if "decoder_input_ids" in features else np.array(
-                            [[self.get_bos_token()] for _ in range(features["input_ids"].shape[0])],
-                            dtype=np.int64), "encoder_hidden_states": res[0],
-                        "encoder_attention_mask": to_numpy(features["attention_mask"])}
-                    res += self.decoder_session.run([], ort_inputs)
+            if bucketing:
+                indices = order[start_idx:start_idx + model_config.batch_size]
+            else:
+                indices = slice(start_idx, start_idx + model_config.batch_size)
+            input_features = {k: input_data[indices] for k, input_data in features.items() if k in input_names}
+            if bucketing:
+                input_features = self._trim_padding(input_features, lengths[indices].max().item())
+            ort_inputs = dict((k, to_numpy(input_data)) for k, input_data in input_features.items())
+            metrics.observe_batch(len(ort_inputs["input_ids"]), input_features.get("attention_mask"))
+
+            with metrics.timer("forward"):
+                res = self.session.run([], ort_inputs)
+                if self.is_encoder_decoder:
+                    if self.decoder_session:
+                        # Prepare decoder input
+                        # This works with encoder decoder models exported similarirly to the FastT5 onnx model
+                        ort_inputs = {
+                            "input_ids": features["decoder_input_ids"] if "decoder_input_ids" in features else np.array(
+                                [[self.get_bos_token()] for _ in range(features["input_ids"].shape[0])],
+                                dtype=np.int64), "encoder_hidden_states": res[0],
+                            "encoder_attention_mask": to_numpy(features["attention_mask"])}
+                        res += self.decoder_session.run([], ort_inputs)
             all_predictions.append(res)
         final_prediction = {}
-        output_names = [self.session.get_outputs()[i].name for i in range(len(self.session.get_outputs()))]
+        output_names = list(self.output_names[self.session])
         if self.is_encoder_decoder:
-            output_names += [self.decoder_session.get_outputs()[i].name for i in
-                             range(len(self.decoder_session.get_outputs()))]
+            output_names += self.output_names[self.decoder_session]
 
         for idx, key in enumerate(output_names):
             # HuggingFace outputs for 'attentions' and more is returned as tuple of tensors
             # Tuple of tuples only exists for 'past_key_values' which is only relevant for generation.
             # Generation should NOT use this function
-            final_prediction[key] = torch.cat([torch.tensor(p[idx]) for p in all_predictions])
+            # the arrays returned by onnx runtime are not shared, so they are used without a copy
+            outputs = [torch.from_numpy(p[idx]) for p in all_predictions]
+            if bucketing:
+                outputs = [self._pad_sequence_dims(output, sequence_dims[key], padded_length) for output in outputs]
+            final_prediction[key] = torch.cat(outputs)
+            if bucketing:
+                final_prediction[key] = final_prediction[key][torch.argsort(order)]
         if output_features:
             return final_prediction, features
         return final_prediction
 
+    def _onnx_sequence_dims(self) -> Optional[Dict[str, List[int]]]:
+        """
+        Returns the dimensions of each model output that share the dynamic sequence axis of the input ids,
+        or None if the model was exported without a dynamic sequence axis
+        """
+        input_ids = [node for node in self.session.get_inputs() if node.name == "input_ids"]
+        if not input_ids or len(input_ids[0].shape) < 2 or not isinstance(input_ids[0].shape[1], str):
+            return None
+        sequence_axis = input_ids[0].shape[1]
+        return {
+            node.name: [dim for dim, size in enumerate(node.shape) if size == sequence_axis]
+            for node in self.session.get_outputs()
+        }
+
     def _embedding(self, request: PredictionRequest) -> PredictionOutput:
         """
         Embeds the input from the request
@@ -206,13 +344,20 @@ class Onnx(Transformer):
         max_length = request.task_kwargs.get("max_length", 20)
         task_outputs = {"generated_texts": []}
         model_outputs = defaultdict(list)
-        for prompt in request.input:
-            # if num_beams is specified beam search is executed otherwise greedy search
-            if "num_beams" in request.task_kwargs:
-                input_ids, scores = self._beam_search(request, prompt, max_length)
-            else:
-                input_ids, scores = self._greedy_generation(request, prompt, max_length)
-
+        # if num_beams is specified beam search is executed otherwise greedy search
+        if "num_beams" in request.task_kwargs:
+            # beam search decodes the beams of each prompt together
+            results = [self._beam_search(request, prompt, max_length) for prompt in request.input]
+        else:
+            # decoder-only models can only batch left-padded prompts if the positions can be passed to the model
+            batch_size = model_config.batch_size if self.is_encoder_decoder \
+                or "position_ids" in self.input_names[self.session] else 1
+            results = []
+            for start_idx in range(0, len(request.input), batch_size):
+                results += self._greedy_generation(request, request.input[start_idx:start_idx + batch_size],
+                                                   max_length)
+
+        for input_ids, scores in results:
             generated_texts = [self.tokenizer.decode(seq, skip_special_tokens=True,
                                                      clean_up_tokenization_spaces=request.task_kwargs.get(
                                                          "clean_up_tokenization_spaces", False))
@@ -228,39 +373,50 @@ class Onnx(Transformer):
 
         return PredictionOutputForGeneration(model_outputs=model_outputs, **task_outputs)
 
-    def _greedy_generation(self, request, prompt, max_length):
+    def _greedy_generation(self, request, prompts, max_length):
         """
-        Performs greedy generation for the prompts
+        Performs greedy generation for a batch of prompts
 
         Args:
              request: the inference request
-             prompt: the prompt for the generation
+             prompts: the prompts for the generation
              max_length: the maximum length of the generated sequence
         Returns:
-             the ids of the generated sequence and the score
+             the ids of the generated sequence and the scores for each prompt
         """
         cur_len = 0
         eos_token_id = self.tokenizer.eos_token_id if self.tokenizer.eos_token_id is not None else self.tokenizer.pad_token_id
-        request.preprocessing_kwargs["padding"] = False
-        features = self.tokenizer(prompt,
-                                  return_tensors="pt",
-                                  **request.preprocessing_kwargs)
-        input_ids = features["input_ids"]
-        generated_ids = [self.get_bos_token()] if self.is_encoder_decoder else []
-        unfinished_sequences = input_ids.new(input_ids.shape[0]).fill_(1)
-        scores = ()
+        request.preprocessing_kwargs["padding"] = True
+        # the generated tokens of decoder-only models have to directly follow the prompt
+        padding_side = self.tokenizer.padding_side
+        if not self.is_encoder_decoder:
+            self.tokenizer.padding_side = "left"
+        try:
+            features = self.tokenizer(prompts,
+                                      return_tensors="pt",
+                                      **request.preprocessing_kwargs)
+        finally:
+            self.tokenizer.padding_side = padding_side
+        start_ids = [self.get_bos_token()] if self.is_encoder_decoder else []
+        generated_ids = [list(start_ids) for _ in prompts]
+        scores = [() for _ in prompts]
+        # finished sequences are continued with padding, so that all sequences of the batch have the same length
+        sequences = np.array([start_ids for _ in prompts], dtype=np.int64).reshape(len(prompts), len(start_ids))
+        unfinished_sequences = torch.ones(len(prompts), dtype=torch.long)
+        state = self._start_generation(features)
         # greedy generation (adapted from transformers/generation_utils.py)
         while cur_len < max_length:
-            input_data = self._prepare_input(features, generated_ids)
-            predictions = self._predict(request, features=input_data)
-
-            next_token_logits = predictions["logits"][:, -1, :]
-            scores += (next_token_logits,)
+            next_token_logits = self._decoding_step(state, sequences)
 
             # argmax
             next_tokens = torch.argmax(next_token_logits, dim=-1)
             # update generated ids, model inputs, and length for next step
-            generated_ids.append(next_tokens[:, None].item())
+            for idx in torch.nonzero(unfinished_sequences).flatten().tolist():
+                scores[idx] += (next_token_logits[idx:idx + 1],)
+                generated_ids[idx].append(next_tokens[idx].item())
+            next_tokens = next_tokens * unfinished_sequences + \
+                self.tokenizer.pad_token_id * (1 - unfinished_sequences)
+            sequences = np.concatenate((sequences, next_tokens.numpy()[:, None]), axis=1)
             cur_len = cur_len + 1
 
             if eos_token_id is not None:
@@ -268,37 +424,114 @@ class Onnx(Transformer):
                 # stop when each sentence is finished, or if we exceed the maximum length
             if unfinished_sequences.max() == 0:
                 break
-        return [generated_ids], scores
+        return [([ids], prompt_scores) for ids, prompt_scores in zip(generated_ids, scores)]
 
-    def _prepare_input(self, encoder_features, generated_sequence):
+    def _start_generation(self, features) -> dict:
         """
-        Prepares the input for the _predict method. If the model is an encoder decoder model the
-        generated sequence is the decoder input.
+        Prepares the decoding state for the prompts. For encoder decoder models the encoder is only run once here
+        and its outputs are reused in every decoding step.
 
         Args:
-             encoder_features: the features of the prompt
-             generated_sequence: the generated ids
+             features: the features of the prompts
 
         Returns:
-             the features for the model
+             the decoding state with one row per sequence
         """
-        model_input = encoder_features.copy()
-        # if it is a encoder decoder model the generated sequence is passed to the decoder
-        # otherwise the generated sequence is appended to the input_ids
+        state = {"past": None, "input_ids": to_numpy(features["input_ids"]).astype(np.int64)}
         if self.is_encoder_decoder:
-            model_input["decoder_input_ids"] = np.array([generated_sequence], dtype=np.int64)
-            model_input["decoder_attention_mask"] = np.array([[1] * len(generated_sequence)], dtype=np.int64)
+            encoder_inputs = {k: to_numpy(v) for k, v in features.items() if k in self.input_names[self.session]}
+            state["encoder_hidden_states"] = self.session.run([], encoder_inputs)[0]
+            state["encoder_attention_mask"] = to_numpy(features["attention_mask"]).astype(np.int64)
+        else:
+            state["attention_mask"] = to_numpy(features["attention_mask"]).astype(np.int64)
+        return state
 
-        elif generated_sequence:
-            model_input["input_ids"] = torch.cat(
-                (encoder_features["input_ids"], torch.tensor(generated_sequence).unsqueeze(dim=0)), dim=1)
-            model_input["attention_mask"] = torch.ones(model_input["input_ids"].shape, dtype=torch.int64)
+    def _decoding_step(self, state: dict, sequences: np.ndarray) -> torch.Tensor:
+        """
+        Computes the logits of the next token for all sequences with one session call.
+        If a decoder with past-key-value inputs is available, only the last token of each sequence is passed to
+        the model after the first step and the cached keys and values are updated in the decoding state.
+
+        Args:
+             state: the decoding state from _start_generation, with one row per sequence
+             sequences: the generated ids of each sequence (including the decoder start token for encoder decoder
+                models) with shape (num_sequences, cur_len)
+
+        Returns:
+             the logits of the next token for each sequence
+        """
+        use_past = state["past"] is not None
+        if self.is_encoder_decoder:
+            session = self.decoder_with_past_session if use_past else self.decoder_session
+            ort_inputs = {
+                "input_ids": sequences[:, -1:] if use_past else sequences,
+                "encoder_hidden_states": state["encoder_hidden_states"],
+                "encoder_attention_mask": state["encoder_attention_mask"],
+            }
+        else:
+            session = self.decoder_with_past_session if use_past else self.session
+            # the generated sequence is appended to the (left-padded) prompt
+            input_ids = np.concatenate((state["input_ids"], sequences), axis=1)
+            attention_mask = np.concatenate((state["attention_mask"], np.ones(sequences.shape, dtype=np.int64)), axis=1)
+            position_ids = np.maximum(np.cumsum(attention_mask, axis=1) - 1, 0)
+            ort_inputs = {
+                "input_ids": input_ids[:, -1:] if use_past else input_ids,
+                "attention_mask": attention_mask,
+                "position_ids": position_ids[:, -1:] if use_past else position_ids,
+            }
+        if use_past:
+            ort_inputs.update(state["past"])
+        res = session.run([], {k: v for k, v in ort_inputs.items() if k in self.input_names[session]})
+        outputs = dict(zip(self.output_names[session], res))
+        # without present outputs (e.g. a decoder-only model exported without past) the full sequence is used
+        if self.decoder_with_past_session is not None and len(outputs) > 1:
+            state["past"] = self._update_past(state["past"] or {}, outputs)
+        return torch.tensor(outputs["logits"][:, -1, :])
+
+    def _update_past(self, past: dict, outputs: dict) -> dict:
+        """
+        Maps the present keys and values returned by the decoder to the past-key-value inputs of
+        the decoder with past. Outputs named 'present.*' are matched with inputs named 'past_key_values.*'
+        (e.g. exports of the transformers.onnx package or optimum).
+        Cached values that the decoder does not return (e.g. the cross-attention keys and values of
+        encoder decoder models) are kept.
+
+        Raises:
+             ValueError: if an output has no matching past-key-value input or
+                not all past-key-value inputs have a value afterwards
+        """
+        updated = dict(past)
+        for name, value in outputs.items():
+            if name == "logits":
+                continue
+            past_name = name.replace("present", "past_key_values", 1)
+            if not name.startswith("present") or past_name not in self.past_input_names:
+                raise ValueError(
+                    f"The decoder output {name} does not match a past-key-value input of the decoder with past "
+                    f"({self.past_input_names})"
+                )
+            updated[past_name] = value
+        missing = [name for name in self.past_input_names if name not in updated]
+        if missing:
+            raise ValueError(
+                f"The decoder returned {len(outputs) - 1} present outputs for {len(self.past_input_names)} "
+                f"past-key-value inputs of the decoder with past, no values for {missing}"
+            )
+        return updated
 
-        return model_input
+    @staticmethod
+    def _reorder_state(state: dict, beam_idx: List[int]) -> dict:
+        """
+        Selects the rows of the decoding state for the beams that are continued in the next step
+        """
+        reordered = {k: np.take(v, beam_idx, axis=0) for k, v in state.items() if k != "past"}
+        reordered["past"] = None if state["past"] is None else \
+            {k: np.take(v, beam_idx, axis=0) for k, v in state["past"].items()}
+        return reordered
 
     def _beam_search(self, request, prompt, max_length):
         """
-        Performs beam search for the given prompt
+        Performs beam search for the given prompt. All beams are decoded together with one session call per step.
 
         Args:
              request: the inference request
@@ -313,52 +546,53 @@ class Onnx(Transformer):
                                   return_tensors="pt",
                                   **request.preprocessing_kwargs)
         # get the generation arguments
-        num_beams = request.task_kwargs.pop("num_beams")
-        no_repeat_ngram_size = request.task_kwargs.pop("no_repeat_ngram_size", 0)
-        do_sample = request.task_kwargs.pop("do_sample", False)
-        top_p = request.task_kwargs.pop("top_p", None)
-        top_k = request.task_kwargs.pop("top_k", None)
-        num_return_sequences = request.task_kwargs.pop("num_return_sequences", 1)
+        num_beams = request.task_kwargs["num_beams"]
+        no_repeat_ngram_size = request.task_kwargs.get("no_repeat_ngram_size", 0)
+        do_sample = request.task_kwargs.get("do_sample", False)
+        top_p = request.task_kwargs.get("top_p", None)
+        top_k = request.task_kwargs.get("top_k", None)
+        num_return_sequences = request.task_kwargs.get("num_return_sequences", 1)
         return_sequences = []
         for i in range(num_return_sequences):
             sequences = [([self.get_bos_token()] if self.is_encoder_decoder else [], 0.0)]
+            state = self._start_generation(features)
             cur_len = 0
             while cur_len < max_length:
+                next_token_logits = self._decoding_step(state, np.array([seq[0] for seq in sequences], dtype=np.int64))
+                next_token_scores = F.softmax(next_token_logits, dim=1)
+                if do_sample:
+                    next_token_scores = self._preprocess_logits(next_token_scores, top_k=top_k, top_p=top_p,
+                                                                min_tokens_to_keep=2 * num_beams)
+
+                if no_repeat_ngram_size > 0:
+                    banned_batch_tokens = calc_banned_ngram_tokens(
+                        torch.tensor([seq[0] for seq in sequences]), len(sequences), no_repeat_ngram_size, cur_len
+                    )
+                    for i, banned_tokens in enumerate(banned_batch_tokens):
+                        next_token_scores[i, banned_tokens] = -float("inf")
+
+                if do_sample:
+                    # draw the next token based on the probabilities
+                    probs = nn.functional.softmax(next_token_scores, dim=-1)
+
+                    next_tokens = torch.multinomial(probs, num_samples=2 * num_beams)
+                    next_token_prob = torch.gather(next_token_scores, -1, next_tokens)
+
+                    _, _indices = torch.sort(next_token_prob, descending=True, dim=1)
+                    next_tokens_idx = torch.gather(next_tokens, -1, _indices)
+                    next_token_prob = torch.gather(next_token_prob, -1, _indices)
+
+                else:
+                    # take the most likely tokens as the next tokens
+                    next_token_prob, next_tokens_idx = torch.topk(next_token_scores, num_beams, dim=-1)
                 candidates = []
-                for seq in sequences:
-                    model_input = self._prepare_input(features, seq[0])
-                    predictions = self._predict(request, False, model_input)
-
-                    next_token_logits = predictions["logits"][:, -1, :]
-                    next_token_scores = F.softmax(next_token_logits, dim=1)
-                    if do_sample:
-                        next_token_scores = self._preprocess_logits(next_token_scores, top_k=top_k, top_p=top_p,
-                                                                    min_tokens_to_keep=2 * num_beams)
-
-                    if no_repeat_ngram_size > 0:
-                        banned_batch_tokens = calc_banned_ngram_tokens(
-                            torch.tensor([seq[0]]), 1, no_repeat_ngram_size, cur_len
-                        )
-                        for i, banned_tokens in enumerate(banned_batch_tokens):
-                            next_token_scores[i, banned_tokens] = -float("inf")
-
-                    if do_sample:
-                        # draw the next token based on the probabilities
-                        probs = nn.functional.softmax(next_token_scores, dim=-1)
-
-                        next_tokens = torch.multinomial(probs, num_samples=2 * num_beams)
-                        next_token_prob = torch.gather(next_token_scores, -1, next_tokens)
-
-                        _, _indices = torch.sort(next_token_prob, descending=True, dim=1)
-                        next_tokens_idx = torch.gather(next_tokens, -1, _indices)
-
-                    else:
-                        # take the most likely tokens as the next tokens
-                        next_token_prob, next_tokens_idx = torch.topk(next_token_scores, num_beams, dim=-1)
-                    candidates += [(seq[0] + [token_id], seq[1] + np.log(score)) for token_id, score in
-                                   zip(next_tokens_idx.squeeze().tolist(), next_token_prob.squeeze().tolist())]
+                for beam, seq in enumerate(sequences):
+                    candidates += [(seq[0] + [token_id], seq[1] + np.log(score), beam) for token_id, score in
+                                   zip(next_tokens_idx[beam].tolist(), next_token_prob[beam].tolist())]
                 # select the candidates with the highest scores as beams for the generation of the next token
-                sequences = sorted(candidates, key=lambda x: x[1], reverse=True)[:num_beams]
+                candidates = sorted(candidates, key=lambda x: x[1], reverse=True)[:num_beams]
+                sequences = [(candidate[0], candidate[1]) for candidate in candidates]
+                state = self._reorder_state(state, [candidate[2] for candidate in candidates])
                 cur_len += 1
 
             return_sequences.append(sequences[0])
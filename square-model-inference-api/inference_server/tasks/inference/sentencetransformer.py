@@ -2,8 +2,10 @@ import logging
 
 import torch
 from sentence_transformers import SentenceTransformer as SentenceTransformerModel
-from tasks.config.model_config import model_config
+from tasks.config.model_config import IDENTIFIER, model_config
+from tasks.inference.embedding_cache import create_embedding_cache
 from tasks.inference.model import Model
+from tasks.metrics import metrics
 from tasks.models.prediction import PredictionOutput, PredictionOutputForEmbedding
 from tasks.models.request import Task, PredictionRequest
 
@@ -26,6 +28,7 @@ class SentenceTransformer(Model):
              kwargs: Not used
         """
         self._load_model(model_config.model_name, model_config.disable_gpu)
+        self.embedding_cache = create_embedding_cache()
 
     def _load_model(self, model_name, disable_gpu):
         """
@@ -44,9 +47,23 @@ class SentenceTransformer(Model):
         self.model = model
 
     def _embedding(self, request: PredictionRequest) -> PredictionOutput:
-        embeddings = self.model.encode(request.input, batch_size=model_config.batch_size, show_progress_bar=False)
+        if self.embedding_cache is not None:
+            # the embeddings only depend on the deployment, the model and the text
+            namespace = f"sentence-transformer/{IDENTIFIER}/{model_config.model_name}"
+            embeddings = self.embedding_cache.embed(request, namespace, self._encode)
+            self._save_statistics("embedding_cache", self.embedding_cache.statistics)
+        else:
+            embeddings = self._encode(request)
         return PredictionOutputForEmbedding(model_outputs={"embeddings": embeddings})
 
+    def _encode(self, request: PredictionRequest):
+        metrics.observe_batch(len(request.input))
+        with metrics.timer("forward"):
+            return self.model.encode(request.input, batch_size=model_config.batch_size, show_progress_bar=False)
+
+    def can_batch(self, request: PredictionRequest, task: Task) -> bool:
+        return task == Task.embedding and isinstance(request.input, list) and not request.is_preprocessed
+
     def predict(self, request: PredictionRequest, task: Task) -> PredictionOutput:
         """
         Args:
@@ -1,14 +1,19 @@
+import json
 import logging
 import math
 import string
+import time
 from collections import defaultdict
+from contextlib import nullcontext
 from typing import Any, Dict, List, Tuple, Union
 
 import numpy as np
 import torch
 from tasks.attacks import hotflip, input_reduction, subspan, topk_tokens
-from tasks.config.model_config import model_config
+from tasks.config.model_config import IDENTIFIER, model_config
+from tasks.inference.embedding_cache import create_embedding_cache
 from tasks.inference.model import Model
+from tasks.metrics import metrics
 from tasks.models.prediction import (PredictionOutput,
                                      PredictionOutputForEmbedding,
                                      PredictionOutputForGeneration,
@@ -33,6 +38,39 @@ CLASS_MAPPING = {
     "generation": AutoModelForCausalLM,
 }
 
+# Position of the sequence dimensions of the model outputs. Used to pad the outputs of batches that were
+# only padded to their own longest input back to the longest input of the whole request.
+# 'logits' only have a sequence dimension for token classification (see Transformer._sequence_output_dims)
+SEQUENCE_OUTPUT_DIMS = {
+    "start_logits": [1],
+    "end_logits": [1],
+    "last_hidden_state": [1],
+    "pooler_output": [],
+    "hidden_states": [1],
+    "attentions": [2, 3],
+}
+
+# Tasks whose outputs can be split per input after merging several requests into one forward pass
+BATCHABLE_TASKS = [
+    Task.sequence_classification,
+    Task.token_classification,
+    Task.embedding,
+    Task.question_answering,
+]
+
+
+# Supported values of PRECISION. int8 quantizes the weights of all linear layers dynamically,
+# bf16 runs the forward passes with bfloat16 autocast. Both are only used on CPU
+PRECISIONS = ["fp32", "int8", "bf16"]
+# Inputs used to compare the outputs and the latency of the model with reduced precision against fp32
+PRECISION_CHECK_INPUTS = [
+    "The quick brown fox jumps over the lazy dog.",
+    "What is the capital of France? Paris is the capital and most populous city of France.",
+    "Transformers process all tokens of a sentence in parallel.",
+    "I did not like this movie at all.",
+]
+PRECISION_CHECK_REPEATS = 3
+
 
 class Transformer(Model):
     """
@@ -40,6 +78,8 @@ class Transformer(Model):
     """
 
     SUPPORTED_EMBEDDING_MODES = ["mean", "max", "cls", "token", "pooler"]
+    # Numeric precision of the forward passes, see PRECISIONS
+    precision = "fp32"
 
     def __init__(self, **kwargs):
         """
@@ -54,6 +94,7 @@ class Transformer(Model):
         # new added section start
         self.gradients = None
         # new added section end
+        self.embedding_cache = create_embedding_cache()
         if model_config.model_class == "from_config":
             config = AutoConfig.from_pretrained(model_config.model_name)
             model_arch = config.architectures[0]
@@ -87,10 +128,116 @@ class Transformer(Model):
         # Check if GPU is available
         device = "cuda" if torch.cuda.is_available() and not disable_gpu else "cpu"
         model = model_cls.from_pretrained(model_name).to(device)
+        # The model is only used for inference and explanations only need gradients w.r.t. the input,
+        # so the parameters are frozen once
+        model.requires_grad_(False)
         logger.info(f"Model {model_name} loaded on {device}")
 
         self.model = model
         self.tokenizer = tokenizer
+        self._set_precision(model_config.precision, device)
+
+    def _set_precision(self, precision: str, device: str):
+        """
+        Quantize the model to int8 or enable bf16 autocast. With PRECISION_CHECK, the outputs and the latency
+        are compared against fp32 and the model falls back to fp32 if the error is larger than PRECISION_TOLERANCE.
+        """
+        if precision not in PRECISIONS:
+            raise RuntimeError(f"Unknown PRECISION. Must be one of {PRECISIONS}")
+        if precision == "fp32":
+            return
+        if device != "cpu":
+            logger.warning(f"Precision {precision} is only supported on CPU. Using fp32 on {device}")
+            return
+
+        reference = self.model
+        if precision == "int8":
+            self.model = torch.quantization.quantize_dynamic(reference, {torch.nn.Linear}, dtype=torch.qint8)
+        self.precision = precision
+        logger.info(f"Using {precision} precision")
+        if not model_config.precision_check:
+            return
+
+        results = self._check_precision(reference)
+        if results.get("relative_error", 0) > model_config.precision_tolerance:
+            logger.warning(
+                f"Relative error {results['relative_error']:.4f} of {precision} exceeds the tolerance "
+                f"{model_config.precision_tolerance}. Using fp32"
+            )
+            self.model = reference
+            self.precision = "fp32"
+            results["fallback"] = True
+        self._save_statistics("precision_check", lambda: results, force=True)
+
+    def _check_precision(self, reference: Module) -> Dict[str, Any]:
+        """
+        Compare the outputs and latency of the model against the fp32 reference model on PRECISION_CHECK_INPUTS
+
+        Returns:
+            the maximal relative error of the first output over the inputs and the latencies in seconds
+        """
+        features = self.tokenizer(PRECISION_CHECK_INPUTS, return_tensors="pt", padding=True, truncation=True)
+        try:
+            reference_outputs, reference_latency = self._timed_forward(reference, features, reduced_precision=False)
+            outputs, latency = self._timed_forward(self.model, features, reduced_precision=True)
+        except Exception as e:
+            # e.g. encoder-decoder models that need decoder inputs
+            logger.warning(f"Skipping the precision check: {e}")
+            return {"precision": self.precision, "error": str(e), "fallback": False}
+
+        key = next(
+            k for k, v in reference_outputs.items() if isinstance(v, torch.Tensor) and v.is_floating_point()
+        )
+        expected = reference_outputs[key].float().flatten(1)
+        actual = outputs[key].float().flatten(1)
+        relative_error = ((actual - expected).norm(dim=1) / expected.norm(dim=1).clamp(min=1e-12)).max().item()
+        results = {
+            "precision": self.precision,
+            "output": key,
+            "relative_error": relative_error,
+            "fp32_latency": reference_latency,
+            "latency": latency,
+            "speedup": reference_latency / latency,
+            "fallback": False,
+        }
+        logger.info(f"Precision check: {results}")
+        return results
+
+    def _timed_forward(self, model: Module, features, reduced_precision: bool) -> Tuple[Dict, float]:
+        """
+        Run the model on the features once for warm-up and then PRECISION_CHECK_REPEATS times
+
+        Returns:
+            the outputs of the model and the average latency in seconds
+        """
+        with torch.no_grad(), self._precision_context() if reduced_precision else nullcontext():
+            outputs = model(**features)
+            start = time.perf_counter()
+            for _ in range(PRECISION_CHECK_REPEATS):
+                model(**features)
+            latency = (time.perf_counter() - start) / PRECISION_CHECK_REPEATS
+        return outputs, latency
+
+    def _precision_context(self):
+        """
+        The context for forward passes with the precision of the model
+        """
+        if self.precision == "bf16":
+            return torch.autocast("cpu", dtype=torch.bfloat16)
+        return nullcontext()
+
+    def _to_float32(self, value):
+        """
+        Convert all floating point tensors of the model outputs to float32, e.g. after bf16 autocast
+        """
+        if isinstance(value, torch.Tensor):
+            return value.float() if value.is_floating_point() else value
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._to_float32(v) for v in value)
+        if isinstance(value, dict):
+            for key in value.keys():
+                value[key] = self._to_float32(value[key])
+        return value
 
     def encode(
             self, inputs: list = None, add_special_tokens: bool = True, return_tensors=None
@@ -185,26 +332,32 @@ class Transformer(Model):
         handles.append(attn_layer.register_forward_hook(forward_hook))
         return handles
 
-    def _register_hooks(self, embeddings_list: List, alpha: int, method: str):
+    def _register_hooks(self, embeddings_list: List, alpha: Union[float, np.ndarray], method: str):
         """
         Register the model embeddings during the forward pass
         Args:
             embeddings_list: list to store embeddings during forward pass
+            alpha: the scaling factor of the embeddings for integrated gradients. If multiple values are given,
+                the batch consists of one copy of the input for each value
+            method: the explanation method
         """
 
         def forward_hook(module, inputs, output):
-            if alpha == 0 and method in ["simple_grads", "integrated_grads"]:
-                embeddings_list.append(output.squeeze(0).clone().detach())
+            alphas = torch.as_tensor(alpha, dtype=output.dtype, device=output.device).reshape(-1)
+            num_inputs = output.shape[0] // len(alphas)
+            if alphas[0] == 0 and method in ["simple_grads", "integrated_grads"]:
+                embeddings_list.append(output[:num_inputs].squeeze(0).clone().detach())
             if method == "integrated_grads":
-                # Scale the embedding by alpha
-                output.mul_(alpha)
+                # Scale the embeddings of each copy of the input by its alpha
+                output.mul_(alphas.repeat_interleave(num_inputs).view(-1, 1, 1))
             elif method == "smooth_grads":
-                torch.manual_seed(4)
-                torch.cuda.manual_seed(4)
+                generator = torch.Generator(device=output.device).manual_seed(4)
                 # Random noise = N(0, stdev * (max-min))
                 stdev = 0.01
                 scale = output.detach().max() - output.detach().min()
-                noise = torch.randn(output.shape, device=output.device) * stdev * scale
+                noise = torch.randn(
+                    output.shape, device=output.device, generator=generator
+                ) * stdev * scale
 
                 # Add the random noise
                 output.add_(noise)
@@ -221,13 +374,14 @@ class Transformer(Model):
             embedding_grads: list to store the gradients
         """
 
-        def hook_layers(module, grad_in, grad_out):
-            grads = grad_out[0]
-            embedding_grads.append(grads)
+        def forward_hook(module, inputs, output):
+            # the parameters are frozen, so the gradients are computed w.r.t. the embeddings
+            output.requires_grad_(True)
+            output.register_hook(embedding_grads.append)
 
         hooks = []
         embedding_layer = self.get_model_embeddings()
-        hooks.append(embedding_layer.register_full_backward_hook(hook_layers))
+        hooks.append(embedding_layer.register_forward_hook(forward_hook))
         return hooks
 
     def _register_attention_gradient_hooks(self, attn_grads: List):
@@ -244,49 +398,64 @@ class Transformer(Model):
         hooks = []
         attentions = self.get_model_attentions()
         hooks.append(attentions.register_full_backward_hook(hook_layers))
+        # the parameters are frozen, so the embeddings have to require gradients
+        hooks.append(
+            self.get_model_embeddings().register_forward_hook(
+                lambda module, inputs, output: output.requires_grad_(True)
+            )
+        )
         return hooks
 
-    def get_gradients(self, request: PredictionRequest, method: str, **kwargs):
+    def get_gradients(
+            self, request: PredictionRequest, method: str, features=None, num_samples: int = 1, **kwargs
+    ):
         """
         Compute model gradients
         Args:
-            inputs: list of question and context
-            answer_start: answer span start
-            answer_end: answer span end
+            request: the request with the input
+            method: the explanation method
+            features: the tokenized input. The input of the request is tokenized if not given
+            num_samples: number of copies of the input that are processed in one batch,
+                e.g. the interpolation steps of integrated gradients.
+                The gradients of the copies are summed up.
+            kwargs: the targets for the loss, e.g. labels or the answer start and end
         Return:
             dict of model gradients
         """
+        if self.precision == "int8":
+            raise ValueError("Gradient-based explanations are not supported for models with int8 precision")
 
-        original_param_name_to_requires_grad_dict = {}
-        for param_name, param in self.model.named_parameters():
-            original_param_name_to_requires_grad_dict[param_name] = param.requires_grad
-            param.requires_grad = True
-
+        if features is None:
+            features = self.tokenizer(
+                request.input, return_tensors="pt", **request.preprocessing_kwargs
+            )
         gradients: List[torch.Tensor] = []
         if method == "scaled_attention":
             hooks: List = self._register_attention_gradient_hooks(gradients)
         else:
             hooks: List = self._register_embedding_gradient_hooks(gradients)
-        with torch.backends.cudnn.flags(enabled=False):
-            features = self.tokenizer(
-                request.input, return_tensors="pt", **request.preprocessing_kwargs
-            )
-            input_features = self._ensure_tensor_on_device(**features)
-            outputs = self.model(**input_features, **kwargs, **request.model_kwargs)
-            loss = outputs.loss
-
-            # Zero gradients.
-            # NOTE: this is actually more efficient than
-            # calling `self._model.zero_grad()`
-            # because it avoids a read op when the
-            # gradients are first updated below.
-            for p in self.model.parameters():
-                p.grad = None
-            loss.backward()
-
-        for hook in hooks:
-            hook.remove()
-
+        try:
+            with torch.backends.cudnn.flags(enabled=False):
+                input_features = self._ensure_tensor_on_device(
+                    **{k: v.repeat(num_samples, *[1] * (v.dim() - 1)) for k, v in features.items()}
+                )
+                targets = {
+                    k: v.repeat(num_samples) if isinstance(v, torch.Tensor) else v
+                    for k, v in kwargs.items()
+                }
+                outputs = self.model(**input_features, **targets, **request.model_kwargs)
+                # The loss is averaged over the batch. Scale it, so that the gradients
+                # of each copy are the same as if it was processed on its own.
+                loss = outputs.loss * num_samples
+                loss.backward()
+        finally:
+            for hook in hooks:
+                hook.remove()
+
+        # sum up the gradients of the copies of the input
+        gradients = [
+            grad.reshape(num_samples, -1, *grad.shape[1:]).sum(dim=0) for grad in gradients
+        ]
         # if multiple entries, only choose emb grad for the correct answer
         if "labels" in kwargs.keys() and gradients[0].shape[0] > 1:
             gradients = [gradients[0][kwargs["labels"].item()].unsqueeze(0)]
@@ -299,10 +468,6 @@ class Transformer(Model):
             key = "grad_input_" + str(idx + 1)
             grad_dict[key] = grad.detach().cpu().numpy()
 
-        # restore the original requires_grad values of the parameters
-        for param_name, param in self.model.named_parameters():
-            param.requires_grad = original_param_name_to_requires_grad_dict[param_name]
-
         return grad_dict
 
     def _predict(
@@ -331,9 +496,10 @@ class Transformer(Model):
             else "cpu"
         )
 
-        features = self.tokenizer(
-            request.input, return_tensors="pt", **request.preprocessing_kwargs
-        )
+        with metrics.timer("tokenization"):
+            features = self.tokenizer(
+                request.input, return_tensors="pt", **request.preprocessing_kwargs
+            )
         if request.explain_kwargs or request.attack_kwargs:
             self.decoded_texts = [
                 self.decode(tokens, skip_special_tokens=False)
@@ -361,15 +527,47 @@ class Transformer(Model):
             ]:
                 request.model_kwargs["output_attentions"] = True
 
-        for start_idx in range(0, len(request.input), model_config.batch_size):
+        # Sort the inputs by length, so that each batch is only padded to the longest input in the batch.
+        # The outputs are padded to the longest input of the request and restored to the input order afterwards.
+        bucketing = self._use_length_buckets(request, features)
+        if bucketing:
+            lengths = features["attention_mask"].sum(dim=1)
+            order = torch.argsort(lengths, descending=True)
+        padded_length = features["input_ids"].shape[1]
+        sequence_dims = self._sequence_output_dims()
+
+        start_idx = 0
+        while start_idx < len(request.input):
             with torch.no_grad():
+                if bucketing:
+                    indices = order[start_idx: start_idx + model_config.batch_size]
+                else:
+                    indices = slice(start_idx, start_idx + model_config.batch_size)
                 input_features = {
-                    k: features[k][start_idx: start_idx + model_config.batch_size]
-                    for k in features.keys()
+                    k: features[k][indices] for k in features.keys() if k != "offset_mapping"
                 }
+                if bucketing:
+                    input_features = self._trim_padding(input_features, lengths[indices].max().item())
                 input_features = self._ensure_tensor_on_device(**input_features)
-                predictions = self.model(**input_features, **request.model_kwargs)
+                metrics.observe_batch(len(input_features["input_ids"]), input_features.get("attention_mask"))
+                with metrics.timer("forward"):
+                    predictions = self._forward(input_features, request.model_kwargs, indices)
+                if bucketing:
+                    if any(key not in sequence_dims for key in predictions.keys()):
+                        # e.g. outputs requested with model_kwargs, they cannot be padded to the whole request.
+                        # All batches return the same outputs, so only the first batch is predicted again
+                        logger.info(
+                            f"Not using length buckets for outputs {list(predictions.keys())} "
+                            f"with unknown sequence dimensions"
+                        )
+                        bucketing = False
+                        continue
+                    for key in predictions.keys():
+                        predictions[key] = self._pad_sequence_dims(
+                            predictions[key], sequence_dims[key], padded_length
+                        )
                 all_predictions.append(predictions)
+            start_idx += model_config.batch_size
 
         keys = all_predictions[0].keys()
         final_prediction = {}
@@ -398,11 +596,82 @@ class Transformer(Model):
                 final_prediction[key] = torch.cat(
                     [p[key].cpu() for p in all_predictions]
                 )
+        if bucketing:
+            inverse_order = torch.argsort(order)
+            for key, value in final_prediction.items():
+                if isinstance(value, tuple):
+                    final_prediction[key] = tuple(v[inverse_order] for v in value)
+                else:
+                    final_prediction[key] = value[inverse_order]
         if output_features:
             return final_prediction, features
 
         return final_prediction
 
+    def _forward(self, features: Dict[str, torch.Tensor], model_kwargs: dict, indices) -> dict:
+        """
+        Run the model on one batch of the request
+
+        Args:
+             features: the input features of the batch
+             model_kwargs: additional arguments for the model
+             indices: the positions of the batch in the request (a slice or a tensor with indices)
+        Returns:
+             the model outputs for the batch
+        """
+        with self._precision_context():
+            outputs = self.model(**features, **model_kwargs)
+        if self.precision == "bf16":
+            outputs = self._to_float32(outputs)
+        return outputs
+
+    def _use_length_buckets(self, request: PredictionRequest, features) -> bool:
+        """
+        Inputs are only sorted into length buckets if there is more than one batch,
+        the inputs are padded to the longest input and the outputs do not depend on the whole request
+        """
+        return (
+                "attention_mask" in features
+                and len(features["input_ids"]) > model_config.batch_size
+                and request.preprocessing_kwargs.get("padding") in [True, "longest"]
+                and not request.explain_kwargs
+                and not request.attack_kwargs
+        )
+
+    def _sequence_output_dims(self) -> Dict[str, List[int]]:
+        """
+        Returns the sequence dimensions of the model outputs for the current task
+        """
+        sequence_dims = dict(SEQUENCE_OUTPUT_DIMS)
+        sequence_dims["logits"] = [1] if self.task == Task.token_classification else []
+        return sequence_dims
+
+    def _trim_padding(self, features: Dict[str, torch.Tensor], length: int) -> Dict[str, torch.Tensor]:
+        """
+        Remove the padding tokens exceeding the given length from the features
+        """
+        if self.tokenizer.padding_side == "left":
+            return {k: v[:, v.shape[1] - length:] for k, v in features.items()}
+        return {k: v[:, :length] for k, v in features.items()}
+
+    def _pad_sequence_dims(
+            self, value: Union[torch.Tensor, Tuple], dims: List[int], length: int
+    ) -> Union[torch.Tensor, Tuple]:
+        """
+        Pad the sequence dimensions of the output with zeros to the given length
+        """
+        if isinstance(value, tuple):
+            return tuple(self._pad_sequence_dims(v, dims, length) for v in value)
+        for dim in dims:
+            missing = length - value.shape[dim]
+            if missing > 0:
+                shape = list(value.shape)
+                shape[dim] = missing
+                padding = value.new_zeros(shape)
+                parts = [padding, value] if self.tokenizer.padding_side == "left" else [value, padding]
+                value = torch.cat(parts, dim=dim)
+        return value
+
     def _interpret(
             self, request: PredictionRequest, prediction: Dict, method: str, **kwargs
     ):
@@ -414,6 +683,10 @@ class Transformer(Model):
         attentions_list: List[torch.Tensor] = []
         grads: Dict[str, Any] = {}
         instances_with_grads: Dict = {}
+        # the input is tokenized once for all gradient computations
+        features = self.tokenizer(
+            request.input, return_tensors="pt", **request.preprocessing_kwargs
+        )
 
         if method == "simple_grads":
             # Hook used for saving embeddings
@@ -421,7 +694,7 @@ class Transformer(Model):
                 embeddings_list, alpha=0, method=method
             )
             try:
-                grads = self.get_gradients(request, method, **kwargs)
+                grads = self.get_gradients(request, method, features=features, **kwargs)
             finally:
                 for handle in handles:
                     handle.remove()
@@ -440,23 +713,19 @@ class Transformer(Model):
             # integral in integrated grad
             steps = 10
             # Exclude the endpoint because we do a left point
-            # integral approximation
-            for alpha in np.linspace(0, 1.0, num=steps, endpoint=False):
-                handles = []
-                # Hook for modifying embedding value
-                handles = self._register_hooks(embeddings_list, alpha, method=method)
-                try:
-                    gradients = self.get_gradients(request, method, **kwargs)
-                finally:
-                    for handle in handles:
-                        handle.remove()
-
-                # Running sum of gradients
-                if grads == {}:
-                    grads = gradients
-                else:
-                    for key in gradients.keys():
-                        grads[key] += gradients[key]
+            # integral approximation.
+            # All steps are computed in one batch with one copy of the input per alpha
+            alphas = np.linspace(0, 1.0, num=steps, endpoint=False)
+            # Hook for modifying embedding value
+            handles = self._register_hooks(embeddings_list, alphas, method=method)
+            try:
+                # Sum of the gradients of all steps
+                grads = self.get_gradients(
+                    request, method, features=features, num_samples=steps, **kwargs
+                )
+            finally:
+                for handle in handles:
+                    handle.remove()
 
             # Average of each gradient term
             for key in grads.keys():
@@ -477,20 +746,16 @@ class Transformer(Model):
 
         elif method == "smooth_grads":
             num_samples = 10
-            for _ in range(num_samples):
-                handles = self._register_hooks(embeddings_list, alpha=0, method=method)
-                try:
-                    gradients = self.get_gradients(request, method, **kwargs)
-                finally:
-                    for handle in handles:
-                        handle.remove()
-
-                # Sum gradients
-                if grads == {}:
-                    grads = gradients
-                else:
-                    for key in gradients.keys():
-                        grads[key] += gradients[key]
+            # All samples are computed in one batch with different noise for each copy of the input
+            handles = self._register_hooks(embeddings_list, alpha=0, method=method)
+            try:
+                # Sum of the gradients of all samples
+                grads = self.get_gradients(
+                    request, method, features=features, num_samples=num_samples, **kwargs
+                )
+            finally:
+                for handle in handles:
+                    handle.remove()
 
             # Average the gradients
             for key in grads.keys():
@@ -510,7 +775,7 @@ class Transformer(Model):
             # Hook used for saving attentions
             handles: List = self._register_forward_hooks_attn(attentions_list)
             try:
-                grads = self.get_gradients(request, method, **kwargs)
+                grads = self.get_gradients(request, method, features=features, **kwargs)
                 # print(grads["grad_input_1"][:, :, 0, :].mean(1))
             finally:
                 for handle in handles:
@@ -552,6 +817,57 @@ class Transformer(Model):
         return attributions
 
     def _embedding(self, request: PredictionRequest) -> PredictionOutput:
+        embedding_mode = request.task_kwargs.get("embedding_mode", "mean")
+        if self.embedding_cache is not None and self._can_cache_embeddings(request):
+            embeddings = self.embedding_cache.embed(
+                request,
+                self._embedding_cache_namespace(request),
+                lambda missing: self._compute_embeddings(missing)[0]["embeddings"].numpy(),
+            )
+            self._save_statistics("embedding_cache", self.embedding_cache.statistics)
+            return PredictionOutputForEmbedding(
+                model_outputs={"embeddings": embeddings}, embedding_mode=embedding_mode
+            )
+        predictions, task_outputs = self._compute_embeddings(request)
+        return PredictionOutputForEmbedding(model_outputs=predictions, **task_outputs)
+
+    def _can_cache_embeddings(self, request: PredictionRequest) -> bool:
+        """
+        Only the pooled embeddings of plain requests are cached, the other model outputs are not returned for them
+        """
+        return (
+                request.task_kwargs.get("embedding_mode", "mean") != "token"
+                and not request.is_preprocessed
+                and not request.model_kwargs
+                and not request.explain_kwargs
+                and not request.attack_kwargs
+        )
+
+    def _embedding_cache_namespace(self, request: PredictionRequest) -> str:
+        """
+        Everything besides the input that determines the embedding of an input
+        """
+        return json.dumps(
+            {
+                "identifier": IDENTIFIER,
+                "model_type": model_config.model_type,
+                "model_name": model_config.model_name,
+                "model_class": model_config.model_class,
+                "adapter_name": request.adapter_name,
+                "precision": self.precision,
+                "embedding_mode": request.task_kwargs.get("embedding_mode", "mean"),
+                "preprocessing_kwargs": request.preprocessing_kwargs,
+            },
+            sort_keys=True,
+        )
+
+    def _compute_embeddings(self, request: PredictionRequest) -> Tuple[Dict, Dict]:
+        """
+        Embed the inputs of the request with the model
+
+        Returns:
+            the model outputs including the embeddings and the other task outputs
+        """
         request.model_kwargs["output_hidden_states"] = True
         predictions, features = self._predict(request, output_features=True)
         # We remove hidden_states from predictions!
@@ -603,7 +919,7 @@ class Transformer(Model):
                 features.word_ids(i) for i in range(len(request.input))
             ]
         predictions["embeddings"] = emb
-        return PredictionOutputForEmbedding(model_outputs=predictions, **task_outputs)
+        return predictions, task_outputs
 
     def _token_classification(self, request: PredictionRequest) -> PredictionOutput:
         predictions, features = self._predict(request, output_features=True)
@@ -694,37 +1010,51 @@ class Transformer(Model):
 
     def _generation(self, request: PredictionRequest) -> PredictionOutput:
         request.preprocessing_kwargs["padding"] = request.preprocessing_kwargs.get(
-            "padding", False
+            "padding", True
         )
         request.preprocessing_kwargs[
             "add_special_tokens"
         ] = request.preprocessing_kwargs.get("add_special_tokens", False)
         task_outputs = {"generated_texts": []}
         model_outputs = defaultdict(list)
+        request.model_kwargs.update(request.task_kwargs)
+        request.model_kwargs["return_dict_in_generate"] = True
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        request.model_kwargs["pad_token_id"] = request.model_kwargs.get(
+            "pad_token_id", self.tokenizer.pad_token_id
+        )
 
-        # We cannot batch generate, so we have to do it separately for each input prompt.
-        for prompt in request.input:
-            features = self.tokenizer(
-                prompt, return_tensors="pt", **request.preprocessing_kwargs
-            )
-            input_ids = features["input_ids"]
-            input_ids = self._ensure_tensor_on_device(input_ids=input_ids)["input_ids"]
-            request.model_kwargs.update(request.task_kwargs)
-            request.model_kwargs["return_dict_in_generate"] = True
-            res = self.model.generate(input_ids, **request.model_kwargs)
-
-            # put everything on CPU and add it to model_outputs
-            for key in res.keys():
-                if isinstance(res[key], tuple):
-                    if isinstance(res[key][0], tuple):
-                        res[key] = tuple(
-                            (tuple(tensor.cpu() for tensor in tpl)) for tpl in res[key]
-                        )
-                    else:
-                        res[key] = tuple(tensor.cpu() for tensor in res[key])
-                else:
-                    res[key] = res[key].cpu()
-                model_outputs[key].append(res[key])
+        # The prompts are generated in batches. They are padded on the left,
+        # so that the generated tokens directly follow each prompt.
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "left"
+        results = [None] * len(request.input)
+        try:
+            for indices in self._generation_batches(request):
+                prompts = [request.input[i] for i in indices]
+                with metrics.timer("tokenization"):
+                    features = self.tokenizer(
+                        prompts, return_tensors="pt", **request.preprocessing_kwargs
+                    )
+                features = self._ensure_tensor_on_device(
+                    input_ids=features["input_ids"],
+                    attention_mask=features["attention_mask"],
+                )
+                metrics.observe_batch(len(prompts), features["attention_mask"])
+                with metrics.timer("forward"), self._precision_context():
+                    res = self.model.generate(**features, **request.model_kwargs)
+                if self.precision == "bf16":
+                    res = self._to_float32(res)
+
+                for idx, prompt_res in zip(indices, self._split_generation_output(res, features["attention_mask"])):
+                    results[idx] = prompt_res
+        finally:
+            self.tokenizer.padding_side = padding_side
+
+        for prompt_res in results:
+            for key in prompt_res.keys():
+                model_outputs[key].append(prompt_res[key])
 
             generated_texts = [
                 self.tokenizer.decode(
@@ -734,13 +1064,72 @@ class Transformer(Model):
                         "clean_up_tokenization_spaces", False
                     ),
                 )
-                for seq in res["sequences"]
+                for seq in prompt_res["sequences"]
             ]
             task_outputs["generated_texts"].append(generated_texts)
         return PredictionOutputForGeneration(
             model_outputs=model_outputs, **task_outputs
         )
 
+    def _generation_batches(self, request: PredictionRequest) -> List[List[int]]:
+        """
+        Groups the prompts into batches of at most BATCH_SIZE prompts.
+        max_length (also the default limit) and min_length of decoder-only models count the prompt,
+        and thereby also its left padding in the batch. Unless the request only limits the generation with
+        max_new_tokens, only prompts of the same length are generated together, so that each prompt gets
+        the same limits as if it was generated on its own.
+        Args:
+            request: the generation request
+        Returns:
+            the indices of the prompts of each batch
+        """
+        kwargs = request.model_kwargs
+        if self.model.config.is_encoder_decoder or ("max_new_tokens" in kwargs and "min_length" not in kwargs):
+            lengths = [0] * len(request.input)
+        else:
+            features = self.tokenizer(request.input, **{**request.preprocessing_kwargs, "padding": False})
+            lengths = [len(input_ids) for input_ids in features["input_ids"]]
+
+        groups = defaultdict(list)
+        for idx, length in enumerate(lengths):
+            groups[length].append(idx)
+        return [
+            indices[start: start + model_config.batch_size]
+            for indices in groups.values()
+            for start in range(0, len(indices), model_config.batch_size)
+        ]
+
+    def _split_generation_output(
+            self, res, attention_mask: torch.Tensor
+    ) -> List[Dict[str, Any]]:
+        """
+        Splits the output of generating a batch of prompts into the outputs of each prompt.
+        The left padding of the prompts is removed from the generated sequences.
+        Args:
+            res: the output of model.generate for the batch
+            attention_mask: the attention mask of the left-padded prompts
+        Returns:
+            the generation outputs for each prompt, moved to the CPU
+        """
+        num_prompts = attention_mask.shape[0]
+        num_padding = (attention_mask.shape[1] - attention_mask.sum(dim=1)).tolist()
+
+        def split(value, idx):
+            # the rows of each prompt (e.g. for beams or multiple return sequences) are consecutive
+            if isinstance(value, tuple):
+                return tuple(split(v, idx) for v in value)
+            rows = value.shape[0] // num_prompts
+            return value[idx * rows: (idx + 1) * rows].cpu()
+
+        outputs = []
+        for idx in range(num_prompts):
+            output = {key: split(value, idx) for key, value in res.items()}
+            # decoder-only models return the prompt as part of the generated sequence
+            if not self.model.config.is_encoder_decoder:
+                output["sequences"] = output["sequences"][:, num_padding[idx]:]
+            outputs.append(output)
+        return outputs
+
     def _question_answering(self, request: PredictionRequest) -> PredictionOutput:
         """
         Span-based question answering for a given question and context.
@@ -751,137 +1140,67 @@ class Transformer(Model):
 
         # Making heavy use of https://huggingface.co/transformers/
         # _modules/transformers/pipelines/question_answering.html#QuestionAnsweringPipeline
-        def decode(
-                start_: np.ndarray,
-                end_: np.ndarray,
-                topk: int,
-                max_answer_len: int,
-                undesired_tokens_: np.ndarray,
-        ) -> Tuple:
-            """
-            Take the output of any :obj:`ModelForQuestionAnswering` and
-                will generate probabilities for each span to be the
-                actual answer.
-            In addition, it filters out some unwanted/impossible cases
-            like answer len being greater than max_answer_len or
-            answer end position being before the starting position.
-            The method supports output the k-best answer through
-            the topk argument.
-            Args:
-                start_ (:obj:`np.ndarray`): Individual start
-                    probabilities for each token.
-                end (:obj:`np.ndarray`): Individual end_ probabilities
-                    for each token.
-                topk (:obj:`int`): Indicates how many possible answer
-                    span(s) to extract from the model output.
-                max_answer_len (:obj:`int`): Maximum size of the answer
-                    to extract from the model's output.
-                undesired_tokens_ (:obj:`np.ndarray`): Mask determining
-                    tokens that can be part of the answer
-            """
-            # Ensure we have batch axis
-            if start_.ndim == 1:
-                start_ = start_[None]
-
-            if end_.ndim == 1:
-                end_ = end_[None]
-
-            # Compute the score of each tuple(start_, end_) to be the real answer
-            outer = np.matmul(np.expand_dims(start_, -1), np.expand_dims(end_, 1))
-
-            # Remove candidate with end_ < start_ and end_ - start_ > max_answer_len
-            candidates = np.tril(np.triu(outer), max_answer_len - 1)
-
-            #  Inspired by Chen & al. (https://github.com/facebookresearch/DrQA)
-            scores_flat = candidates.flatten()
-            if topk == 1:
-                idx_sort = [np.argmax(scores_flat)]
-            elif len(scores_flat) < topk:
-                idx_sort = np.argsort(-scores_flat)
-            else:
-                idx = np.argpartition(-scores_flat, topk)[0:topk]
-                idx_sort = idx[np.argsort(-scores_flat[idx])]
-
-            starts_, ends_ = np.unravel_index(idx_sort, candidates.shape)[1:]
-            desired_spans = np.isin(starts_, undesired_tokens_.nonzero()) & np.isin(
-                ends_, undesired_tokens_.nonzero()
-            )
-            starts_ = starts_[desired_spans]
-            ends_ = ends_[desired_spans]
-            scores_ = candidates[0, starts_, ends_]
-
-            return starts_, ends_, scores_
-
         request.preprocessing_kwargs["truncation"] = "only_second"
+        request.preprocessing_kwargs["return_offsets_mapping"] = True
         predictions, features = self._predict(request, output_features=True)
+        request.preprocessing_kwargs.pop("return_offsets_mapping")
+        offsets = features.pop("offset_mapping").numpy()
 
         task_outputs = {
             "answers": [],
             "attributions": [],
             "adversarial": {"indices": [], },  # for hotflip, input_reduction and topk
         }
-        for idx, (start, end, (_, context)) in enumerate(
-                zip(predictions["start_logits"], predictions["end_logits"], request.input)
-        ):
-            start = start.numpy()
-            end = end.numpy()
-            # Ensure padded tokens & question tokens cannot
-            # belong to the set of candidate answers.
-            question_tokens = np.abs(
-                np.array([s != 1 for s in features.sequence_ids(idx)]) - 1
-            )
-            # Unmask CLS token for 'no answer'
-            question_tokens[0] = 1
-            undesired_tokens = question_tokens & features["attention_mask"][idx].numpy()
-
-            # Generate mask
-            undesired_tokens_mask = undesired_tokens == 0.0
-
-            # Make sure non-context indexes in the tensor cannot
-            # contribute to the softmax
-            start = np.where(undesired_tokens_mask, -10000.0, start)
-            end = np.where(undesired_tokens_mask, -10000.0, end)
+        # Ensure padded tokens & question tokens cannot
+        # belong to the set of candidate answers.
+        sequence_ids = np.array(
+            [features.sequence_ids(i) for i in range(len(request.input))], dtype=float
+        )
+        context_tokens = torch.from_numpy(sequence_ids == 1) & features["attention_mask"].bool()
+        # Unmask CLS token for 'no answer'
+        context_tokens[:, 0] = True
+        topk = request.task_kwargs.get("topk", 1)
+        starts, ends, scores, no_answer_scores = self._decode_spans(
+            predictions["start_logits"],
+            predictions["end_logits"],
+            context_tokens,
+            topk,
+            request.task_kwargs.get("max_answer_len", 128),
+        )
+        word_ids = np.array(
+            [features.word_ids(i) for i in range(len(request.input))], dtype=float
+        )
+        word_ids[sequence_ids != 1] = np.nan
+        start_chars, end_chars = self._span_char_offsets(
+            word_ids, offsets, starts.numpy(), ends.numpy()
+        )
 
-            start = np.exp(
-                start - np.log(np.sum(np.exp(start), axis=-1, keepdims=True))
-            )
-            end = np.exp(end - np.log(np.sum(np.exp(end), axis=-1, keepdims=True)))
-
-            # Get score for 'no answer' then mask for decoding step (CLS token
-            no_answer_score = (start[0] * end[0]).item()
-            start[0] = end[0] = 0.0
-
-            starts, ends, scores = decode(
-                start,
-                end,
-                request.task_kwargs.get("topk", 1),
-                request.task_kwargs.get("max_answer_len", 128),
-                undesired_tokens,
-            )
+        for idx, (_, context) in enumerate(request.input):
+            # spans with a score of 0 contain masked tokens
+            found = (scores[idx] > 0).numpy()
             enc = features[idx]
-            self.original_ans_start = enc.token_to_word(starts[0])
-            self.original_ans_end = enc.token_to_word(ends[0])
+            if found.any():
+                self.original_ans_start = enc.token_to_word(starts[idx][0].item())
+                self.original_ans_end = enc.token_to_word(ends[idx][0].item())
             answers = [
                 {
-                    "score": score.item(),
-                    "start": enc.word_to_chars(enc.token_to_word(s), sequence_index=1)[
-                        0
-                    ],
-                    "end": enc.word_to_chars(enc.token_to_word(e), sequence_index=1)[1],
-                    "answer": context[
-                              enc.word_to_chars(enc.token_to_word(s), sequence_index=1)[
-                                  0
-                              ]: enc.word_to_chars(enc.token_to_word(e), sequence_index=1)[1]
-                              ],
+                    "score": score,
+                    "start": start_char,
+                    "end": end_char,
+                    "answer": context[start_char:end_char],
                 }
-                for s, e, score in zip(starts, ends, scores)
+                for start_char, end_char, score in zip(
+                    start_chars[idx][found].tolist(),
+                    end_chars[idx][found].tolist(),
+                    scores[idx][found].tolist(),
+                )
             ]
             if request.task_kwargs.get("show_null_answers", True):
                 answers.append(
-                    {"score": no_answer_score, "start": 0, "end": 0, "answer": ""}
+                    {"score": no_answer_scores[idx].item(), "start": 0, "end": 0, "answer": ""}
                 )
             answers = sorted(answers, key=lambda x: x["score"], reverse=True)[
-                      : request.task_kwargs.get("topk", 1)
+                      : topk
                       ]
             task_outputs["answers"].append(answers)
 
@@ -942,12 +1261,92 @@ class Transformer(Model):
             model_outputs=predictions, **task_outputs
         )
 
+    @staticmethod
+    def _decode_spans(
+            start_logits: torch.Tensor,
+            end_logits: torch.Tensor,
+            context_tokens: torch.Tensor,
+            topk: int,
+            max_answer_len: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Finds the k-best answer spans for a batch of question answering outputs.
+        Only spans with end >= start and at most max_answer_len tokens are scored, so the
+        scores form a band of width max_answer_len instead of the full seq x seq matrix.
+        Args:
+            start_logits: the start logits with shape (batch, seq)
+            end_logits: the end logits with shape (batch, seq)
+            context_tokens: mask of the tokens that can be part of an answer
+                and of the CLS token for 'no answer'
+            topk: the number of spans to extract for each input
+            max_answer_len: the maximum number of tokens of an answer
+        Returns:
+            the start and end token indices and the probabilities of the spans with shape (batch, topk)
+            and the probabilities for 'no answer' with shape (batch,).
+            Spans containing masked tokens have a probability of 0.
+        """
+        # Make sure non-context indexes in the tensor cannot
+        # contribute to the softmax
+        start = torch.log_softmax(start_logits.masked_fill(~context_tokens, -10000.0), dim=-1)
+        end = torch.log_softmax(end_logits.masked_fill(~context_tokens, -10000.0), dim=-1)
+
+        # Get score for 'no answer' then mask for decoding step (CLS token)
+        no_answer_scores = torch.exp(start[:, 0] + end[:, 0])
+        start = start.masked_fill(~context_tokens, -float("inf"))
+        end = end.masked_fill(~context_tokens, -float("inf"))
+        start[:, 0] = end[:, 0] = -float("inf")
+
+        # band[b, s, w] is the log probability of the span from token s to token s + w
+        batch_size, seq_len = start.shape
+        width = min(max_answer_len, seq_len)
+        end = torch.cat([end, end.new_full((batch_size, width - 1), -float("inf"))], dim=1)
+        band = start.unsqueeze(-1) + end.unfold(1, width, 1)
+
+        scores, idx = torch.topk(band.reshape(batch_size, -1), min(topk, seq_len * width), dim=-1)
+        starts = torch.div(idx, width, rounding_mode="floor")
+        ends = starts + idx % width
+        return starts, ends, torch.exp(scores), no_answer_scores
+
+    @staticmethod
+    def _span_char_offsets(
+            word_ids: np.ndarray, offsets: np.ndarray, starts: np.ndarray, ends: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Maps the token spans to character spans in the context, extended to full words.
+        Args:
+            word_ids: the word index of each token with shape (batch, seq), NaN for tokens outside the context
+            offsets: the character offsets of each token with shape (batch, seq, 2)
+            starts: the start token indices of the spans with shape (batch, topk)
+            ends: the end token indices of the spans with shape (batch, topk)
+        Returns:
+            the start and end character offsets of the spans
+        """
+        positions = np.arange(word_ids.shape[1])
+        padding = np.full((word_ids.shape[0], 1), np.nan)
+        # NaN never equals NaN, so tokens outside the context are their own words
+        first_of_word = word_ids != np.concatenate([padding, word_ids[:, :-1]], axis=1)
+        last_of_word = word_ids != np.concatenate([word_ids[:, 1:], padding], axis=1)
+        # index of the first/ last token of the word of each token
+        word_start = np.maximum.accumulate(np.where(first_of_word, positions, 0), axis=1)
+        word_end = np.flip(
+            np.minimum.accumulate(np.flip(np.where(last_of_word, positions, positions[-1]), axis=1), axis=1),
+            axis=1,
+        )
+        start_tokens = np.take_along_axis(word_start, starts, axis=1)
+        end_tokens = np.take_along_axis(word_end, ends, axis=1)
+        start_chars = np.take_along_axis(offsets[:, :, 0], start_tokens, axis=1)
+        end_chars = np.take_along_axis(offsets[:, :, 1], end_tokens, axis=1)
+        return start_chars, end_chars
+
     def _model_attacks(
             self, request: PredictionRequest, task_outputs
     ) -> PredictionOutput:
         """
         Perform attacks on the model output.
+        All perturbed variants of the instance are built at once and predicted as one batch.
+        The time for building and predicting the variants is reported in the adversarial outputs.
         """
+        start_time = time.perf_counter()
 
         if request.attack_kwargs["method"] == "hotflip":
 
@@ -977,9 +1376,8 @@ class Transformer(Model):
                 ans_start=ans_start, ans_end=ans_end
             )
             contexts = batch_request.pop("contexts")
-            predictions = self.predict(
-                PredictionRequest(**batch_request), task=self.task
-            )
+            attack_time = time.perf_counter() - start_time
+            predictions = self._predict_variants(batch_request)
             predictions.contexts = contexts
             predictions.adversarial["indices"] = indices
 
@@ -989,9 +1387,8 @@ class Transformer(Model):
             )
             batch_request, indices = attack.attack_instance()
             questions = batch_request.pop("questions")
-            predictions = self.predict(
-                PredictionRequest(**batch_request), task=self.task
-            )
+            attack_time = time.perf_counter() - start_time
+            predictions = self._predict_variants(batch_request)
             predictions.model_outputs.pop("attentions", None)
             predictions.questions = questions
             predictions.adversarial["indices"] = indices
@@ -1010,15 +1407,49 @@ class Transformer(Model):
                 )
                 batch_request, indices = attack.attack_instance()
             contexts = batch_request.pop("contexts")
-            predictions = self.predict(
-                PredictionRequest(**batch_request), task=self.task
-            )
+            attack_time = time.perf_counter() - start_time
+            predictions = self._predict_variants(batch_request)
             predictions.model_outputs.pop("attentions", None)
             predictions.contexts = contexts
             predictions.adversarial["indices"] = indices
-        # logger.info(predictions)
+        else:
+            raise ValueError(f"Unknown attack method {request.attack_kwargs['method']}")
+
+        predictions.adversarial["metrics"] = {
+            "num_variants": len(batch_request["input"]),
+            "attack_time": attack_time,
+            "prediction_time": time.perf_counter() - start_time - attack_time,
+        }
+        logger.info(
+            f"Attack {request.attack_kwargs['method']}: {predictions.adversarial['metrics']}"
+        )
         return predictions
 
+    def _predict_variants(self, batch_request: dict) -> PredictionOutput:
+        """
+        Predict the perturbed variants of an attacked instance in one batch.
+        The variants are derived from an already validated request,
+        so they are passed to the task directly instead of going through predict again.
+        """
+        request = PredictionRequest(**batch_request)
+        if self.task == Task.question_answering:
+            return self._question_answering(request)
+        return self._sequence_classification(request)
+
+    def can_batch(self, request: PredictionRequest, task: Task) -> bool:
+        """
+        Plain requests for the classification, embedding and question answering tasks can be merged.
+        Explanations, attacks and additional model outputs (e.g. attentions) depend on the whole request.
+        """
+        return (
+                task in BATCHABLE_TASKS
+                and isinstance(request.input, list)
+                and not request.is_preprocessed
+                and not request.explain_kwargs
+                and not request.attack_kwargs
+                and not request.model_kwargs
+        )
+
     def predict(self, request: PredictionRequest, task: Task) -> PredictionOutput:
         """
         The selector prediction function that calls the
@@ -0,0 +1,231 @@
+import logging
+import os
+import sys
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# arrays of the index, each stored as <name>.npy in the index directory
+ARRAYS = ["offsets", "targets", "relations", "weights", "simple_offsets", "simple_neighbors"]
+
+
+class ConceptNetIndex:
+    """
+    Compact, read-only ConceptNet graph in CSR format.
+
+    The directed (multi-)edges of node u are targets[offsets[u]:offsets[u + 1]] with their
+    relation ids and weights, sorted by target and otherwise in the order of the original graph.
+    The undirected neighbors of node u (the neighbors in cpnet_simple) are
+    simple_neighbors[simple_offsets[u]:simple_offsets[u + 1]], sorted and without duplicates.
+
+    Loaded indices are memory-mapped, so forked worker processes share the pages
+    and startup does not depend on the size of the graph.
+    """
+
+    def __init__(self, offsets, targets, relations, weights, simple_offsets, simple_neighbors):
+        self.offsets = offsets
+        self.targets = targets
+        self.relations = relations
+        self.weights = weights
+        self.simple_offsets = simple_offsets
+        self.simple_neighbors = simple_neighbors
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.offsets) - 1
+
+    @classmethod
+    def from_edges(cls, sources, targets, relations, weights, num_nodes: int):
+        """
+        Build the index from the directed edges of the graph
+
+        Args:
+             sources: source node id of each edge
+             targets: target node id of each edge
+             relations: relation id of each edge
+             weights: weight of each edge
+             num_nodes: number of nodes, i.e. the size of the ConceptNet vocab
+        """
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        # stable, so multi-edges between two nodes keep their order
+        order = np.lexsort((targets, sources))
+        offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=num_nodes), out=offsets[1:])
+
+        # every directed edge connects both nodes in the undirected graph
+        pairs = np.unique(
+            np.stack([np.concatenate([sources, targets]), np.concatenate([targets, sources])], axis=1), axis=0
+        )
+        simple_offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pairs[:, 0], minlength=num_nodes), out=simple_offsets[1:])
+
+        return cls(
+            offsets=offsets,
+            targets=targets[order].astype(np.int32),
+            relations=np.asarray(relations, dtype=np.int16)[order],
+            weights=np.asarray(weights, dtype=np.float32)[order],
+            simple_offsets=simple_offsets,
+            simple_neighbors=pairs[:, 1].astype(np.int32),
+        )
+
+    @classmethod
+    def from_networkx(cls, graph, num_nodes: int = 0):
+        """
+        Build the index from the networkx MultiDiGraph of ConceptNet
+
+        Args:
+             graph: the graph with 'rel' and optionally 'weight' as edge attributes
+             num_nodes: number of nodes, at least the largest node id + 1 is used
+        """
+        edges = list(graph.edges(data=True))
+        sources = np.array([u for u, _, _ in edges], dtype=np.int64)
+        targets = np.array([v for _, v, _ in edges], dtype=np.int64)
+        relations = np.array([data["rel"] for _, _, data in edges], dtype=np.int16)
+        weights = np.array([data.get("weight", 1.0) for _, _, data in edges], dtype=np.float32)
+        if len(edges):
+            num_nodes = max(num_nodes, int(max(sources.max(), targets.max())) + 1)
+        return cls.from_edges(sources, targets, relations, weights, num_nodes)
+
+    def save(self, path: str):
+        """
+        Store the arrays of the index as .npy files in the directory
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True):
+        """
+        Load an index stored with save
+
+        Args:
+             path: the directory of the index
+             mmap: memory-map the arrays instead of reading them into memory
+        """
+        mmap_mode = "r" if mmap else None
+        return cls(**{name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in ARRAYS})
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return all(os.path.exists(os.path.join(path, f"{name}.npy")) for name in ARRAYS)
+
+    def has_node(self, node: int) -> bool:
+        """
+        Whether the node has any edge, i.e. it is a node of cpnet_simple
+        """
+        return bool(0 <= node < self.num_nodes and self.simple_offsets[node + 1] > self.simple_offsets[node])
+
+    def neighbors(self, node: int) -> np.ndarray:
+        """
+        The sorted neighbors of the node in the undirected graph
+        """
+        return self.simple_neighbors[self.simple_offsets[node]:self.simple_offsets[node + 1]]
+
+    def has_edge(self, source: int, target: int) -> bool:
+        """
+        Whether the nodes are connected in the undirected graph
+        """
+        neighbors = self.neighbors(source)
+        i = np.searchsorted(neighbors, target)
+        return bool(i < len(neighbors) and neighbors[i] == target)
+
+    def common_neighbors(self, nodes) -> np.ndarray:
+        """
+        All nodes that are neighbors of at least two different nodes of the given nodes,
+        i.e. the union of the common neighbors of all pairs of nodes
+
+        Returns:
+            the sorted node ids
+        """
+        nodes = [node for node in set(nodes) if self.has_node(node)]
+        if len(nodes) < 2:
+            return np.zeros(0, dtype=np.int64)
+        # the neighbors of a node are unique, so a node that occurs twice is a neighbor of two nodes
+        candidates, counts = np.unique(
+            np.concatenate([self.neighbors(node) for node in nodes]), return_counts=True
+        )
+        return candidates[counts >= 2].astype(np.int64)
+
+    def edges_between(self, nodes):
+        """
+        All directed edges between the given nodes
+
+        Args:
+             nodes: unique node ids
+
+        Returns:
+            position of the source and target in nodes, relation id and weight of each edge,
+            sorted by source and target position
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        if len(nodes) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty, np.zeros(0, dtype=np.float32)
+        order = np.argsort(nodes, kind="stable")
+        if np.any(nodes[order][1:] == nodes[order][:-1]):
+            raise ValueError("The node ids have to be unique")
+        starts = self.offsets[nodes]
+        lengths = self.offsets[nodes + 1] - starts
+        # indices of all outgoing edges of the nodes
+        edge_starts = np.cumsum(lengths) - lengths
+        edges = np.arange(lengths.sum()) - np.repeat(edge_starts - starts, lengths)
+        source_pos = np.repeat(np.arange(len(nodes)), lengths)
+
+        targets = np.asarray(self.targets[edges], dtype=np.int64)
+        i = np.minimum(np.searchsorted(nodes, targets, sorter=order), len(nodes) - 1)
+        target_pos = order[i]
+        keep = nodes[target_pos] == targets
+
+        source_pos, target_pos, edges = source_pos[keep], target_pos[keep], edges[keep]
+        order = np.lexsort((np.arange(len(edges)), target_pos, source_pos))
+        return (
+            source_pos[order],
+            target_pos[order],
+            np.asarray(self.relations[edges[order]], dtype=np.int64),
+            np.asarray(self.weights[edges[order]], dtype=np.float32),
+        )
+
+    def adjacency(self, nodes, num_relations: int) -> np.ndarray:
+        """
+        Adjacency tensor of the subgraph of the given nodes. Edges with relation ids outside
+        of [0, num_relations), e.g. the reversed relations, are ignored.
+
+        Returns:
+            array of shape (num_relations, len(nodes), len(nodes)) with 1 for every edge
+        """
+        adj = np.zeros((num_relations, len(nodes), len(nodes)), dtype=np.uint8)
+        source_pos, target_pos, relations, _ = self.edges_between(nodes)
+        keep = (relations >= 0) & (relations < num_relations)
+        adj[relations[keep], source_pos[keep], target_pos[keep]] = 1
+        return adj
+
+
+def convert(graph_path: str, vocab_path: str, index_path: str) -> ConceptNetIndex:
+    """
+    Convert the pickled networkx graph of ConceptNet to a ConceptNetIndex
+
+    Args:
+         graph_path: path of the gpickle file, e.g. conceptnet.en.pruned.graph
+         vocab_path: path of the ConceptNet vocab with one concept per line, e.g. concept.txt.
+            Every concept gets a node, including the concepts without edges at the end of the vocab.
+         index_path: directory where the index is stored
+    """
+    import networkx as nx
+
+    with open(vocab_path, "r", encoding="utf8") as fin:
+        num_nodes = sum(1 for _ in fin)
+    logger.info(f"Converting {graph_path} with {num_nodes} concepts to {index_path}")
+    index = ConceptNetIndex.from_networkx(nx.read_gpickle(graph_path), num_nodes)
+    index.save(index_path)
+    return index
+
+
+if __name__ == "__main__":
+    # python cpnet_index.py conceptnet.en.pruned.graph concept.txt conceptnet.en.pruned.csr
+    if len(sys.argv) != 4:
+        sys.exit(f"usage: {sys.argv[0]} <graph path> <vocab path> <index path>")
+    logging.basicConfig(level=logging.INFO)
+    convert(sys.argv[1], sys.argv[2], sys.argv[3])
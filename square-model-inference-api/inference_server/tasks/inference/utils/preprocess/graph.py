@@ -4,8 +4,9 @@ import numpy as np
 from scipy.sparse import coo_matrix
 # from multiprocessing import Pool
 from billiard.pool import Pool
-from concurrent.futures import ThreadPoolExecutor
 from collections import OrderedDict
+from contextlib import ExitStack
+import threading
 import time
 
 
@@ -13,9 +14,8 @@ concept2id = None
 id2concept = None
 
 
-cpnet = None
-cpnet_all = None
-cpnet_simple = None
+# ConceptNetIndex with the directed edges (cpnet) and the undirected neighbors (cpnet_simple)
+cpnet_index = None
 
 merged_relations = [
     'antonym',
@@ -41,86 +41,149 @@ id2relation = merged_relations
 relation2id = {r: i for i, r in enumerate(id2relation)}
 
 
+def init_worker(_cpnet_vocab, _cpnet_index):
+    """
+    Sets the read-only ConceptNet resources used by the graph construction. Used as
+    initializer of long-lived worker pools, so that the resources are only passed
+    to each worker once.
+    """
+    global id2concept, cpnet_index
+    id2concept = _cpnet_vocab
+    cpnet_index = _cpnet_index
+
+
 def concepts2adj(node_ids):
     cids = np.array(node_ids, dtype=np.int32)
     n_rel = len(id2relation)
     n_node = cids.shape[0]
-    adj = np.zeros((n_rel, n_node, n_node), dtype=np.uint8)
-    for s in range(n_node):
-        for t in range(n_node):
-            s_c, t_c = cids[s], cids[t]
-            if cpnet.has_edge(s_c, t_c):
-                for e_attr in cpnet[s_c][t_c].values():
-                    # print("edge attributes:", e_attr)
-                    if e_attr['rel'] >= 0 and e_attr['rel'] < n_rel:
-                        adj[e_attr['rel']][s][t] = 1
+    adj = cpnet_index.adjacency(cids, n_rel)
     # cids += 1  # note!!! index 0 is reserved for padding
     adj = coo_matrix(adj.reshape(-1, n_node))
     return adj, cids
 
 
-def get_LM_score(cids, question, model, tokenizer):
-    cids = cids[:]
-    cids.insert(0, -1)   # QAcontext node
-    sents, scores = [], []
-    sents = [
-        tokenizer.encode(
-            question.lower(),
-            add_special_tokens=True
-        )
-        if cid == -1
-        else tokenizer.encode(
-            '{} {}.'.format(
-                question.lower(),
-                ' '.join(id2concept[cid].split('_'))
-            ),
-            add_special_tokens=True)
-        for cid in cids
-    ]
-    n_cids = len(cids)
-    # print(n_cids)
-    cur_idx = 0
-    batch_size = 128
-    while cur_idx < n_cids:
-        # Prepare batch
-        input_ids = sents[cur_idx: cur_idx+batch_size]
-        max_len = max([len(seq) for seq in input_ids])
-        for j, seq in enumerate(input_ids):
-            seq += [tokenizer.pad_token_id] * (max_len-len(seq))
-            input_ids[j] = seq
-        input_ids = torch.tensor(input_ids)
-        mask = (input_ids != 1).long()
-        # Get LM score
-        with torch.no_grad():
-            outputs = model(
-                input_ids,
-                attention_mask=mask,
-                masked_lm_labels=input_ids
-            )
-            loss = outputs[0]  # [B, ]
-            _scores = list(-loss.detach().cpu().numpy())
-        scores += _scores
-        cur_idx += batch_size
-    assert len(sents) == len(scores) == len(cids)
-    cid2score = OrderedDict(
-        sorted(list(zip(cids, scores)),
-               key=lambda x: -x[1])
-    )  # score: from high to low
-
-    return cid2score
+class LMScorer:
+    """
+    Scores the relevance of concepts for QA contexts with the loss of a masked LM
+    on the sentence "<context> <concept>.". The context alone is scored as node -1.
+
+    The sentences of all contexts are scored in one stage: duplicate sentences are scored
+    once, sentences are sorted by length so that batches need little padding, and each
+    batch is filled up to max_tokens tokens. Scores are cached per (context, concept),
+    so repeated questions do not reach the LM again.
+    """
+
+    def __init__(self, model, tokenizer, max_tokens=8192, max_batch_size=128, cache_size=0):
+        """
+        Args:
+             model: RobertaForMaskedLMwithLoss in eval mode
+             tokenizer: the tokenizer of the model
+             max_tokens: maximum number of tokens (incl. padding) of a batch
+             max_batch_size: maximum number of sentences of a batch
+             cache_size: maximum number of cached scores, 0 disables the cache
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.cache_size = cache_size
+        # (context, concept id) -> score, ordered from least to most recently used
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def score(self, queries):
+        """
+        Args:
+             queries: (concept ids, context) for each QA context
+
+        Returns:
+            for each query, the scores of the context node -1 and all concept ids,
+            from high to low
+        """
+        keys = [
+            [(context.lower(), cid) for cid in [-1] + list(cids)]
+            for cids, context in queries
+        ]
+        scores = self._get_cached(key for query_keys in keys for key in query_keys)
+        missing = list(dict.fromkeys(
+            key for query_keys in keys for key in query_keys if key not in scores
+        ))
+        if missing:
+            computed = self._score_sentences([self._sentence(*key) for key in missing])
+            computed = dict(zip(missing, computed))
+            self._put_cached(computed)
+            scores.update(computed)
+
+        return [
+            OrderedDict(sorted(
+                [(cid, scores[(context, cid)]) for context, cid in query_keys],
+                key=lambda x: -x[1]
+            ))  # score: from high to low
+            for query_keys in keys
+        ]
+
+    @staticmethod
+    def _sentence(context, cid):
+        if cid == -1:
+            return context
+        return '{} {}.'.format(context, ' '.join(id2concept[cid].split('_')))
+
+    def _score_sentences(self, sentences):
+        """
+        Negative LM loss of each sentence
+        """
+        input_ids = self.tokenizer(sentences, add_special_tokens=True)["input_ids"]
+        order = sorted(range(len(input_ids)), key=lambda i: len(input_ids[i]))
+        device = next(self.model.parameters()).device
+        scores = [None] * len(input_ids)
+
+        start = 0
+        while start < len(order):
+            # sentences are sorted by length, so the last one determines the padded length
+            end = start + 1
+            while end < len(order) and end - start < self.max_batch_size \
+                    and (end - start + 1) * len(input_ids[order[end]]) <= self.max_tokens:
+                end += 1
+            batch = order[start:end]
+            max_len = len(input_ids[batch[-1]])
+            ids = torch.full((len(batch), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+            mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+            for j, i in enumerate(batch):
+                ids[j, :len(input_ids[i])] = torch.tensor(input_ids[i])
+                mask[j, :len(input_ids[i])] = 1
+            ids, mask = ids.to(device), mask.to(device)
+            with torch.no_grad():
+                loss = self.model(ids, attention_mask=mask, masked_lm_labels=ids)[0]  # [B, ]
+            for i, value in zip(batch, (-loss).tolist()):
+                scores[i] = value
+            start = end
+        return scores
+
+    def _get_cached(self, keys):
+        if not self.cache_size:
+            return {}
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    found[key] = self._cache[key]
+        return found
+
+    def _put_cached(self, scores):
+        if not self.cache_size:
+            return
+        with self._lock:
+            self._cache.update(scores)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
 
 
 def concepts_to_adj_matrices_part1(data):
     qc_ids, ac_ids, question = data
     qa_nodes = set(qc_ids) | set(ac_ids)
-    extra_nodes = set()
-
-    for qid in qa_nodes:
-        for aid in qa_nodes:
-            if qid != aid and qid in cpnet_simple.nodes \
-                    and aid in cpnet_simple.nodes:
-                extra_nodes |= set(cpnet_simple[qid]) &\
-                               set(cpnet_simple[aid])  # list of node ids
+    # common neighbors of all pairs of question and answer concepts
+    extra_nodes = set(cpnet_index.common_neighbors(qa_nodes).tolist())
     extra_nodes = extra_nodes - qa_nodes
 
     return (
@@ -156,11 +219,12 @@ def generate_adj_data_from_grounded_concepts__use_LM(
         grounded,
         concept2id,
         _cpnet_vocab,
-        _cpnet,
-        _cpnet_simple,
+        _cpnet_index,
         model,
         tokenizer,
-        num_processes=1
+        num_processes=1,
+        pool=None,
+        scorer=None,
 ):
     """
     This function will save
@@ -175,23 +239,18 @@ def generate_adj_data_from_grounded_concepts__use_LM(
 
     statement_json: json (dict)
     grounded: 5 dicts as
-    cpnet_graph_path: str
-    cpnet_vocab_path: str
+    _cpnet_vocab: list of concepts
+    _cpnet_index: ConceptNetIndex
 
     num_processes: int
+    pool: worker pool initialized with init_worker, a new pool
+        with num_processes workers is created for this call if None
+    scorer: LMScorer for the relevance scores, a new one without
+        cache is created for this call if None
     """
     # print(concept2id)
-    global cpnet
-    cpnet = _cpnet
-    del _cpnet
-
-    global cpnet_simple
-    cpnet_simple = _cpnet_simple
-    del _cpnet_simple
-
-    global id2concept
-    id2concept = _cpnet_vocab
-    del _cpnet_vocab
+    init_worker(_cpnet_vocab, _cpnet_index)
+    del _cpnet_index, _cpnet_vocab
 
     qa_data = []
     for ex in grounded:
@@ -204,30 +263,27 @@ def generate_adj_data_from_grounded_concepts__use_LM(
         qa_data.append((q_ids, a_ids, QAcontext))
 
     # start = time.time()
-    with Pool(num_processes) as p:
-        res1 = list(tqdm(p.imap(
+    with ExitStack() as stack:
+        # pools that are not passed in only live for this call
+        if pool is None:
+            pool = stack.enter_context(Pool(num_processes))
+
+        res1 = list(tqdm(pool.imap(
             concepts_to_adj_matrices_part1,
             qa_data),
             total=len(qa_data)
         ))
 
-    global concepts_to_adj_matrices_part2
-    def concepts_to_adj_matrices_part2(data):
-        qc_ids, ac_ids, question, extra_nodes = data
-        cid2score = get_LM_score(
-            qc_ids + ac_ids + extra_nodes,
-            question,
-            model,
-            tokenizer
-        )
-        return (qc_ids, ac_ids, question, extra_nodes, cid2score)
-
-    workers = 5
-    with ThreadPoolExecutor(workers) as pool:
-        res2= list(pool.map(concepts_to_adj_matrices_part2, res1))
-
-    with Pool(num_processes) as p:
-        res3 = list(tqdm(p.imap(
+        # the relevance scores of all answer choices are computed together
+        if scorer is None:
+            scorer = LMScorer(model, tokenizer)
+        cid2scores = scorer.score([
+            (qc_ids + ac_ids + extra_nodes, question)
+            for qc_ids, ac_ids, question, extra_nodes in res1
+        ])
+        res2 = [data + (cid2score,) for data, cid2score in zip(res1, cid2scores)]
+
+        res3 = list(tqdm(pool.imap(
             concepts_to_adj_matrices_part3,
             res2),
             total=len(res2)
@@ -1,8 +1,11 @@
 import multiprocessing
-# import multiprocessing.pool
+import multiprocessing.pool
 # from multiprocessing import Pool
+import threading
+from collections import OrderedDict
 from billiard.pool import Pool
-from spacy.matcher import Matcher
+from spacy.matcher import PhraseMatcher
+from spacy.tokens import Doc
 from tqdm import tqdm
 import nltk
 
@@ -19,11 +22,21 @@ blacklist = {"-PRON-", "actually", "likely", "possibly", "want",
 nltk.download('stopwords', quiet=True)
 nltk_stopwords = nltk.corpus.stopwords.words('english')
 
+# concepts with spaces instead of underscores (for hard grounding) and the original concepts
 CPNET_VOCAB = None
+CONCEPTS = None
+_vocab_source = None
 PATTERN_PATH = None
 nlp = None
 matcher = None
 
+# maximum number of qa pairs that are grounded in one task of the worker pool
+GROUNDING_CHUNK_SIZE = 16
+# concept -> lemmatized concept, ordered from least to most recently used
+LEMMA_CACHE = OrderedDict()
+LEMMA_CACHE_SIZE = 100000
+LEMMA_CACHE_LOCK = threading.Lock()
+
 
 
 class NoDaemonProcess(multiprocessing.Process):
@@ -67,97 +80,192 @@ def create_pattern(nlp, doc, debug=False):
     return pattern
 
 
-def lemmatize(nlp, concept):
+def build_matcher(nlp, patterns):
+    """
+    Compiles the concept patterns (a list of {"LEMMA": ...} token patterns per concept)
+    into a PhraseMatcher on the token lemmas. It finds the same matches as a Matcher with
+    these patterns, but looks up all concepts at once instead of trying every pattern.
+    """
+    phrase_matcher = PhraseMatcher(nlp.vocab, attr="LEMMA")
+    for concept, pattern in patterns.items():
+        lemmas = [token["LEMMA"] for token in pattern]
+        phrase_matcher.add(concept, [Doc(nlp.vocab, words=lemmas, lemmas=lemmas)])
+    return phrase_matcher
 
-    doc = nlp(concept.replace("_", " "))
-    lcs = set()
-    lcs.add("_".join([token.lemma_ for token in doc]))  # all lemma
-    return lcs
+
+def lemmatize(nlp, concept):
+    return lemmatize_all(nlp, [concept])[concept]
+
+
+def lemmatize_all(nlp, concepts):
+    """
+    Lemmatizes the concepts, running the pipeline in one batch
+    for all concepts that are not in the lemma cache
+
+    Returns:
+        the set with the lemmatized concept for each concept
+    """
+    lemmas = {}
+    with LEMMA_CACHE_LOCK:
+        for concept in concepts:
+            if concept in LEMMA_CACHE:
+                LEMMA_CACHE.move_to_end(concept)
+                lemmas[concept] = LEMMA_CACHE[concept]
+    missing = [concept for concept in dict.fromkeys(concepts) if concept not in lemmas]
+    docs = nlp.pipe([concept.replace("_", " ") for concept in missing])
+    for concept, doc in zip(missing, docs):
+        lemmas[concept] = "_".join([token.lemma_ for token in doc])  # all lemma
+    with LEMMA_CACHE_LOCK:
+        for concept in missing:
+            LEMMA_CACHE[concept] = lemmas[concept]
+        while len(LEMMA_CACHE) > LEMMA_CACHE_SIZE:
+            LEMMA_CACHE.popitem(last=False)
+    return {concept: {lemma} for concept, lemma in lemmas.items()}
 
 
 def ground_qa_pair(qa_pair):
+    return ground_qa_pairs([qa_pair])[0]
+
+
+def ground_qa_pairs(qa_pairs):
+    """
+    Grounds the statements and answers of all pairs, running
+    the pipeline on all texts in batches
+    """
     global nlp, matcher
-    s, a = qa_pair
-    all_concepts = ground_mentioned_concepts(nlp, matcher, s, a)
-    # print("all", all_concepts)
-    answer_concepts = ground_mentioned_concepts(nlp, matcher, a)
-    # print("ans c", answer_concepts)
-    question_concepts = all_concepts - answer_concepts
-    # print("ques c", question_concepts)
-    if len(question_concepts) == 0:
-        question_concepts = hard_ground(nlp, s, CPNET_VOCAB)  # not very possible
-        # print("ques c new", question_concepts)
-
-    if len(answer_concepts) == 0:
-        answer_concepts = hard_ground(nlp, a, CPNET_VOCAB)  # some case
-        # print("ans c new", answer_concepts)
-
-    # question_concepts = question_concepts -  answer_concepts
-    question_concepts = sorted(list(question_concepts))
-    answer_concepts = sorted(list(answer_concepts))
-    return {"sent": s, "ans": a, "qc": question_concepts, "ac": answer_concepts}
+    texts = []
+    answers = []
+    for s, a in qa_pairs:
+        texts += [s.lower(), a.lower()]
+        answers += [a, None]
+    docs = list(nlp.pipe(texts))
+    # all concepts of the statement except for the answer mentions, and the concepts of the answer
+    sentence_concepts = find_mentioned_concepts(nlp, matcher, docs, answers)
+
+    res = []
+    for i, (s, a) in enumerate(qa_pairs):
+        all_concepts, answer_concepts = sentence_concepts[2 * i], sentence_concepts[2 * i + 1]
+        # print("all", all_concepts)
+        # print("ans c", answer_concepts)
+        question_concepts = all_concepts - answer_concepts
+        # print("ques c", question_concepts)
+        if len(question_concepts) == 0:
+            question_concepts = hard_ground_doc(docs[2 * i], CPNET_VOCAB)  # not very possible
+            # print("ques c new", question_concepts)
+
+        if len(answer_concepts) == 0:
+            answer_concepts = hard_ground_doc(docs[2 * i + 1], CPNET_VOCAB)  # some case
+            # print("ans c new", answer_concepts)
+
+        # question_concepts = question_concepts -  answer_concepts
+        question_concepts = sorted(list(question_concepts))
+        answer_concepts = sorted(list(answer_concepts))
+        res.append({"sent": s, "ans": a, "qc": question_concepts, "ac": answer_concepts})
+    return res
 
 
 def ground_mentioned_concepts(nlp, matcher, s, ans=None):
     s = s.lower()
-    doc = nlp(s)
-    matches = matcher(doc)
-    mentioned_concepts = set()
-    span_to_concepts = {}
-
-    if ans is not None:
-        ans_matcher = Matcher(nlp.vocab)
-        ans_matcher.add(ans, [[{'TEXT': token.text.lower()} for token in nlp.tokenizer.pipe(ans)]])
-
-        ans_match = ans_matcher(doc)
-        ans_mentions = set()
-        for _, ans_start, ans_end in ans_match:
-            ans_mentions.add((ans_start, ans_end))
-
-    for match_id, start, end in matches:
-        if ans is not None:
+    return find_mentioned_concepts(nlp, matcher, [nlp(s)], [ans])[0]
+
+
+def answer_mentions(doc, ans):
+    """
+    Token spans of the doc that are mentions of the answer. Like the
+    former per-answer Matcher, the answer is matched as one token text
+    per character of the answer.
+    """
+    chars = [c.lower() for c in ans]
+    texts = [token.text for token in doc]
+    if not chars:
+        return set()
+    return {
+        (start, start + len(chars))
+        for start in range(len(texts) - len(chars) + 1)
+        if texts[start:start + len(chars)] == chars
+    }
+
+
+def find_mentioned_concepts(nlp, matcher, docs, answers):
+    """
+    Finds the concepts mentioned in each doc, ignoring mentions of the answer (if it is not None).
+    The concepts of all docs are lemmatized together.
+    """
+    span_to_concepts = []
+    for doc, ans in zip(docs, answers):
+        matches = matcher(doc)
+        ans_mentions = answer_mentions(doc, ans) if ans is not None else set()
+        doc_span_to_concepts = {}
+        for match_id, start, end in matches:
             if (start, end) in ans_mentions:
                 continue
 
-        span = doc[start:end].text  # the matched span
-
-        original_concept = nlp.vocab.strings[match_id]
-        original_concept_set = set()
-        original_concept_set.add(original_concept)
-
-        if len(original_concept.split("_")) == 1:
-            original_concept_set.update(lemmatize(nlp, nlp.vocab.strings[match_id]))
-        if span not in span_to_concepts:
-            span_to_concepts[span] = set()
-        span_to_concepts[span].update(original_concept_set)
-
-    for span, concepts in span_to_concepts.items():
-        concepts_sorted = list(concepts)
-        concepts_sorted.sort(key=len)
-        shortest = concepts_sorted[0:3]
-
-        for c in shortest:
-            if c in blacklist:
-                continue
-
-            # a set with one string like: set("like_apples")
-            lcs = lemmatize(nlp, c)
-            intersect = lcs.intersection(shortest)
-            if len(intersect) > 0:
-                mentioned_concepts.add(list(intersect)[0])
-            else:
-                mentioned_concepts.add(c)
-
-        exact_match = set([concept for concept in concepts_sorted
-                           if concept.replace("_", " ").lower() == span.lower()])
-        assert len(exact_match) < 2
-        mentioned_concepts.update(exact_match)
-    return mentioned_concepts
+            span = doc[start:end].text  # the matched span
+            original_concept = nlp.vocab.strings[match_id]
+            doc_span_to_concepts.setdefault(span, []).append(original_concept)
+        span_to_concepts.append(doc_span_to_concepts)
+
+    lemmas = lemmatize_all(nlp, [
+        concept
+        for doc_span_to_concepts in span_to_concepts
+        for concepts in doc_span_to_concepts.values()
+        for concept in concepts
+        if len(concept.split("_")) == 1
+    ])
+    for doc_span_to_concepts in span_to_concepts:
+        for span, concepts in doc_span_to_concepts.items():
+            original_concept_set = set(concepts)
+            for concept in concepts:
+                if len(concept.split("_")) == 1:
+                    original_concept_set.update(lemmas[concept])
+            doc_span_to_concepts[span] = original_concept_set
+
+    shortest_concepts = []
+    for doc_span_to_concepts in span_to_concepts:
+        doc_shortest = {}
+        for span, concepts in doc_span_to_concepts.items():
+            concepts_sorted = list(concepts)
+            concepts_sorted.sort(key=len)
+            doc_shortest[span] = (concepts_sorted, concepts_sorted[0:3])
+        shortest_concepts.append(doc_shortest)
+    lemmas = lemmatize_all(nlp, [
+        c
+        for doc_shortest in shortest_concepts
+        for _, shortest in doc_shortest.values()
+        for c in shortest
+        if c not in blacklist
+    ])
+
+    res = []
+    for doc_shortest in shortest_concepts:
+        mentioned_concepts = set()
+        for span, (concepts_sorted, shortest) in doc_shortest.items():
+            for c in shortest:
+                if c in blacklist:
+                    continue
+
+                # a set with one string like: set("like_apples")
+                lcs = lemmas[c]
+                intersect = lcs.intersection(shortest)
+                if len(intersect) > 0:
+                    mentioned_concepts.add(list(intersect)[0])
+                else:
+                    mentioned_concepts.add(c)
+
+            exact_match = set([concept for concept in concepts_sorted
+                               if concept.replace("_", " ").lower() == span.lower()])
+            assert len(exact_match) < 2
+            mentioned_concepts.update(exact_match)
+        res.append(mentioned_concepts)
+    return res
 
 
 def hard_ground(nlp, sent, cpnet_vocab):
     sent = sent.lower()
-    doc = nlp(sent)
+    return hard_ground_doc(nlp(sent), cpnet_vocab)
+
+
+def hard_ground_doc(doc, cpnet_vocab):
     res = set()
     for t in doc:
         if t.lemma_ in cpnet_vocab:
@@ -172,9 +280,29 @@ def hard_ground(nlp, sent, cpnet_vocab):
     return res
 
 
-def match_mentioned_concepts(sents, answers, num_processes):
+def init_worker(cpnet_vocab, _nlp, _matcher):
+    """
+    Sets the read-only resources used by ground_qa_pairs. Used as initializer of
+    long-lived worker pools, so that the resources are only passed to each worker once.
+    The vocab sets are only built again for a different vocab, so forked workers
+    share the sets of the parent.
+    """
+    global CPNET_VOCAB, CONCEPTS, nlp, matcher, _vocab_source
+    if _vocab_source is not cpnet_vocab:
+        CPNET_VOCAB = set(c.replace("_", " ") for c in cpnet_vocab)
+        CONCEPTS = set(cpnet_vocab)
+        _vocab_source = cpnet_vocab
+    nlp = _nlp
+    matcher = _matcher
+
+
+def match_mentioned_concepts(sents, answers, num_processes, pool=None):
+    qa_pairs = list(zip(sents, answers))
+    chunks = [qa_pairs[i:i + GROUNDING_CHUNK_SIZE] for i in range(0, len(qa_pairs), GROUNDING_CHUNK_SIZE)]
+    if pool is not None:
+        return [res for chunk in tqdm(pool.imap(ground_qa_pairs, chunks), total=len(chunks)) for res in chunk]
     with Pool(num_processes) as p:
-        res = list(tqdm(p.imap(ground_qa_pair, zip(sents, answers)), total=len(sents)))
+        res = [res for chunk in tqdm(p.imap(ground_qa_pairs, chunks), total=len(chunks)) for res in chunk]
     return res
 
 
@@ -223,16 +351,17 @@ def prune(data, cpnet_vocab):
     return prune_data
 
 
-def ground(statement, cpnet_vocab, _nlp, _matcher, num_processes=1, debug=False):
-    global CPNET_VOCAB
-    CPNET_VOCAB = [c.replace("_", " ") for c in cpnet_vocab]
+def ground(statement, cpnet_vocab, _nlp, _matcher, num_processes=1, debug=False, pool=None):
+    """
+    Grounds the statements and answers to ConceptNet concepts.
+    If a pool is given, its workers have to be initialized with init_worker.
+    Otherwise, a new pool with num_processes workers is created for this call.
+    """
+    init_worker(cpnet_vocab, _nlp, _matcher)
+    del _nlp, _matcher
 
     sents = []
     answers = []
-    global matcher ,nlp
-    matcher = _matcher
-    nlp = _nlp
-    del _nlp, _matcher
 
     for sentence in statement["statements"]:
             sents.append(sentence["statement"])
@@ -244,7 +373,7 @@ def ground(statement, cpnet_vocab, _nlp, _matcher, num_processes=1, debug=False)
             print(answer)
         answers.append(answer)
 
-    res = match_mentioned_concepts(sents, answers, num_processes)
-    res = prune(res, cpnet_vocab)
+    res = match_mentioned_concepts(sents, answers, num_processes, pool)
+    res = prune(res, CONCEPTS)
     print(f'grounding concepts finished ')
     return res
@@ -0,0 +1,237 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from tasks.config.model_config import IDENTIFIER, model_config, save_process_statistics
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+RATIO_BUCKETS = (0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 384, 512, 1024, 2048)
+
+# name -> (description, buckets)
+HISTOGRAMS = {
+    "inference_stage_seconds": ("Time in seconds spent in each stage of a prediction", LATENCY_BUCKETS),
+    "inference_batch_inputs": ("Number of inputs per forward pass of the model", SIZE_BUCKETS),
+    "inference_batch_requests": ("Number of requests merged into one prediction", SIZE_BUCKETS),
+    "inference_padding_ratio": ("Share of padding tokens in the inputs of a forward pass", RATIO_BUCKETS),
+    "inference_input_tokens": ("Number of tokens per input without padding", TOKEN_BUCKETS),
+}
+
+# Stages of Model.predict, the remaining time of a prediction is counted as post-processing
+MODEL_STAGES = ["tokenization", "forward", "encoding", "grounding", "graph_construction"]
+
+# Minimal time in seconds between two writes of the metrics of the worker
+SAVE_INTERVAL = 5.0
+
+
+class Metrics:
+    """
+    Histograms of the worker for the Prometheus /metrics route of the API.
+
+    Observations are labeled with the model, task and adapter of the prediction that the
+    current thread is working on (see labels). The durations of the stages are also collected
+    per prediction (see collect), so that they can be returned with the result.
+    """
+
+    def __init__(self):
+        # (name, sorted label items) -> {"buckets": [...], "sum": ..., "count": ...}
+        self._histograms: Dict = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._saved = float("-inf")
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Add the value to the histogram with the given name and labels.
+        The labels of the current prediction are added automatically.
+        """
+        buckets = HISTOGRAMS[name][1]
+        labels = {**self.current_labels(), **labels}
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+                self._histograms[key] = histogram
+            i = bisect.bisect_left(buckets, value)
+            if i < len(buckets):
+                histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def current_labels(self) -> Dict:
+        return getattr(self._local, "labels", {})
+
+    @contextmanager
+    def labels(self, **labels):
+        """
+        Label all observations of the current thread within the context
+        """
+        previous = self.current_labels()
+        self._local.labels = {**previous, **labels}
+        try:
+            yield
+        finally:
+            self._local.labels = previous
+
+    @contextmanager
+    def collect(self):
+        """
+        Collect the durations of the stages observed by the current thread within the context.
+        On exit, they are also added to the durations collected by an enclosing context.
+
+        Yields:
+            dictionary from stage to the total seconds spent in the stage
+        """
+        previous = getattr(self._local, "timing", None)
+        timing = {}
+        self._local.timing = timing
+        try:
+            yield timing
+        finally:
+            self._local.timing = previous
+            if previous is not None:
+                self.add_timing(timing)
+
+    def add_timing(self, timing: Dict[str, float]):
+        """
+        Add durations that were observed by another thread (e.g. for the merged prediction of a batch)
+        to the durations collected by the current thread without observing them again
+        """
+        collected = getattr(self._local, "timing", None)
+        if collected is None:
+            return
+        for stage, seconds in timing.items():
+            collected[stage] = collected.get(stage, 0.0) + seconds
+
+    def observe_stage(self, stage: str, seconds: float):
+        self.observe("inference_stage_seconds", seconds, stage=stage)
+        self.add_timing({stage: seconds})
+
+    @contextmanager
+    def timer(self, stage: str):
+        """
+        Measure the duration of the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def predict_timer(self):
+        """
+        Measure a call of Model.predict. The time that is not spent in one of the MODEL_STAGES
+        within the call is counted as post-processing.
+        """
+        start = time.perf_counter()
+        with self.collect() as timing:
+            try:
+                yield
+            finally:
+                total = time.perf_counter() - start
+                self.observe_stage("predict", total)
+                stages = sum(timing.get(stage, 0.0) for stage in MODEL_STAGES)
+                self.observe_stage("postprocessing", max(total - stages, 0.0))
+
+    def observe_batch(self, num_inputs: int, attention_mask=None):
+        """
+        Observe the size of a forward pass and, if the attention mask is given,
+        its share of padding tokens and the number of tokens of each input
+        """
+        self.observe("inference_batch_inputs", num_inputs)
+        if attention_mask is None or num_inputs == 0:
+            return
+        lengths = attention_mask.sum(-1).tolist()
+        self.observe("inference_padding_ratio", 1 - sum(lengths) / (len(lengths) * attention_mask.shape[-1]))
+        for length in lengths:
+            self.observe("inference_input_tokens", length)
+
+    def snapshot(self) -> List[Dict]:
+        """
+        The current state of all histograms with non-cumulative bucket counts
+        """
+        with self._lock:
+            return [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "buckets": list(histogram["buckets"]),
+                    "sum": histogram["sum"],
+                    "count": histogram["count"],
+                }
+                for (name, labels), histogram in self._histograms.items()
+            ]
+
+    def save(self, force: bool = False):
+        """
+        Store the metrics for the API. Unless force is set, they are written at most every SAVE_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        if not force and now - self._saved < SAVE_INTERVAL:
+            return
+        self._saved = now
+        # the metrics of each worker process are stored separately, so that the API can sum them up
+        try:
+            save_process_statistics(IDENTIFIER or model_config.model_name, "metrics", self.snapshot())
+        except (OSError, AttributeError) as e:
+            logger.warning(f"Could not store metrics: {e}")
+
+
+metrics = Metrics()
+
+
+def _format_labels(labels: Dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    values = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + values + "}"
+
+
+def render_prometheus(snapshots: List[Optional[List[Dict]]]) -> str:
+    """
+    Sum up the metrics of all workers and render them in the Prometheus text format
+
+    Args:
+         snapshots: the metrics snapshot of each worker
+    """
+    merged: Dict = {}
+    for snapshot in snapshots:
+        for histogram in snapshot or []:
+            if histogram["name"] not in HISTOGRAMS:
+                continue
+            key = (histogram["name"], tuple(sorted(histogram["labels"].items())))
+            if key not in merged:
+                merged[key] = {"buckets": [0] * len(histogram["buckets"]), "sum": 0.0, "count": 0}
+            merged[key]["buckets"] = [a + b for a, b in zip(merged[key]["buckets"], histogram["buckets"])]
+            merged[key]["sum"] += histogram["sum"]
+            merged[key]["count"] += histogram["count"]
+
+    lines = []
+    for name, (description, buckets) in HISTOGRAMS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} histogram")
+        for (histogram_name, labels), histogram in sorted(merged.items()):
+            if histogram_name != name:
+                continue
+            labels = dict(labels)
+            cumulative = 0
+            for upper_bound, count in zip(buckets, histogram["buckets"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, le=float(upper_bound))} {cumulative}")
+            lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {histogram["count"]}')
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
@@ -6,40 +6,69 @@ import numpy as np
 import torch
 from pydantic import Field, BaseModel
 from tasks.config.model_config import model_config
+from tasks.metrics import metrics
+
+
+def _encode_base64(arr: np.ndarray) -> str:
+    """
+    Encodes the array with np.save as base64 string
+    """
+    # np.save expects a file which we emulate with BytesIO
+    with BytesIO() as b:
+        np.save(b, arr)
+        arr_binary = b.getvalue()
+    arr_binary_b64 = base64.b64encode(arr_binary)
+    arr_string_b64 = arr_binary_b64.decode("latin1")
+    return arr_string_b64
+
+    # DECODE THE VALUE WITH
+    # arr_binary_b64 = arr_string_b64.encode()
+    # arr_binary = base64.decodebytes(arr_binary_b64)
+    # arr = np.load(BytesIO(arr_binary))
+
+
+def _encode_binary(arr: np.ndarray) -> dict:
+    """
+    Encodes the array as raw little-endian buffer with a dtype and shape header.
+    The buffer is kept as bytes, so the result can only be serialized with a binary format like msgpack.
+    """
+    arr = np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder("<"))
+    return {"dtype": arr.dtype.str, "shape": list(arr.shape), "data": arr.tobytes()}
+
+    # DECODE THE VALUE WITH
+    # arr = np.frombuffer(value["data"], dtype=value["dtype"]).reshape(value["shape"])
+
+
+def _decode_binary(value: dict) -> np.ndarray:
+    return np.frombuffer(value["data"], dtype=np.dtype(value["dtype"])).reshape(value["shape"])
 
 
 def _encode_numpy(
         obj: Dict[str, Union[torch.Tensor, Tuple[torch.Tensor]]],
         return_plaintext: bool = None,
-) -> Dict[str, Union[list, str]]:
+        return_binary: bool = None,
+) -> Dict[str, Union[list, str, dict]]:
     """
-    Encodes the Torch Tensors first to Numpy arrays and then encodes them either as plain lists or base64 string
-    depending on the flag RETURN_PLAINTEXT_ARRAYS
+    Encodes the Torch Tensors first to Numpy arrays and then encodes them either as plain lists, base64 string
+    or raw binary buffers depending on the flags RETURN_PLAINTEXT_ARRAYS and BINARY_ARRAYS
     :param obj: the objects whose tensors will be encoded
-    :return: the same dictionary with all tensors replaced by lists or base64-encoded array strings.
+    :return: the same dictionary with all tensors replaced by lists, base64-encoded array strings or binary arrays.
     """
     if return_plaintext is None:
         return_plaintext = model_config.return_plaintext_arrays
+    if return_binary is None:
+        return_binary = model_config.binary_arrays
 
-    # Encode numpy array either as lists or base64 string
+    # Encode numpy array either as lists, base64 string or binary buffer
     def encode(arr):
         if isinstance(arr, torch.Tensor):
             arr = arr.numpy()
         if return_plaintext:
             return arr.tolist()
+        elif return_binary:
+            return _encode_binary(arr)
         else:
-            # np.save expects a file which we emulate with BytesIO
-            with BytesIO() as b:
-                np.save(b, arr)
-                arr_binary = b.getvalue()
-            arr_binary_b64 = base64.b64encode(arr_binary)
-            arr_string_b64 = arr_binary_b64.decode("latin1")
-            return arr_string_b64
-
-            # DECODE THE VALUE WITH
-            # arr_binary_b64 = arr_string_b64.encode()
-            # arr_binary = base64.decodebytes(arr_binary_b64)
-            # arr = np.load(BytesIO(arr_binary))
+            return _encode_base64(arr)
 
     # Recursively go through a value and encode leaves (=tensors) it or iterate over values and encode them
     def enc_or_iterate(val):
@@ -62,6 +91,59 @@ def _encode_numpy(
     return obj
 
 
+def _decode_numpy(
+        obj: Dict[str, Union[list, str, dict]],
+        is_encoded: bool,
+) -> Dict[str, Union[np.ndarray, List[np.ndarray]]]:
+    """
+    Reverses _encode_numpy and decodes the lists, base64 strings or binary arrays back to numpy arrays
+    :param obj: the dictionary with the encoded arrays
+    :param is_encoded: whether the arrays are base64 strings or binary arrays (True) or plain lists (False)
+    :return: the same dictionary with all encoded arrays replaced by numpy arrays
+    """
+    def decode(val):
+        if is_encoded:
+            if isinstance(val, list):
+                return [decode(v) for v in val]
+            if isinstance(val, dict):
+                return _decode_binary(val)
+            arr_binary = base64.decodebytes(val.encode("latin1"))
+            return np.load(BytesIO(arr_binary))
+        return np.array(val)
+
+    return {k: decode(v) for k, v in obj.items()}
+
+
+def binary_to_base64(obj: Dict[str, Union[list, str, dict]]) -> Dict[str, Union[list, str]]:
+    """
+    Replaces all binary arrays by base64 strings, e.g. to return a result stored with binary arrays as JSON
+    :param obj: the model outputs of a prediction result
+    :return: the same dictionary with the binary arrays replaced by base64-encoded array strings
+    """
+    def convert(val):
+        if isinstance(val, list):
+            return [convert(v) for v in val]
+        if isinstance(val, dict):
+            return _encode_base64(_decode_binary(val))
+        return val
+
+    return {k: convert(v) for k, v in obj.items()}
+
+
+def stringify_keys(obj):
+    """
+    Converts all dictionary keys to strings like JSON does. msgpack only decodes string map keys, so results
+    with e.g. integer keys in id2label have to be converted before they are stored with msgpack.
+    :param obj: the prediction result
+    :return: the same result with all dictionary keys as strings
+    """
+    if isinstance(obj, dict):
+        return {k if isinstance(k, str) else str(k): stringify_keys(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [stringify_keys(v) for v in obj]
+    return obj
+
+
 class PredictionOutput(BaseModel):
     """
     The results of the prediction of the model on the given input for the requested task.
@@ -73,6 +155,9 @@ class PredictionOutput(BaseModel):
                     "arr_binary_b64 = arr_string_b64.encode()<br>"
                     "arr_binary = base64.decodebytes(arr_binary_b64)<br>"
                     "arr = np.load(BytesIO(arr_binary))<br><br>"
+                    "Results requested with 'Accept: application/x-msgpack' can contain binary arrays instead, i.e. "
+                    "dictionaries with 'dtype', 'shape' and the raw little-endian buffer 'data'. Decode them with:<br>"
+                    "arr = np.frombuffer(value['data'], dtype=value['dtype']).reshape(value['shape'])<br><br>"
                     "SentenceTransformer:<br>"
                     "'embedding':<br>"
                     "- 'embeddings: Embedding tensors.<br>"
@@ -96,8 +181,13 @@ class PredictionOutput(BaseModel):
     )
     model_output_is_encoded: bool = Field(
         not model_config.return_plaintext_arrays,
-        description="Flag indicating that 'model_output' is a base64-encoded numpy array and not a human-readable list."
+        description="Flag indicating that 'model_output' is a base64-encoded (or binary) numpy array "
+                    "and not a human-readable list."
                     "See the field description for 'model_output' on information on how to decode the array.")
+    timing: Optional[Dict[str, float]] = Field(
+        None,
+        description="Seconds spent in each stage of the prediction. Only set if 'return_timing' is requested."
+    )
 
     def __init__(self, **data):
         """
@@ -110,7 +200,8 @@ class PredictionOutput(BaseModel):
                         extracted spans, etc.
         """
         super().__init__(**data)
-        self.model_outputs = _encode_numpy(self.model_outputs)
+        with metrics.timer("encoding"):
+            self.model_outputs = _encode_numpy(self.model_outputs)
         self.model_output_is_encoded = not model_config.return_plaintext_arrays
 
 class TokenAttributions(BaseModel):
@@ -101,3 +101,8 @@ class PredictionRequest(BaseModel):
         description="Only necessary for Adapter. "
                     "The fully specified name of the to-be-used adapter from adapterhub.ml"
     )
+    return_timing: bool = Field(
+        default=False,
+        description="Return the seconds spent in each stage of the prediction (e.g. 'queue_wait', "
+                    "'tokenization', 'forward', 'postprocessing') in 'timing' of the result."
+    )
@@ -1,16 +1,23 @@
 import logging
 import os
+import threading
+import time
 from abc import ABC
 
 from celery import Task
+from celery.signals import before_task_publish, worker_process_shutdown, worker_shutdown
 
+from .batching import RequestBatcher
 from .celery import app
-from .config.model_config import model_config
+from .config.model_config import IDENTIFIER, model_config, remove_process_statistics
 from .inference.adaptertransformer import AdapterTransformer
 from .inference.onnx import Onnx
 from .inference.sentencetransformer import SentenceTransformer
 from .inference.transformer import Transformer
 from .inference.graph_transformers import GraphTransformers
+from .inference.model import flush_statistics
+from .metrics import metrics
+from .models.prediction import stringify_keys
 from .models.request import PredictionRequest
 
 logger = logging.getLogger(__name__)
@@ -33,6 +40,10 @@ class ModelTask(Task, ABC):
     def __init__(self):
         super().__init__()
         self.model = None
+        self.batcher = None
+        self._init_lock = threading.Lock()
+        # time at which the current task of the thread returned its result and the labels of its metrics
+        self._local = threading.local()
 
     def __call__(self, *args, **kwargs):
         """
@@ -41,12 +52,35 @@ class ModelTask(Task, ABC):
         """
         model_config.update()
         logger.info(f"Configuration: {model_config}")
-        if not self.model:
-            logger.info(model_config)
-            model_instance = MODEL_MAPPING[model_config.model_type]()
-            self.model = model_instance
+        # worker threads (--pool threads) share the task instance, so the model is only created once
+        with self._init_lock:
+            if not self.model:
+                logger.info(model_config)
+                model_instance = MODEL_MAPPING[model_config.model_type]()
+                self.model = model_instance
+            if model_config.enable_batching:
+                if not self.batcher:
+                    logger.info(f"Merging concurrent requests with a wait time of {model_config.batch_wait_time}s")
+                    self.batcher = RequestBatcher(self.model, model_config.batch_size, model_config.batch_wait_time)
+                self.batcher.max_batch_size = model_config.batch_size
+                self.batcher.max_wait_time = model_config.batch_wait_time
+                self.batcher.mix_adapters = model_config.mix_adapters
+            else:
+                self.batcher = None
         return self.run(*args, **kwargs)
 
+    def on_success(self, retval, task_id, args, kwargs):
+        # Celery stores the result in the backend before calling on_success
+        returned_at = getattr(self._local, "returned_at", None)
+        if returned_at is not None:
+            with metrics.labels(**self._local.labels):
+                metrics.observe_stage("result_storage", time.perf_counter() - returned_at)
+            self._local.returned_at = None
+        metrics.save()
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        metrics.save()
+
 
 @app.task(
     bind=True,
@@ -55,5 +89,59 @@ class ModelTask(Task, ABC):
 def prediction_task(self, prediction_request, task, model_config):
     logger.info(f"Prediction Request: {prediction_request} for task {task}")
     logger.info(model_config)
-    prediction = self.model.predict(PredictionRequest(**prediction_request), task)
-    return prediction.dict()
+    request = PredictionRequest(**prediction_request)
+    labels = {
+        "model": IDENTIFIER or model_config.get("model_name"),
+        "task": getattr(task, "value", task),
+        "adapter": request.adapter_name or "",
+    }
+    with metrics.labels(**labels), metrics.collect() as timing:
+        # set by the API when the task is sent (see add_enqueue_time)
+        enqueued_at = getattr(self.request, "enqueued_at", None)
+        if enqueued_at is not None:
+            metrics.observe_stage("queue_wait", max(time.time() - enqueued_at, 0.0))
+        with metrics.timer("total"):
+            if self.batcher is not None:
+                result = self.batcher.submit(request, task)
+            else:
+                with metrics.predict_timer():
+                    prediction = self.model.predict(request, task)
+                result = prediction.dict()
+    if request.return_timing:
+        result["timing"] = timing
+    if model_config.get("binary_arrays"):
+        # the result is stored with msgpack (see celery.py)
+        result = stringify_keys(result)
+    self._local.returned_at = time.perf_counter()
+    self._local.labels = labels
+    return result
+
+
+@before_task_publish.connect(sender=prediction_task.name)
+def add_enqueue_time(headers=None, **kwargs):
+    """
+    Add the time at which the prediction is queued to the task, so that the worker can measure the queue wait
+    """
+    if headers is not None:
+        headers["enqueued_at"] = time.time()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def close_model(**kwargs):
+    """
+    Release the resources of the model, e.g. its worker pools, when the worker exits
+    """
+    if prediction_task.model is not None:
+        logger.info("Closing model")
+        prediction_task.model.close()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def remove_statistics(**kwargs):
+    """
+    Remove the statistics of the exiting worker process, so that the API stops merging them
+    """
+    flush_statistics()
+    remove_process_statistics()
@@ -57,6 +57,24 @@ def test_transformer_sequence_classification():
     )
     return Transformer()
 
+
+# The tolerance of the precision check is disabled, so that the model never falls back to fp32
+@pytest.fixture(scope="class")
+def test_transformer_sequence_classification_int8():
+    torch.manual_seed(987654321)
+    set_test_config(
+        model_name=TRANSFORMER_MODEL,
+        model_class="sequence_classification",
+        disable_gpu=True,
+        batch_size=1,
+        max_input_size=50,
+        model_type="transformer",
+        precision="int8",
+        precision_tolerance=float("inf"),
+    )
+    return Transformer()
+
+
 @pytest.fixture(scope="class")
 def test_transformer_sequence_classification_roberta():
     torch.manual_seed(987654321)
@@ -156,6 +174,22 @@ def test_transformer_generation():
     return Transformer()
 
 
+@pytest.fixture(scope="class")
+def test_transformer_generation_bf16():
+    torch.manual_seed(987654321)
+    set_test_config(
+        model_name=TRANSFORMER_MODEL,
+        model_class="generation",
+        disable_gpu=True,
+        batch_size=1,
+        max_input_size=50,
+        model_type="transformers",
+        precision="bf16",
+        precision_tolerance=float("inf"),
+    )
+    return Transformer()
+
+
 @pytest.fixture(scope="class")
 def test_adapter():
     set_test_config(
@@ -270,6 +304,27 @@ def test_onnx_generation():
         return None
 
 
+@pytest.fixture(scope="class")
+def test_onnx_generation_with_past():
+    onnx_path = "./onnx_models/t5_encoder_decoder/t5-small-encoder.onnx"
+    decoder_init_path = "./onnx_models/t5_encoder_decoder/t5-small-init-decoder.onnx"
+    decoder_path = "./onnx_models/t5_encoder_decoder/t5-small-decoder.onnx"
+    if os.path.isfile(onnx_path) and os.path.isfile(decoder_path):
+        set_test_config(
+            model_name=ONNX_MODEL,
+            disable_gpu=True,
+            batch_size=1,
+            max_input_size=50,
+            onnx_path=onnx_path,
+            decoder_path=decoder_init_path,
+            decoder_with_past_path=decoder_path,
+            model_type="onnx",
+        )
+        return Onnx()
+    else:
+        return None
+
+
 @pytest.fixture()
 def prediction_request():
     request = PredictionRequest.parse_obj({
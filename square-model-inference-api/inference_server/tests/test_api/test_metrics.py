@@ -0,0 +1,20 @@
+from starlette.testclient import TestClient
+
+from tasks.config import model_config as config_module
+from tasks.config.model_config import save_process_statistics
+from tasks.metrics import Metrics
+
+
+def test_metrics(test_app, tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(config_module, "CONFIG_PATH", str(tmp_path))
+    metrics = Metrics()
+    with metrics.labels(model="test_model"):
+        metrics.observe("inference_stage_seconds", 0.2, stage="forward")
+    save_process_statistics("test_model", "metrics", metrics.snapshot())
+
+    test_client = TestClient(test_app)
+    response = test_client.get("/api/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE inference_stage_seconds histogram" in response.text
+    assert 'inference_stage_seconds_count{model="test_model",stage="forward"} 1' in response.text
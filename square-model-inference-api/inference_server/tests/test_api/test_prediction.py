@@ -1,8 +1,13 @@
+import base64
+from io import BytesIO
 from unittest.mock import patch
 
+import msgpack
+import numpy as np
 from starlette.testclient import TestClient
 from celery.result import AsyncResult
 
+from tasks.models.prediction import _encode_numpy
 from tasks.models.request import Task
 
 
@@ -147,3 +152,78 @@ def test_api_statistics(test_app) -> None:
     assert response.json()["model_name"] == "bert-base-uncased"
     assert response.json()["max_input"] == 512
     assert response.status_code == 200
+
+
+def binary_task_result():
+    model_outputs = _encode_numpy(
+        {"logits": np.ones((2, 3), dtype="float32")}, return_plaintext=False, return_binary=True
+    )
+    return {"model_outputs": model_outputs, "model_output_is_encoded": True, "labels": [0, 0]}
+
+
+@patch('celery.result.AsyncResult.get', return_value=binary_task_result())
+@patch('celery.result.AsyncResult.ready', return_value=True)
+def test_api_task_result_json(test_ready, test_get, test_app) -> None:
+    test_client = TestClient(test_app)
+    response = test_client.get("/api/task_result/123")
+    assert response.status_code == 200
+    encoded_arr = response.json()["result"]["model_outputs"]["logits"]
+    arr = np.load(BytesIO(base64.decodebytes(encoded_arr.encode())))
+    np.testing.assert_equal(arr, np.ones((2, 3), dtype="float32"))
+
+
+@patch('celery.result.AsyncResult.get', return_value=binary_task_result())
+@patch('celery.result.AsyncResult.ready', return_value=True)
+def test_api_task_result_msgpack(test_ready, test_get, test_app) -> None:
+    test_client = TestClient(test_app)
+    response = test_client.get("/api/task_result/123", headers={"Accept": "application/x-msgpack"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-msgpack"
+    binary_arr = msgpack.unpackb(response.content, raw=False)["result"]["model_outputs"]["logits"]
+    arr = np.frombuffer(binary_arr["data"], dtype=binary_arr["dtype"]).reshape(binary_arr["shape"])
+    np.testing.assert_equal(arr, np.ones((2, 3), dtype="float32"))
+
+
+@patch('celery.result.AsyncResult.get', return_value=binary_task_result())
+@patch('celery.result.AsyncResult.ready', return_value=True)
+@patch('celery.app.task.Task.apply_async',  return_value=AsyncResult(123))
+def test_api_question_answering_wait(test_task, test_ready, test_get, test_app) -> None:
+    test_client = TestClient(test_app)
+    response = test_client.post(
+        f"/api/{identifier}/question-answering?wait=true",
+        json={
+            "input": [
+                ["What is this?", "this is a test"]
+            ],
+            "is_preprocessed": False,
+            "preprocessing_kwargs": {},
+            "model_kwargs": {},
+            "task_kwargs": {},
+            "adapter_name": ""
+        }
+    )
+    assert test_task.called
+    assert response.status_code == 200
+    assert response.json()["status"] == "Finished"
+    assert response.json()["result"]["labels"] == [0, 0]
+
+
+@patch('celery.result.AsyncResult.ready', return_value=False)
+@patch('celery.app.task.Task.apply_async',  return_value=AsyncResult(123))
+def test_api_question_answering_wait_timeout(test_task, test_ready, test_app) -> None:
+    test_client = TestClient(test_app)
+    response = test_client.post(
+        f"/api/{identifier}/question-answering?wait=true&timeout=0.05",
+        json={
+            "input": [
+                ["What is this?", "this is a test"]
+            ],
+            "is_preprocessed": False,
+            "preprocessing_kwargs": {},
+            "model_kwargs": {},
+            "task_kwargs": {},
+            "adapter_name": ""
+        }
+    )
+    assert response.status_code == 202
+    assert response.json()["status"] == "Processing"
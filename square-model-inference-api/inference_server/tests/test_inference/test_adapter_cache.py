@@ -0,0 +1,71 @@
+from tasks.inference.adapter_cache import AdapterCache
+
+
+class FakeAdapters:
+    """
+    Records the adapters loaded into and removed from a model
+    """
+
+    def __init__(self, sizes=None):
+        self.sizes = sizes or {}
+        self.loads = []
+        self.unloads = []
+
+    def load(self, adapter_name):
+        self.loads.append(adapter_name)
+        return self.sizes.get(adapter_name, 1)
+
+    def unload(self, adapter_name):
+        self.unloads.append(adapter_name)
+
+
+def test_adapter_is_only_loaded_once():
+    adapters = FakeAdapters()
+    cache = AdapterCache(adapters.load, adapters.unload)
+    assert not cache.get("qa/squad1@ukp")
+    assert cache.get("qa/squad1@ukp")
+    assert adapters.loads == ["qa/squad1@ukp"]
+    statistics = cache.statistics()
+    assert statistics["hits"] == 1
+    assert statistics["misses"] == 1
+    assert statistics["adapters"]["qa/squad1@ukp"]["loads"] == 1
+
+
+def test_least_recently_used_adapter_is_evicted():
+    adapters = FakeAdapters()
+    cache = AdapterCache(adapters.load, adapters.unload, max_adapters=2)
+    cache.get("a")
+    cache.get("b")
+    cache.get("a")
+    cache.get("c")
+    assert adapters.unloads == ["b"]
+    assert "a" in cache and "c" in cache and "b" not in cache
+    cache.get("b")
+    assert adapters.loads == ["a", "b", "c", "b"]
+    assert cache.statistics()["evictions"] == 2
+
+
+def test_memory_budget_keeps_requested_adapter():
+    adapters = FakeAdapters(sizes={"small": 10, "large": 100})
+    cache = AdapterCache(adapters.load, adapters.unload, max_memory=50)
+    cache.get("small")
+    cache.get("large")
+    assert adapters.unloads == ["small"]
+    assert "large" in cache
+    assert cache.is_full()
+
+
+def test_statistics_of_processes_are_merged():
+    caches = [AdapterCache(FakeAdapters().load, FakeAdapters().unload, max_adapters=2) for _ in range(2)]
+    caches[0].get("a")
+    caches[0].get("a")
+    caches[1].get("a")
+    caches[1].get("b")
+    merged = AdapterCache.merge_statistics([cache.statistics() for cache in caches])
+    assert merged["processes"] == 2
+    assert merged["loaded"] == 3
+    assert merged["max_adapters"] == 2
+    assert merged["hits"] == 1 and merged["misses"] == 3
+    assert merged["adapters"]["a"]["loads"] == 2
+    assert merged["adapters"]["b"]["loads"] == 1
+    assert AdapterCache.merge_statistics([]) is None
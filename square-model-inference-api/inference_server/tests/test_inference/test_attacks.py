@@ -0,0 +1,42 @@
+from tasks.attacks.input_reduction import InputReduction
+from tasks.attacks.topk_tokens import TopkTokens
+from tasks.models.request import PredictionRequest
+
+
+def attack_request(**attack_kwargs):
+    return PredictionRequest.parse_obj({
+        "input": [["what is a test", "this is a short test"]],
+        "attack_kwargs": attack_kwargs,
+        "adapter_name": "",
+    })
+
+
+def attributions(question_scores, context_scores):
+    question = ["what", "is", "a", "test"]
+    context = ["this", "is", "a", "short", "test"]
+    return {"attributions": [{
+        "question_tokens": [[(i, word, score) for i, (word, score) in enumerate(zip(question, question_scores))]],
+        "context_tokens": [[(i, word, score) for i, (word, score) in enumerate(zip(context, context_scores))]],
+    }]}
+
+
+def test_input_reduction_removes_smallest_words_first():
+    attack = InputReduction(
+        request=attack_request(method="input_reduction", max_reductions=2),
+        task="question_answering",
+        model_outputs=attributions([0.4, 0.1, 0.1, 0.4], [0.2] * 5),
+    )
+    batch_request, indices = attack.attack_instance()
+    assert batch_request["questions"] == ["what is a test", "what a test", "what test"]
+    assert indices == [1, 2]
+
+
+def test_topk_tokens_keeps_highest_scored_tokens():
+    attack = TopkTokens(
+        request=attack_request(method="topk_tokens", max_tokens=3),
+        task="question_answering",
+        model_outputs=attributions([0.25] * 4, [0.1, 0.3, 0.05, 0.5, 0.05]),
+    )
+    batch_request, indices = attack.attack_instance()
+    assert batch_request["contexts"] == ["this is a short test", "short", "is short", "this is short"]
+    assert indices == [3, 1, 0]
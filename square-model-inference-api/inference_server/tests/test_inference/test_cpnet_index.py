@@ -0,0 +1,93 @@
+import itertools
+
+import networkx as nx
+import numpy as np
+import pytest
+
+from tasks.inference.utils.preprocess.cpnet_index import ConceptNetIndex, convert
+
+NUM_RELATIONS = 3
+
+
+@pytest.fixture(scope="module")
+def cpnet():
+    # relation ids >= NUM_RELATIONS are the reversed relations
+    graph = nx.MultiDiGraph()
+    edges = [(0, 1, 0), (1, 0, 3), (0, 1, 2), (1, 2, 1), (2, 1, 4), (2, 3, 0), (3, 2, 3), (4, 2, 2), (5, 5, 1)]
+    for u, v, rel in edges:
+        graph.add_edge(u, v, rel=rel, weight=float(u + v + rel))
+    return graph
+
+
+@pytest.fixture(scope="module")
+def cpnet_simple(cpnet):
+    graph = nx.Graph()
+    for u, v in cpnet.edges():
+        graph.add_edge(u, v)
+    return graph
+
+
+@pytest.fixture(scope="module")
+def index(cpnet):
+    return ConceptNetIndex.from_networkx(cpnet, num_nodes=8)
+
+
+def test_neighbors(index, cpnet_simple):
+    assert index.num_nodes == 8
+    for node in range(index.num_nodes):
+        assert index.has_node(node) == (node in cpnet_simple.nodes)
+        if node in cpnet_simple.nodes:
+            assert index.neighbors(node).tolist() == sorted(cpnet_simple[node])
+    assert index.has_edge(2, 4)
+    assert not index.has_edge(0, 2)
+
+
+def test_common_neighbors(index, cpnet_simple):
+    for nodes in [{0, 2}, {1, 3, 4}, {0, 1, 2, 3, 4}, {0, 6}, {5}]:
+        expected = set()
+        for q, a in itertools.product(nodes, nodes):
+            if q != a and q in cpnet_simple.nodes and a in cpnet_simple.nodes:
+                expected |= set(cpnet_simple[q]) & set(cpnet_simple[a])
+        assert index.common_neighbors(nodes).tolist() == sorted(expected)
+
+
+def test_adjacency(index, cpnet):
+    nodes = np.array([3, 1, 0, 2, 5])
+    expected = np.zeros((NUM_RELATIONS, len(nodes), len(nodes)), dtype=np.uint8)
+    for s, t in itertools.product(range(len(nodes)), range(len(nodes))):
+        if cpnet.has_edge(nodes[s], nodes[t]):
+            for edge in cpnet[nodes[s]][nodes[t]].values():
+                if 0 <= edge["rel"] < NUM_RELATIONS:
+                    expected[edge["rel"], s, t] = 1
+    np.testing.assert_array_equal(index.adjacency(nodes, NUM_RELATIONS), expected)
+
+
+def test_edges_between_keep_order_of_multi_edges(index):
+    source_pos, target_pos, relations, weights = index.edges_between([1, 0])
+    assert source_pos.tolist() == [0, 1, 1]
+    assert target_pos.tolist() == [1, 0, 0]
+    assert relations.tolist() == [3, 0, 2]
+    assert weights.tolist() == [4.0, 1.0, 3.0]
+
+
+def test_save_and_load(index, tmp_path):
+    index.save(str(tmp_path))
+    assert ConceptNetIndex.exists(str(tmp_path))
+    loaded = ConceptNetIndex.load(str(tmp_path))
+    assert isinstance(loaded.targets, np.memmap)
+    np.testing.assert_array_equal(loaded.adjacency([0, 1, 2], NUM_RELATIONS), index.adjacency([0, 1, 2], NUM_RELATIONS))
+    assert loaded.common_neighbors([0, 2]).tolist() == index.common_neighbors([0, 2]).tolist()
+
+
+def test_edges_between_rejects_duplicate_nodes(index):
+    with pytest.raises(ValueError):
+        index.edges_between([1, 0, 1])
+
+
+def test_convert_adds_nodes_without_edges_at_the_end_of_the_vocab(cpnet, tmp_path, monkeypatch):
+    monkeypatch.setattr(nx, "read_gpickle", lambda path: cpnet, raising=False)
+    vocab_path = tmp_path / "concept.txt"
+    vocab_path.write_text("".join(f"concept_{i}\n" for i in range(8)), encoding="utf8")
+    index = convert("conceptnet.en.pruned.graph", str(vocab_path), str(tmp_path / "index"))
+    assert index.num_nodes == 8
+    assert ConceptNetIndex.load(str(tmp_path / "index")).adjacency([7, 0, 1], NUM_RELATIONS)[0, 1, 2] == 1
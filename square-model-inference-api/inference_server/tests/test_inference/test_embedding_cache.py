@@ -0,0 +1,88 @@
+import numpy as np
+
+from tasks.inference import embedding_cache
+from tasks.inference.embedding_cache import EmbeddingCache
+from tasks.models.request import PredictionRequest
+
+
+class CountingEncoder:
+    """
+    Embeds each text by its length and records the inputs that reach the model
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, request):
+        self.calls.append(list(request.input))
+        return np.array([[float(len(text)), 1.0] for text in request.input], dtype=np.float32)
+
+
+def test_only_missing_inputs_are_embedded():
+    cache = EmbeddingCache(max_memory=2 ** 20)
+    encoder = CountingEncoder()
+    first = cache.embed(PredictionRequest(input=["a", "bb", "a"]), "model", encoder)
+    second = cache.embed(PredictionRequest(input=["ccc", "bb"]), "model", encoder)
+    assert encoder.calls == [["a", "bb"], ["ccc"]]
+    np.testing.assert_array_equal(first[:, 0], [1, 2, 1])
+    np.testing.assert_array_equal(second[:, 0], [3, 2])
+    statistics = cache.statistics()
+    assert statistics["hits"] == 1
+    assert statistics["misses"] == 4
+
+
+def test_namespaces_are_separate():
+    cache = EmbeddingCache(max_memory=2 ** 20)
+    encoder = CountingEncoder()
+    cache.embed(PredictionRequest(input=["a"]), "mean", encoder)
+    cache.embed(PredictionRequest(input=["a"]), "cls", encoder)
+    assert encoder.calls == [["a"], ["a"]]
+
+
+def test_normalized_inputs_share_embeddings():
+    cache = EmbeddingCache(max_memory=2 ** 20)
+    encoder = CountingEncoder()
+    cache.embed(PredictionRequest(input=["caf\u00e9  au lait"]), "model", encoder)
+    # decomposed unicode and different whitespace
+    cache.embed(PredictionRequest(input=[" cafe\u0301 au\tlait\n"]), "model", encoder)
+    assert encoder.calls == [["caf\u00e9 au lait"]]
+    assert cache.statistics()["hits"] == 1
+
+
+def test_least_recently_used_embeddings_are_evicted():
+    # each embedding has 8 bytes, so only two fit into the cache
+    cache = EmbeddingCache(max_memory=16)
+    encoder = CountingEncoder()
+    cache.embed(PredictionRequest(input=["a", "bb"]), "model", encoder)
+    cache.embed(PredictionRequest(input=["a"]), "model", encoder)
+    cache.embed(PredictionRequest(input=["ccc"]), "model", encoder)
+    cache.embed(PredictionRequest(input=["a", "bb"]), "model", encoder)
+    assert encoder.calls == [["a", "bb"], ["ccc"], ["bb"]]
+    assert cache.statistics()["evictions"] == 2
+
+
+def test_embeddings_expire(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(embedding_cache.time, "monotonic", lambda: now[0])
+    cache = EmbeddingCache(max_memory=2 ** 20, ttl=10)
+    encoder = CountingEncoder()
+    cache.embed(PredictionRequest(input=["a"]), "model", encoder)
+    now[0] += 5
+    cache.embed(PredictionRequest(input=["a"]), "model", encoder)
+    now[0] += 10
+    cache.embed(PredictionRequest(input=["a"]), "model", encoder)
+    assert encoder.calls == [["a"], ["a"]]
+
+
+def test_statistics_of_processes_are_merged():
+    caches = [EmbeddingCache(max_memory=2 ** 20) for _ in range(2)]
+    encoder = CountingEncoder()
+    caches[0].embed(PredictionRequest(input=["a"]), "model", encoder)
+    caches[0].embed(PredictionRequest(input=["a"]), "model", encoder)
+    caches[1].embed(PredictionRequest(input=["b"]), "model", encoder)
+    merged = EmbeddingCache.merge_statistics([cache.statistics() for cache in caches])
+    assert merged["processes"] == 2
+    assert merged["entries"] == 2
+    assert merged["hits"] == 1 and merged["misses"] == 2
+    assert merged["max_memory"] == 2 ** 20
+    assert EmbeddingCache.merge_statistics([]) is None
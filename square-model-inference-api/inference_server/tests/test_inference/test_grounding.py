@@ -0,0 +1,116 @@
+import pytest
+import spacy
+from spacy.language import Language
+from spacy.matcher import Matcher
+
+from tasks.inference.utils.preprocess import grounding
+
+VOCAB = [
+    "apple", "apples", "tree", "red_fruit", "grow", "fruit", "eat", "store", "supermarket",
+    "orchard", "people", "people_eat", "a", "b", "tall_tree", "where",
+]
+
+QA_PAIRS = [
+    ("Where do apples grow? tree.", "tree"),
+    ("Where do apples grow? supermarkets store fruits.", "supermarkets"),
+    ("People eat red fruit from tall trees in orchards. a", "a"),
+    ("Where do apples grow? a b", "a b"),
+    ("Nothing here xyz.", "xyz"),
+]
+
+
+@Language.component("test_grounding_lemmatizer")
+def toy_lemmatizer(doc):
+    # strips the plural s, so that the test does not depend on a trained pipeline
+    for token in doc:
+        token.lemma_ = token.text[:-1] if token.text.endswith("s") and len(token.text) > 3 else token.text
+    return doc
+
+
+@pytest.fixture(scope="module")
+def nlp():
+    nlp = spacy.blank("en")
+    nlp.add_pipe("test_grounding_lemmatizer")
+    return nlp
+
+
+@pytest.fixture(scope="module")
+def patterns(nlp):
+    return {concept: [{"LEMMA": token.lemma_} for token in nlp(concept.replace("_", " "))] for concept in VOCAB}
+
+
+def old_ground_mentioned_concepts(nlp, matcher, s, ans=None):
+    """
+    The grounding before the PhraseMatcher, with a Matcher per answer and lemmatization per concept
+    """
+    def lemmatize(concept):
+        return {"_".join([token.lemma_ for token in nlp(concept.replace("_", " "))])}
+
+    s = s.lower()
+    doc = nlp(s)
+    mentioned_concepts = set()
+    span_to_concepts = {}
+
+    if ans is not None:
+        ans_matcher = Matcher(nlp.vocab)
+        ans_matcher.add(ans, [[{"TEXT": token.text.lower()} for token in nlp.tokenizer.pipe(ans)]])
+        ans_mentions = set((start, end) for _, start, end in ans_matcher(doc))
+
+    for match_id, start, end in matcher(doc):
+        if ans is not None and (start, end) in ans_mentions:
+            continue
+        span = doc[start:end].text
+        original_concept = nlp.vocab.strings[match_id]
+        original_concept_set = {original_concept}
+        if len(original_concept.split("_")) == 1:
+            original_concept_set.update(lemmatize(original_concept))
+        span_to_concepts.setdefault(span, set()).update(original_concept_set)
+
+    for span, concepts in span_to_concepts.items():
+        concepts_sorted = sorted(concepts, key=len)
+        shortest = concepts_sorted[0:3]
+        for c in shortest:
+            if c in grounding.blacklist:
+                continue
+            intersect = lemmatize(c).intersection(shortest)
+            mentioned_concepts.add(list(intersect)[0] if len(intersect) > 0 else c)
+        mentioned_concepts.update(
+            concept for concept in concepts_sorted if concept.replace("_", " ").lower() == span.lower()
+        )
+    return mentioned_concepts
+
+
+def old_ground_qa_pair(nlp, matcher, s, a):
+    all_concepts = old_ground_mentioned_concepts(nlp, matcher, s, a)
+    answer_concepts = old_ground_mentioned_concepts(nlp, matcher, a)
+    question_concepts = all_concepts - answer_concepts
+    cpnet_vocab = set(c.replace("_", " ") for c in VOCAB)
+    if len(question_concepts) == 0:
+        question_concepts = grounding.hard_ground(nlp, s, cpnet_vocab)
+    if len(answer_concepts) == 0:
+        answer_concepts = grounding.hard_ground(nlp, a, cpnet_vocab)
+    return {"sent": s, "ans": a, "qc": sorted(question_concepts), "ac": sorted(answer_concepts)}
+
+
+@pytest.fixture(scope="module")
+def old_matcher(nlp, patterns):
+    matcher = Matcher(nlp.vocab)
+    for concept, pattern in patterns.items():
+        matcher.add(concept, [pattern])
+    return matcher
+
+
+@pytest.mark.parametrize("sentence,answer", QA_PAIRS)
+def test_mentioned_concepts_match_old_grounding(nlp, patterns, old_matcher, sentence, answer):
+    matcher = grounding.build_matcher(nlp, patterns)
+    for ans in (answer, None):
+        expected = old_ground_mentioned_concepts(nlp, old_matcher, sentence, ans)
+        assert grounding.ground_mentioned_concepts(nlp, matcher, sentence, ans) == expected
+
+
+def test_grounded_qa_pairs_match_old_grounding(nlp, patterns, old_matcher):
+    grounding.init_worker(VOCAB, nlp, grounding.build_matcher(nlp, patterns))
+    expected = [old_ground_qa_pair(nlp, old_matcher, s, a) for s, a in QA_PAIRS]
+    assert grounding.ground_qa_pairs(QA_PAIRS) == expected
+    assert expected[0]["qc"] == ["apple", "apples", "grow", "where"]
+    assert expected[0]["ac"] == ["tree"]
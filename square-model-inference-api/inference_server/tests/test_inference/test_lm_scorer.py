@@ -0,0 +1,79 @@
+import torch
+
+from tasks.inference.utils.preprocess import graph
+
+VOCAB = ["apple", "red_fruit", "tree", "eat"]
+
+
+class FakeTokenizer:
+    pad_token_id = 1
+
+    def __call__(self, sentences, add_special_tokens=True):
+        return {"input_ids": [[0] + [len(word) + 3 for word in s.split()] + [2] for s in sentences]}
+
+
+class FakeLM(torch.nn.Module):
+    """
+    The loss of a sentence is the sum of its (non-padding) token ids
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.ones(1))
+        self.batches = []
+
+    def forward(self, input_ids, attention_mask=None, masked_lm_labels=None):
+        self.batches.append(input_ids.shape)
+        return ((input_ids * attention_mask).sum(dim=1).float() * self.weight,)
+
+
+def expected_score(sentence):
+    ids = FakeTokenizer()([sentence])["input_ids"][0]
+    return -float(sum(ids))
+
+
+def setup_module():
+    graph.init_worker(VOCAB, None)
+
+
+def test_scores_all_contexts_in_one_batch():
+    model = FakeLM()
+    scorer = graph.LMScorer(model, FakeTokenizer())
+    scores = scorer.score([([0, 1], "Where do apples grow? tree."), ([2, 3], "Where do apples grow? supermarket.")])
+
+    assert len(model.batches) == 1
+    assert model.batches[0][0] == 6
+    assert list(scores[0].keys()) == sorted([-1, 0, 1], key=lambda cid: -scores[0][cid])
+    assert scores[0][-1] == expected_score("where do apples grow? tree.")
+    assert scores[0][1] == expected_score("where do apples grow? tree. red fruit.")
+    assert scores[1][3] == expected_score("where do apples grow? supermarket. eat.")
+
+
+def test_padding_does_not_change_scores():
+    model = FakeLM()
+    scorer = graph.LMScorer(model, FakeTokenizer(), max_batch_size=1)
+    unbatched = scorer.score([([0, 1, 2, 3], "why?")])[0]
+    batched = graph.LMScorer(FakeLM(), FakeTokenizer()).score([([0, 1, 2, 3], "why?")])[0]
+    assert len(model.batches) == 5
+    assert unbatched == batched
+
+
+def test_batches_are_limited_by_tokens():
+    model = FakeLM()
+    scorer = graph.LMScorer(model, FakeTokenizer(), max_tokens=16)
+    scorer.score([([0, 1, 2, 3], "a b")])
+    assert all(rows * length <= 16 for rows, length in model.batches)
+    assert sum(rows for rows, _ in model.batches) == 5
+
+
+def test_duplicates_are_scored_once_and_cached():
+    model = FakeLM()
+    scorer = graph.LMScorer(model, FakeTokenizer(), cache_size=100)
+    first = scorer.score([([0, 1], "Question? a."), ([0, 1], "question? A.")])
+    assert first[0] == first[1]
+    assert model.batches[0][0] == 3
+
+    second = scorer.score([([1, 2], "Question? a.")])
+    assert len(model.batches) == 2
+    assert model.batches[1][0] == 1
+    assert second[0][1] == first[0][1]
@@ -3,6 +3,7 @@ import pytest
 import numpy as np
 
 from square_model_inference.models.request import Task
+from tasks.inference.onnx import Onnx
 
 
 @pytest.mark.usefixtures("test_onnx_sequence_classification")
@@ -24,6 +25,17 @@ class TestOnnxSequenceClassification:
         assert all(isinstance(prediction.labels[i], int) for i in range(len(input)))
         assert "logits" in prediction.model_outputs
 
+    def test_session_returns_all_outputs(self, test_onnx_sequence_classification):
+        if test_onnx_sequence_classification is None:
+            pytest.skip("No model found.")
+        session = test_onnx_sequence_classification.session
+        features = test_onnx_sequence_classification.tokenizer(["this is a test"], return_tensors="np")
+        inputs = {k: v for k, v in features.items() if k in session.input_names}
+
+        outputs = session.run([], inputs)
+        assert len(outputs) == len(session.output_names)
+        np.testing.assert_allclose(outputs[0], session.session.run(None, inputs)[0], rtol=1e-5)
+
     @pytest.mark.asyncio
     @pytest.mark.parametrize("input", [(["this is a test"]),
                                        (["this is a test", "this is a test with a longer sentence"])],
@@ -211,3 +223,51 @@ class TestOnnxGeneration:
 
 
 
+
+
+@pytest.mark.usefixtures("test_onnx_generation_with_past")
+class TestOnnxGenerationWithPast:
+    @pytest.mark.asyncio
+    async def test_generation_with_past_matches_full_decoding(self, prediction_request, test_onnx_generation_with_past):
+        if test_onnx_generation_with_past is None:
+            pytest.skip("No model found.")
+        prediction_request.input = ["Today is a good day"]
+
+        with_past = test_onnx_generation_with_past.predict(prediction_request, Task.generation)
+        decoder_with_past_session = test_onnx_generation_with_past.decoder_with_past_session
+        test_onnx_generation_with_past.decoder_with_past_session = None
+        try:
+            without_past = test_onnx_generation_with_past.predict(prediction_request, Task.generation)
+        finally:
+            test_onnx_generation_with_past.decoder_with_past_session = decoder_with_past_session
+        assert with_past.generated_texts == without_past.generated_texts
+
+    @pytest.mark.asyncio
+    async def test_beam_search_with_past(self, prediction_request, test_onnx_generation_with_past):
+        if test_onnx_generation_with_past is None:
+            pytest.skip("No model found.")
+        prediction_request.input = ["Today is a good day"]
+        prediction_request.task_kwargs = {"num_beams": 3, "max_length": 10}
+
+        prediction = test_onnx_generation_with_past.predict(prediction_request, Task.generation)
+        assert isinstance(prediction.generated_texts[0][0], str)
+
+
+@pytest.mark.parametrize("outputs", [
+    {"logits": 0, "present.0.key": 1},
+    {"logits": 0, "present.0.key": 1, "present.0.value": 2, "present.1.key": 3},
+    {"logits": 0, "key.0": 1, "value.0": 2},
+], ids=["missing", "additional", "unnamed"])
+def test_update_past_rejects_mismatched_outputs(outputs):
+    model = Onnx.__new__(Onnx)
+    model.past_input_names = ["past_key_values.0.key", "past_key_values.0.value"]
+    with pytest.raises(ValueError):
+        model._update_past({}, outputs)
+
+
+def test_update_past_keeps_cached_values():
+    model = Onnx.__new__(Onnx)
+    model.past_input_names = ["past_key_values.0.decoder.key", "past_key_values.0.encoder.key"]
+    past = {"past_key_values.0.decoder.key": 1, "past_key_values.0.encoder.key": 2}
+    updated = model._update_past(past, {"logits": 0, "present.0.decoder.key": 3})
+    assert updated == {"past_key_values.0.decoder.key": 3, "past_key_values.0.encoder.key": 2}
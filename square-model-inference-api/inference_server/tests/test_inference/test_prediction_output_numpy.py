@@ -1,5 +1,7 @@
 from starlette.config import Environ
-from tasks.models.prediction import PredictionOutput, _encode_numpy
+from kombu.serialization import dumps, loads
+from tasks.models.prediction import (PredictionOutput, PredictionOutputForSequenceClassification, _encode_numpy,
+                                     binary_to_base64, stringify_keys)
 from io import BytesIO
 import base64
 import torch
@@ -34,3 +36,46 @@ def test_prediction_output_numpy_plaintext() -> None:
 
     np.testing.assert_equal(arr, arr_back)
 
+
+
+def test_prediction_output_numpy_binary() -> None:
+
+    arr = np.arange(12, dtype="float32").reshape(3, 4)
+
+    output = _encode_numpy({"test": torch.from_numpy(arr)}, return_plaintext=False, return_binary=True)
+
+    binary_arr = output["test"]
+    assert isinstance(binary_arr["data"], bytes)
+
+    # reversing code
+    arr_back = np.frombuffer(binary_arr["data"], dtype=binary_arr["dtype"]).reshape(binary_arr["shape"])
+
+    np.testing.assert_equal(arr, arr_back)
+
+
+def test_binary_to_base64() -> None:
+
+    arr = np.ones(shape=(2, 5), dtype="float32")
+
+    output = binary_to_base64(_encode_numpy({"test": [arr, arr]}, return_plaintext=False, return_binary=True))
+
+    for encoded_arr in output["test"]:
+        arr_back = np.load(BytesIO(base64.decodebytes(encoded_arr.encode())))
+        np.testing.assert_equal(arr, arr_back)
+
+
+def test_binary_result_with_int_keys_round_trip() -> None:
+
+    result = PredictionOutputForSequenceClassification(
+        model_outputs=_encode_numpy({"logits": torch.ones(2, 2)}, return_plaintext=False, return_binary=True),
+        labels=[0, 1],
+        id2label={0: "neg", 1: "pos"},
+    ).dict()
+
+    # serialize the result like the Celery result backend
+    content_type, content_encoding, data = dumps(stringify_keys(result), serializer="msgpack")
+    result_back = loads(data, content_type, content_encoding, accept=[content_type])
+
+    assert result_back["id2label"] == {"0": "neg", "1": "pos"}
+    assert result_back["labels"] == [0, 1]
+    np.testing.assert_equal(np.frombuffer(result_back["model_outputs"]["logits"]["data"], dtype="float32"), 1)
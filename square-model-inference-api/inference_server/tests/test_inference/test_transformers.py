@@ -1,8 +1,11 @@
 import pytest
 
 import numpy as np
+import torch
 
 from square_model_inference.models.request import Task
+from tasks.config.model_config import model_config
+from tasks.inference.transformer import Transformer
 
 
 @pytest.mark.usefixtures("test_transformer_sequence_classification")
@@ -68,6 +71,40 @@ class TestTransformerSequenceClassification:
         assert len(prediction.attributions[0].topk_context_idx[0]) <= 5
 
 
+@pytest.mark.usefixtures("test_transformer_sequence_classification_int8")
+class TestTransformerSequenceClassificationInt8:
+    @pytest.mark.asyncio
+    async def test_sequence_classification_int8(self, prediction_request, test_transformer_sequence_classification_int8):
+        prediction_request.input = ["this is a test", "this is a test with a longer sentence"]
+
+        prediction = test_transformer_sequence_classification_int8.predict(prediction_request, Task.sequence_classification)
+        assert test_transformer_sequence_classification_int8.precision == "int8"
+        np.testing.assert_allclose(np.sum(prediction.model_outputs["logits"], axis=-1), [1.0]*2, rtol=1e-5)
+        assert all(isinstance(label, int) for label in prediction.labels)
+
+    def test_precision_check_without_difference(self, test_transformer_sequence_classification_int8):
+        # comparing the model against itself results in no error
+        results = test_transformer_sequence_classification_int8._check_precision(
+            test_transformer_sequence_classification_int8.model
+        )
+        assert results["relative_error"] == 0
+        assert results["output"] == "logits"
+
+    def test_precision_falls_back_to_fp32(self, test_transformer_sequence_classification_int8, monkeypatch):
+        model = test_transformer_sequence_classification_int8
+        quantized = model.model
+        monkeypatch.setattr(model, "_check_precision", lambda reference: {"relative_error": 1.0})
+        monkeypatch.setattr(model, "_save_statistics", lambda *args, **kwargs: None)
+        try:
+            model._set_precision("int8", "cpu")
+            assert model.precision == "fp32"
+            # the model falls back to the model it was quantized from
+            assert model.model is quantized
+        finally:
+            model.model = quantized
+            model.precision = "int8"
+
+
 @pytest.mark.usefixtures("test_transformer_sequence_classification_roberta")
 class TestTransformerSequenceClassificationRoberta:
     test_input = ["this is a test with a longer sentence"]
@@ -168,6 +205,45 @@ class TestTransformerEmbedding:
         assert prediction.embedding_mode == "token"
         assert prediction.word_ids == word_ids
 
+    @pytest.mark.asyncio
+    async def test_embedding_length_buckets_keep_input_order(self, prediction_request, test_transformer_embedding):
+        input = ["this is a test", "this is a test with a longer sentence", "test"]
+        prediction_request.task_kwargs = {"embedding_mode": "mean"}
+        prediction_request.input = input
+
+        prediction = test_transformer_embedding.predict(prediction_request, Task.embedding)
+        for i, text in enumerate(input):
+            prediction_request.input = [text]
+            single = test_transformer_embedding.predict(prediction_request, Task.embedding)
+            np.testing.assert_allclose(prediction.model_outputs["embeddings"][i],
+                                       single.model_outputs["embeddings"][0], rtol=1e-4, atol=1e-5)
+
+    @pytest.mark.asyncio
+    async def test_unknown_outputs_disable_length_buckets_for_the_request(self, prediction_request,
+                                                                          test_transformer_embedding, monkeypatch):
+        model = test_transformer_embedding
+        input = ["this is a test", "this is a test with a longer sentence", "test"]
+        prediction_request.task_kwargs = {"embedding_mode": "mean"}
+        prediction_request.input = input
+        monkeypatch.setattr(model_config, "batch_size", 2)
+        expected = model.predict(prediction_request, Task.embedding).model_outputs["embeddings"]
+
+        sequence_output_dims = model._sequence_output_dims
+        trimmed = []
+        trim_padding = model._trim_padding
+        monkeypatch.setattr(model, "_trim_padding", lambda *args: trimmed.append(1) or trim_padding(*args))
+        # the pooler output of this request has no known sequence dimensions
+        monkeypatch.setattr(model, "_sequence_output_dims",
+                            lambda: {k: v for k, v in sequence_output_dims().items() if k != "pooler_output"})
+        prediction = model.predict(prediction_request, Task.embedding)
+        np.testing.assert_allclose(prediction.model_outputs["embeddings"], expected, rtol=1e-4, atol=1e-5)
+        assert len(trimmed) == 1
+
+        # later requests are still sorted into length buckets
+        monkeypatch.setattr(model, "_sequence_output_dims", sequence_output_dims)
+        model.predict(prediction_request, Task.embedding)
+        assert len(trimmed) == 3
+
     @pytest.mark.asyncio
     async def test_embedding_unknown_mode(self, prediction_request, test_transformer_embedding):
         prediction_request.task_kwargs = {"embedding_mode": "this mode does not exist"}
@@ -222,6 +298,36 @@ class TestTransformerQuestionAnswering:
         assert prediction.answers[0][0].score >= prediction.answers[0][1].score
         assert all(prediction.answers[0][i].answer == answers[i] for i in range(2))
 
+
+def test_decode_spans_matches_outer_product():
+    torch.manual_seed(0)
+    start_logits, end_logits = torch.randn(3, 12), torch.randn(3, 12)
+    context_tokens = torch.zeros(3, 12, dtype=torch.bool)
+    context_tokens[:, 0] = True
+    context_tokens[:, 4:10] = True
+    starts, ends, scores, no_answer_scores = Transformer._decode_spans(start_logits, end_logits, context_tokens, 3, 4)
+
+    for idx in range(3):
+        start = torch.softmax(start_logits[idx].masked_fill(~context_tokens[idx], -10000.0), dim=-1)
+        end = torch.softmax(end_logits[idx].masked_fill(~context_tokens[idx], -10000.0), dim=-1)
+        assert no_answer_scores[idx].item() == pytest.approx((start[0] * end[0]).item(), rel=1e-4)
+        start[0] = end[0] = 0.0
+        outer = torch.tril(torch.triu(torch.outer(start, end)), 3)
+        expected_scores, expected_idx = torch.topk(outer.flatten(), 3)
+        np.testing.assert_allclose(scores[idx].numpy(), expected_scores.numpy(), rtol=1e-4)
+        assert starts[idx].tolist() == (expected_idx // 12).tolist()
+        assert ends[idx].tolist() == (expected_idx % 12).tolist()
+
+
+def test_span_char_offsets_extend_to_words():
+    # question token, then context words "hello" (2 tokens) and "world" (1 token)
+    word_ids = np.array([[np.nan, np.nan, 0, 0, 1, np.nan]])
+    offsets = np.array([[[0, 0], [0, 5], [0, 3], [3, 5], [6, 11], [0, 0]]])
+    start_chars, end_chars = Transformer._span_char_offsets(word_ids, offsets, np.array([[3, 4]]), np.array([[3, 4]]))
+    assert start_chars.tolist() == [[0, 6]]
+    assert end_chars.tolist() == [[5, 11]]
+
+
 @pytest.mark.usefixtures("test_transformer_explainability")
 class TestTransformerQuestionAnswering:
     test_input =  [["Who stars in The Matrix?",
@@ -281,7 +387,28 @@ class TestTransformerQuestionAnsweringRobertaModel:
         assert len(prediction.attributions[0].context_tokens[0][0]) == 3
 
 
-
+@pytest.mark.usefixtures("test_transformer_generation_bf16")
+class TestTransformerGenerationBf16:
+    @pytest.mark.asyncio
+    async def test_generation_bf16(self, prediction_request, test_transformer_generation_bf16, monkeypatch):
+        model = test_transformer_generation_bf16
+        generate = model.model.generate
+        autocast = []
+
+        def generate_with_autocast_check(*args, **kwargs):
+            autocast.append(torch.is_autocast_cpu_enabled())
+            return generate(*args, **kwargs)
+
+        monkeypatch.setattr(model.model, "generate", generate_with_autocast_check)
+        prediction_request.input = ["Generate text"]
+        prediction_request.task_kwargs = {"max_new_tokens": 5}
+        prediction_request.model_kwargs = {"output_scores": True}
+
+        prediction = model.predict(prediction_request, Task.generation)
+        assert model.precision == "bf16"
+        assert autocast == [True]
+        assert isinstance(prediction.generated_texts[0][0], str)
+        assert "scores" in prediction.model_outputs
 
 
 @pytest.mark.usefixtures("test_transformer_generation")
@@ -296,6 +423,35 @@ class TestTransformerGeneration:
         prediction = test_transformer_generation.predict(prediction_request, Task.generation)
         assert all(isinstance(prediction.generated_texts[i][0], str) for i in range(len(input)))
 
+    @pytest.mark.asyncio
+    async def test_generation_batched_prompts(self, prediction_request, test_transformer_generation, monkeypatch):
+        input = ["Generate text", "And a lot more text to generate from"]
+        prediction_request.task_kwargs = {"max_new_tokens": 5}
+        monkeypatch.setattr(model_config, "batch_size", 2)
+
+        prediction_request.input = input
+        prediction = test_transformer_generation.predict(prediction_request, Task.generation)
+        assert len(prediction.generated_texts) == len(input)
+        for i, prompt in enumerate(input):
+            prediction_request.input = [prompt]
+            single = test_transformer_generation.predict(prediction_request, Task.generation)
+            assert prediction.generated_texts[i] == single.generated_texts[0]
+
+    @pytest.mark.asyncio
+    async def test_generation_max_length_independent_of_batch(self, prediction_request, test_transformer_generation,
+                                                              monkeypatch):
+        input = ["Generate text", "And a lot more text to generate from", "Generate more"]
+        # max_length includes the prompt, so the left padding of a batch must not count towards it
+        prediction_request.task_kwargs = {"max_length": 12}
+        monkeypatch.setattr(model_config, "batch_size", 3)
+
+        prediction_request.input = input
+        prediction = test_transformer_generation.predict(prediction_request, Task.generation)
+        for i, prompt in enumerate(input):
+            prediction_request.input = [prompt]
+            single = test_transformer_generation.predict(prediction_request, Task.generation)
+            assert prediction.generated_texts[i] == single.generated_texts[0]
+
     @pytest.mark.asyncio
     async def test_generation_output_attention_and_scores(self, prediction_request, test_transformer_generation):
         prediction_request.model_kwargs = {
@@ -0,0 +1,183 @@
+import threading
+
+import numpy as np
+import torch
+
+from tasks.batching import RequestBatcher, sequence_outputs, split_prediction
+from tasks.inference.model import Model
+from tasks.models.prediction import (PredictionOutputForSequenceClassification,
+                                     PredictionOutputForTokenClassification, _decode_numpy)
+from tasks.models.request import PredictionRequest, Task
+
+
+class CountingModel(Model):
+    """
+    Classifies each input by its length and counts the calls to predict
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def can_batch(self, request, task):
+        return True
+
+    def predict(self, request, task):
+        self.calls.append(len(request.input))
+        logits = torch.tensor([[float(len(text)), 0.0] for text in request.input])
+        return PredictionOutputForSequenceClassification(
+            model_outputs={"logits": logits}, labels=[len(text) for text in request.input]
+        )
+
+
+def test_split_prediction_sequence_classification():
+    output = PredictionOutputForSequenceClassification(
+        model_outputs={"logits": torch.tensor([[1.0, 0.0], [2.0, 0.0], [3.0, 0.0]])},
+        labels=[0, 1, 0],
+        id2label={0: "neg", 1: "pos"},
+    ).dict()
+    first, second = split_prediction(output, [1, 2])
+    assert first["labels"] == [0]
+    assert second["labels"] == [1, 0]
+    assert second["id2label"] == {0: "neg", 1: "pos"}
+    logits = _decode_numpy(second["model_outputs"], second["model_output_is_encoded"])["logits"]
+    np.testing.assert_array_equal(logits, np.array([[2.0, 0.0], [3.0, 0.0]]))
+
+
+def test_split_prediction_removes_padding():
+    output = PredictionOutputForTokenClassification(
+        model_outputs={"logits": torch.zeros(3, 5, 2)},
+        labels=[[0] * 5, [1] * 5, [0] * 5],
+        word_ids=[[None, 0, None, None, None], [None, 0, 1, 2, None], [None, 0, 1, None, None]],
+    ).dict()
+    sequence_keys = sequence_outputs(PredictionRequest(input=[]), Task.token_classification)
+    first, second = split_prediction(output, [1, 2], lengths=[3, 5, 4], sequence_keys=sequence_keys)
+    assert first["word_ids"] == [[None, 0, None]]
+    assert first["labels"] == [[0] * 3]
+    assert second["word_ids"] == [[None, 0, 1, 2, None], [None, 0, 1, None, None]]
+    first_logits = _decode_numpy(first["model_outputs"], first["model_output_is_encoded"])["logits"]
+    assert first_logits.shape == (1, 3, 2)
+
+
+def test_batcher_merges_concurrent_requests():
+    model = CountingModel()
+    batcher = RequestBatcher(model, max_batch_size=32, max_wait_time=0.5)
+    inputs = [["a"], ["bb", "ccc"], ["dddd"]]
+    results = [None] * len(inputs)
+
+    def submit(i):
+        results[i] = batcher.submit(PredictionRequest(input=inputs[i]), Task.sequence_classification)
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(inputs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert model.calls == [4]
+    for request_input, result in zip(inputs, results):
+        assert result["labels"] == [len(text) for text in request_input]
+
+
+def test_batcher_flushes_full_batch():
+    model = CountingModel()
+    batcher = RequestBatcher(model, max_batch_size=2, max_wait_time=10)
+    result = batcher.submit(PredictionRequest(input=["a", "bb"]), Task.sequence_classification)
+    assert model.calls == [2]
+    assert result["labels"] == [1, 2]
+
+
+class AdapterModel(CountingModel):
+    """
+    Classifies each input by its length times a factor of its adapter and records the calls with mixed adapters
+    """
+
+    factors = {"a": 1, "b": 10}
+
+    def __init__(self, can_mix=True):
+        super().__init__()
+        self.can_mix = can_mix
+        self.mixed_calls = []
+
+    def mixed_adapter_key(self, request, task):
+        return "classification"
+
+    def can_mix_adapters(self, adapter_names):
+        return self.can_mix
+
+    def predict(self, request, task):
+        self.calls.append(len(request.input))
+        return self._classify(request.input, [request.adapter_name] * len(request.input))
+
+    def predict_mixed(self, request, adapter_names, task):
+        self.mixed_calls.append(adapter_names)
+        return self._classify(request.input, adapter_names)
+
+    def _classify(self, inputs, adapter_names):
+        labels = [len(text) * self.factors[name] for text, name in zip(inputs, adapter_names)]
+        return PredictionOutputForSequenceClassification(
+            model_outputs={"logits": torch.tensor([[float(label), 0.0] for label in labels])}, labels=labels
+        )
+
+
+def submit_concurrently(batcher, requests):
+    results = [None] * len(requests)
+
+    def submit(i):
+        results[i] = batcher.submit(requests[i], Task.sequence_classification)
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_batcher_mixes_adapters():
+    model = AdapterModel()
+    batcher = RequestBatcher(model, max_batch_size=32, max_wait_time=0.5, mix_adapters=True)
+    requests = [
+        PredictionRequest(input=["a", "bb"], adapter_name="a"),
+        PredictionRequest(input=["ccc"], adapter_name="b"),
+    ]
+    results = submit_concurrently(batcher, requests)
+    assert model.calls == []
+    assert len(model.mixed_calls) == 1
+    assert sorted(model.mixed_calls[0]) == ["a", "a", "b"]
+    assert results[0]["labels"] == [1, 2]
+    assert results[1]["labels"] == [30]
+
+
+def test_batcher_predicts_adapters_separately_if_they_cannot_be_mixed():
+    model = AdapterModel(can_mix=False)
+    batcher = RequestBatcher(model, max_batch_size=32, max_wait_time=0.5, mix_adapters=True)
+    requests = [
+        PredictionRequest(input=["a"], adapter_name="a"),
+        PredictionRequest(input=["bb"], adapter_name="b"),
+        PredictionRequest(input=["ccc"], adapter_name="a"),
+    ]
+    results = submit_concurrently(batcher, requests)
+    assert model.mixed_calls == []
+    assert sorted(model.calls) == [1, 2]
+    assert [result["labels"] for result in results] == [[1], [20], [3]]
+
+
+class TokenizingModel(CountingModel):
+    """
+    CountingModel with a tokenizer that splits the inputs into characters
+    """
+
+    def tokenizer(self, inputs, padding=False, **kwargs):
+        return {"input_ids": [list(text) for text in inputs]}
+
+
+def test_batcher_merges_sequence_classification_with_tokenizer():
+    model = TokenizingModel()
+    batcher = RequestBatcher(model, max_batch_size=32, max_wait_time=0.5)
+    requests = [PredictionRequest(input=["a", "bbbbb"]), PredictionRequest(input=["ccc"])]
+    results = submit_concurrently(batcher, requests)
+    assert model.calls == [3]
+    # labels of sequence classification are not token-level and not truncated to the input lengths
+    assert [result["labels"] for result in results] == [[1, 5], [3]]
+    logits = _decode_numpy(results[1]["model_outputs"], results[1]["model_output_is_encoded"])["logits"]
+    np.testing.assert_array_equal(logits, np.array([[3.0, 0.0]]))
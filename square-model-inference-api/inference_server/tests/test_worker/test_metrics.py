@@ -0,0 +1,87 @@
+import time
+
+import torch
+
+from tasks.config import model_config as config_module
+from tasks.config.model_config import load_process_statistics, remove_process_statistics
+from tasks.metrics import Metrics, render_prometheus
+
+
+def test_observations_are_labeled_and_rendered():
+    metrics = Metrics()
+    with metrics.labels(model="bert", task="embedding"):
+        metrics.observe("inference_batch_inputs", 3)
+        metrics.observe("inference_batch_inputs", 3000)
+    metrics.observe("inference_batch_inputs", 1)
+
+    text = render_prometheus([metrics.snapshot(), metrics.snapshot()])
+    assert "# TYPE inference_batch_inputs histogram" in text
+    assert 'inference_batch_inputs_bucket{model="bert",task="embedding",le="2.0"} 0' in text
+    assert 'inference_batch_inputs_bucket{model="bert",task="embedding",le="4.0"} 2' in text
+    assert 'inference_batch_inputs_bucket{model="bert",task="embedding",le="+Inf"} 4' in text
+    assert 'inference_batch_inputs_count{model="bert",task="embedding"} 4' in text
+    assert 'inference_batch_inputs_sum{model="bert",task="embedding"} 6006.0' in text
+    assert 'inference_batch_inputs_bucket{le="1.0"} 2' in text
+
+
+def test_collected_stages_include_nested_and_added_timing():
+    metrics = Metrics()
+    with metrics.collect() as timing:
+        with metrics.collect() as inner:
+            metrics.observe_stage("forward", 0.5)
+        metrics.add_timing({"forward": 0.25, "batch_wait": 1.0})
+    assert inner == {"forward": 0.5}
+    assert timing == {"forward": 0.75, "batch_wait": 1.0}
+    # stages added from another thread are not observed twice
+    forward = [h for h in metrics.snapshot() if h["labels"] == {"stage": "forward"}]
+    assert forward[0]["count"] == 1
+
+
+def test_predict_timer_counts_remaining_time_as_postprocessing():
+    metrics = Metrics()
+    with metrics.collect() as timing:
+        with metrics.predict_timer():
+            with metrics.timer("forward"):
+                time.sleep(0.02)
+            time.sleep(0.02)
+    assert timing["predict"] >= timing["forward"] + timing["postprocessing"] - 1e-6
+    assert timing["postprocessing"] >= 0.015
+
+
+def test_padding_ratio_and_input_tokens():
+    metrics = Metrics()
+    metrics.observe_batch(2, torch.tensor([[1, 1, 1, 1], [1, 0, 0, 0]]))
+    histograms = {h["name"]: h for h in metrics.snapshot()}
+    assert histograms["inference_batch_inputs"]["sum"] == 2
+    assert histograms["inference_padding_ratio"]["sum"] == 3 / 8
+    assert histograms["inference_input_tokens"]["count"] == 2
+
+
+def test_saved_metrics_are_loaded_for_the_api(tmp_path, monkeypatch):
+    # metrics stored by earlier runs must not be loaded
+    monkeypatch.setattr(config_module, "CONFIG_PATH", str(tmp_path))
+    metrics = Metrics()
+    metrics.observe("inference_stage_seconds", 0.1, stage="forward")
+    metrics.save()
+    assert metrics.snapshot() in load_process_statistics("metrics")
+
+    # writes are throttled unless forced
+    metrics.observe("inference_stage_seconds", 0.1, stage="forward")
+    metrics.save()
+    assert metrics.snapshot() not in load_process_statistics("metrics")
+    metrics.save(force=True)
+    assert metrics.snapshot() in load_process_statistics("metrics")
+
+
+def test_metrics_of_stopped_workers_are_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(config_module, "CONFIG_PATH", str(tmp_path))
+    # a model config that ends like the metrics files is not loaded as metrics
+    (tmp_path / "model-metrics.json").write_text('{"model_name": "model"}')
+    metrics = Metrics()
+    metrics.observe("inference_stage_seconds", 0.1, stage="forward")
+    metrics.save(force=True)
+    assert load_process_statistics("metrics") == [metrics.snapshot()]
+
+    remove_process_statistics()
+    assert load_process_statistics("metrics") == []
+    assert (tmp_path / "model-metrics.json").exists()
@@ -0,0 +1,70 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from tasks.config import model_config as config_module
+from tasks.config.model_config import ModelConfig, load_process_statistics, save_process_statistics, worker_id
+
+
+identifier = "test_config_cache"
+
+
+@pytest.fixture(autouse=True)
+def config_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(config_module, "CONFIG_PATH", str(tmp_path))
+    return tmp_path
+
+
+def test_load_from_file_parses_unchanged_file_once():
+    ModelConfig(model_name="bert-base-uncased", model_type="transformer", batch_size=4).save(identifier)
+    with patch.object(config_module.json, "load", wraps=config_module.json.load) as json_load:
+        first = ModelConfig.load_from_file(identifier)
+        second = ModelConfig.load_from_file(identifier)
+    assert json_load.call_count == 1
+    assert first.batch_size == second.batch_size == 4
+
+
+def test_load_from_file_reloads_after_save():
+    config = ModelConfig(model_name="bert-base-uncased", model_type="transformer", batch_size=4)
+    config.save(identifier)
+    assert ModelConfig.load_from_file(identifier).batch_size == 4
+    config.batch_size = 16
+    config.save(identifier)
+    assert ModelConfig.load_from_file(identifier).batch_size == 16
+
+
+def test_load_from_file_returns_independent_configs():
+    ModelConfig(model_name="bert-base-uncased", model_type="transformer", batch_size=4).save(identifier)
+    config = ModelConfig.load_from_file(identifier)
+    config.batch_size = 64
+    assert ModelConfig.load_from_file(identifier).batch_size == 4
+
+
+def test_update_keeps_defaults_for_settings_missing_in_older_config_files(config_path, monkeypatch):
+    monkeypatch.setattr(config_module, "IDENTIFIER", identifier)
+    ModelConfig(model_name="bert-base-uncased", model_type="transformer", batch_size=4).save(identifier)
+    with open(config_path / f"{identifier}.json") as f:
+        config = json.load(f)
+    older_config = {k: config[k] for k in [
+        "model_name", "model_type", "model_path", "data_path", "decoder_path", "preloaded_adapters", "disable_gpu",
+        "batch_size", "max_input_size", "transformers_cache", "model_class", "return_plaintext_arrays",
+    ]}
+    with open(config_path / f"{identifier}.json", "w") as f:
+        json.dump(older_config, f)
+
+    model_config = ModelConfig.load_from_file(identifier)
+    model_config.update()
+    assert model_config.batch_size == 4
+    assert model_config.precision == "fp32"
+    assert model_config.binary_arrays is False
+
+
+def test_worker_statistics_are_replaced_atomically(config_path):
+    assert load_process_statistics("adapter_cache", identifier) == []
+    save_process_statistics(identifier, "adapter_cache", {"hits": 1})
+    save_process_statistics(identifier, "adapter_cache", {"hits": 2})
+    assert load_process_statistics("adapter_cache", identifier) == [{"hits": 2}]
+    # no temporary files are left behind
+    path = config_path / "worker_statistics" / identifier / "adapter_cache"
+    assert [p.name for p in path.iterdir()] == [f"{worker_id()}.json"]
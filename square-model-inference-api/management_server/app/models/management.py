@@ -45,6 +45,18 @@ class DeployRequest(BaseModel):
     model_name: str = Field("", description="the name of model on HF, AdapterHub or sentence-transformers platform")
     model_path: Optional[str] = Field(None, description="model path for the ONNX models")
     decoder_path: Optional[str] = Field(None, description="path of the decoder ONNX model")
+    decoder_with_past_path: Optional[str] = Field(
+        None, description="path of the ONNX model with past-key-value inputs for incremental generation"
+    )
+    onnx_intra_op_threads: Optional[int] = Field(0, description="onnx runtime intra-op threads, 0 for the default")
+    onnx_inter_op_threads: Optional[int] = Field(0, description="onnx runtime inter-op threads, 0 for the default")
+    onnx_graph_optimization: Optional[str] = Field(
+        "all", description="onnx runtime graph optimization level: disable, basic, extended or all"
+    )
+    onnx_execution_mode: Optional[str] = Field(
+        "sequential", description="onnx runtime execution mode: sequential or parallel"
+    )
+    onnx_memory_arena: Optional[bool] = Field(True, description="whether onnx runtime uses a memory arena on CPU")
     model_type: str = Field("", description="transformer, adapter, onnx, or sentence-transformer")
     disable_gpu: Optional[bool] = Field(True, description="whether to use gpu for inference")
     batch_size: int = Field("", description="input batch size")
@@ -56,7 +68,45 @@ class DeployRequest(BaseModel):
         "for valid names and corresponding class",
     )
     return_plaintext_arrays: Optional[bool] = Field(False, description="whether to encode outputs")
+    binary_arrays: Optional[bool] = Field(
+        False, description="whether encoded outputs are stored as binary buffers and results with msgpack"
+    )
+    precision: Optional[str] = Field(
+        "fp32", description="numeric precision of transformer and adapter models on CPU: fp32, int8 or bf16"
+    )
+    precision_check: Optional[bool] = Field(
+        True, description="whether to compare int8 or bf16 outputs and latency against fp32 when loading the model"
+    )
+    precision_tolerance: Optional[float] = Field(
+        0.05, description="max. relative error of the precision check before falling back to fp32"
+    )
     preloaded_adapters: Optional[bool] = Field(True, description="whether to preload adapters")
+    max_adapters: Optional[int] = Field(
+        0,
+        description="max. number of adapters kept in memory, "
+        "least recently used adapters are removed first (0 for no limit)",
+    )
+    max_adapter_memory: Optional[int] = Field(
+        0, description="max. memory in MB of all adapters kept in memory (0 for no limit)"
+    )
+    enable_batching: Optional[bool] = Field(
+        False, description="whether to merge concurrently queued requests into a single forward pass"
+    )
+    batch_wait_time: Optional[float] = Field(
+        0.01, description="max. time in seconds to wait for requests to merge when batching is enabled"
+    )
+    mix_adapters: Optional[bool] = Field(
+        False, description="whether requests for different adapters are merged as well when batching is enabled"
+    )
+    embedding_cache_size: Optional[int] = Field(
+        0, description="max. memory in MB of embeddings cached by the worker (0 disables the cache)"
+    )
+    embedding_cache_ttl: Optional[int] = Field(
+        0, description="time in seconds after which cached embeddings expire (0 for no expiry)"
+    )
+    embedding_cache_redis_url: Optional[str] = Field(
+        "", description="optional redis url to share cached embeddings between workers"
+    )
 
 
 class TaskGenericModel(BaseModel):
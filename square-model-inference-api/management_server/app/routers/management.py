@@ -170,6 +170,12 @@ async def deploy_new_model(request: Request, model_params: DeployRequest):
         "MODEL_NAME": model_params.model_name,
         "MODEL_PATH": model_params.model_path,
         "DECODER_PATH": model_params.decoder_path,
+        "DECODER_WITH_PAST_PATH": model_params.decoder_with_past_path,
+        "ONNX_INTRA_OP_THREADS": model_params.onnx_intra_op_threads,
+        "ONNX_INTER_OP_THREADS": model_params.onnx_inter_op_threads,
+        "ONNX_GRAPH_OPTIMIZATION": model_params.onnx_graph_optimization,
+        "ONNX_EXECUTION_MODE": model_params.onnx_execution_mode,
+        "ONNX_MEMORY_ARENA": model_params.onnx_memory_arena,
         "MODEL_TYPE": model_params.model_type,
         "MODEL_CLASS": model_params.model_class,
         "DISABLE_GPU": model_params.disable_gpu,
@@ -177,7 +183,19 @@ async def deploy_new_model(request: Request, model_params: DeployRequest):
         "MAX_INPUT_SIZE": model_params.max_input,
         "TRANSFORMERS_CACHE": model_params.transformers_cache,
         "RETURN_PLAINTEXT_ARRAYS": model_params.return_plaintext_arrays,
+        "BINARY_ARRAYS": model_params.binary_arrays,
+        "PRECISION": model_params.precision,
+        "PRECISION_CHECK": model_params.precision_check,
+        "PRECISION_TOLERANCE": model_params.precision_tolerance,
         "PRELOADED_ADAPTERS": model_params.preloaded_adapters,
+        "MAX_ADAPTERS": model_params.max_adapters,
+        "MAX_ADAPTER_MEMORY": model_params.max_adapter_memory,
+        "ENABLE_BATCHING": model_params.enable_batching,
+        "BATCH_WAIT_TIME": model_params.batch_wait_time,
+        "MIX_ADAPTERS": model_params.mix_adapters,
+        "EMBEDDING_CACHE_SIZE": model_params.embedding_cache_size,
+        "EMBEDDING_CACHE_TTL": model_params.embedding_cache_ttl,
+        "EMBEDDING_CACHE_REDIS_URL": model_params.embedding_cache_redis_url,
         "WEB_CONCURRENCY": os.getenv("WEB_CONCURRENCY", 1),  # fixed processes, do not give the control to  end-user
         "KEYCLOAK_BASE_URL": os.getenv("KEYCLOAK_BASE_URL", "https://square.ukp-lab.de"),
         "VERIFY_ISSUER": os.getenv("VERIFY_ISSUER", "1")
@@ -353,6 +371,7 @@ async def init_db_from_docker(token: str = Depends(client_credentials)):
                     "TRANSFORMERS_CACHE": data.get("transformers_cache", ""),
                     "MODEL_PATH": data.get("model_path", ""),
                     "DECODER_PATH": data.get("decoder_path", ""),
+                    "DECODER_WITH_PAST_PATH": data.get("decoder_with_past_path", ""),
                     "CONTAINER": container,
                 }
             )
@@ -15,6 +15,8 @@ CONFIG_VOLUME = os.getenv("CONFIG_VOLUME", "square-model-inference-api_model_con
 MODELS_API_PATH = "models"  # For management server e.g. /api/models/deployed-models to list models etc.
 USER = os.getenv("USERNAME", "user")
 PASSWORD = os.getenv("PASSWORD", "user")
+# Number of worker threads of models with ENABLE_BATCHING, i.e. the max. number of requests that can be merged
+BATCHING_CONCURRENCY = os.getenv("BATCHING_CONCURRENCY", 8)
 
 
 def create_docker_labels(identifier: str, uid: str) -> dict:
@@ -86,11 +88,16 @@ def start_new_model_container(identifier: str, uid: str, env):
     env["REDIS_PASSWORD"] = os.getenv("REDIS_PASSWORD", "secret")
     env["CONFIG_PATH"] = os.getenv("CONFIG_PATH", "/model_configs")
 
+    command = f"celery -A tasks worker -Q {identifier.replace('/', '-')} --loglevel=info"
+    if str(env.get("ENABLE_BATCHING", False)).lower() in ["true", "1"]:
+        # requests can only be merged if the worker processes several tasks at once
+        command += f" --pool threads --concurrency {BATCHING_CONCURRENCY}"
+
     try:
         logger.info(f"CONFIG_VOLUME={CONFIG_VOLUME}")
         container = docker_client.containers.run(
             MODEL_API_IMAGE,
-            command=f"celery -A tasks worker -Q {identifier.replace('/', '-')} --loglevel=info",
+            command=command,
             name=worker_name,
             detach=True,
             environment=env,